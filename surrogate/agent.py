@@ -133,6 +133,8 @@ class Actor:
             self.convnet = conv
         elif self.conv:
             self.convnet = ConvNet(args,self.conv)
+        # Shared encoder: the layers after the ConvNet are also a head model on the embedding
+        self.shared = getattr(args,"shared_encoder",False) and bool(self.conv)
         self.model = self.build_pi_network(self.convnet.model if self.conv else None)
         self.agent_dir = args.agent_dir
         if args.load_agent:
@@ -145,6 +147,9 @@ class Actor:
         else:
             x_in = [Input(shape=ip.shape[1:]) for ip in conv.input]
             x = conv(x_in)
+        if self.shared:
+            emb = x
+            x = emb_in = Input(shape=tuple(emb.shape[1:]))
         for _ in range(self.n_layer):
             x = Dense(self.net_dim, activation=self.activation)(x)
         if self.conti:
@@ -157,6 +162,9 @@ class Actor:
         else:
             output = Dense(np.product(self.action_shape), activation='softmax')(x)
             output = tfp.layers.DistributionLambda(lambda t: tfd.RelaxedOneHotCategorical(1.0,probs=t))(output)
+        if self.shared:
+            self.head = Model(inputs=emb_in, outputs=output)
+            output = self.head(emb)
         model = Model(inputs=x_in, outputs=output)
         return model
 
@@ -181,7 +189,9 @@ class Actor:
         settings = self.convert_action_to_setting(action)
         return tf.squeeze(settings)
 
-    def forward(self, observ):
+    def forward(self, observ, emb=None):
+        if emb is not None:
+            return self.head(emb)
         inp = self.get_input(observ)
         probs = self.model(inp)
         return probs
@@ -195,8 +205,8 @@ class Actor:
         else:
             return tf.argmax(distr.sample(),axis=-1) if train else tf.argmax(distr.probs,axis=-1)
 
-    def get_action_probs(self, observ):
-        distr = self.forward(observ)
+    def get_action_probs(self, observ, emb=None):
+        distr = self.forward(observ,emb)
         if self.conti:
             a = distr.sample()
             logp_action = distr.log_prob(a)
@@ -290,21 +300,25 @@ class QAgent:
             self.convnet = conv
         elif self.conv:
             self.convnet = ConvNet(args,self.conv)
+        self.shared = getattr(args,"shared_encoder",False) and bool(self.conv)
         self.model = self.build_q_network(self.convnet.model if self.conv else None)
-        self.target_model = self.build_q_network(self.convnet.model if self.conv else None)
+        self.target_model = self.build_q_network(self.convnet.model if self.conv else None,target=True)
         self.target_model.set_weights(self.model.get_weights())
         self.agent_dir = args.agent_dir
         # TODO value normalization
         self.value_tau = getattr(args,"value_tau",0.005)
         self.value_avg,self.value_std = tf.constant(0.0),tf.constant(1.0)
         
-    def build_q_network(self,conv=None):
+    def build_q_network(self,conv=None,target=False):
         if conv is None:
             inp = Input(shape=(self.observ_size,))
             x = inp
         else:
             inp = [Input(shape=ip.shape[1:]) for ip in conv.input]
             x = conv(inp)
+        if self.shared:
+            emb = x
+            x = emb_in = Input(shape=tuple(emb.shape[1:]))
         if self.conti:
             a_dim = sum(self.action_shape) if isinstance(self.action_shape,(np.ndarray,list)) else self.action_shape
             a_in = Input(shape=(a_dim,))
@@ -318,6 +332,10 @@ class QAgent:
         else:
             out_dim = 1 if self.conti else np.product(self.action_shape)
             output = Dense(out_dim, activation='linear')(x)
+        if self.shared:
+            head = Model(inputs=[emb_in,a_in] if self.conti else emb_in, outputs=output)
+            setattr(self,'target_head' if target else 'head',head)
+            output = head([emb,a_in] if self.conti else emb)
         model = Model(inputs=inp, outputs=output)
         return model
     
@@ -334,9 +352,13 @@ class QAgent:
             inp = inp + [act] if isinstance(inp,list) else [inp,act]
         return inp
 
-    def forward(self,observ,act=None,target=False):
-        inp = self.get_input(observ,act)
-        q = self.target_model(inp) if target else self.model(inp)
+    def forward(self,observ,act=None,target=False,emb=None):
+        if emb is not None:
+            inp = [emb,act] if self.conti else emb
+            q = self.target_head(inp) if target else self.head(inp)
+        else:
+            inp = self.get_input(observ,act)
+            q = self.target_model(inp) if target else self.model(inp)
         if not self.conti and act is not None:
             if isinstance(self.action_shape,(np.ndarray,list)) and self.mac:
                 q = tf.stack([tf.gather(qi,ai,axis=-1,batch_dims=1)
@@ -377,6 +399,107 @@ class QAgent:
         self.model.load_weights(join(agent_dir,'qnet%s.h5'%i))
         self.target_model.load_weights(join(agent_dir,'qnet%s_target.h5'%i))
 
+class AgentDense(tf.keras.layers.Layer):
+    # Independent dense layer per agent: (batch,n_agents,in) -> (batch,n_agents,units)
+    def __init__(self, units, activation=None, **kwargs):
+        super(AgentDense,self).__init__(**kwargs)
+        self.units = units
+        self.activation = activations.get(activation)
+
+    def build(self,input_shape):
+        self.w = self.add_weight(
+            name='weight',shape=(input_shape[-2],input_shape[-1],self.units),initializer='glorot_uniform',trainable=True,
+        )
+        self.b = self.add_weight(
+            name='bias',shape=(input_shape[-2],self.units),initializer='zeros',trainable=True,
+        )
+        super(AgentDense,self).build(input_shape)
+
+    def call(self,inputs):
+        return self.activation(tf.einsum('bni,niu->bnu',inputs,self.w) + self.b)
+
+class StackedQAgent:
+    """
+    Q networks of all agents evaluated in one call.
+
+    Each agent keeps its own weights (AgentDense) on its observation padded to the largest
+    observation, and its Q head is padded to the largest action space with masked entries.
+
+    Parameters
+    ----------
+    action_shape : np.ndarray
+        number of actions of each agent.
+    observ_space : list
+        state indexes of each agent (dec) or None to observe all the states.
+    args : argparse.Namespace
+        agent arguments with states, net_dim, n_layer, activation and agent_dir.
+    """
+    def __init__(self,
+                 action_shape,
+                 observ_space,
+                 args):
+        self.action_shape = np.array(action_shape)
+        self.n_agents = len(action_shape)
+        self.n_state = len(getattr(args,"states"))
+        self.net_dim = getattr(args,"net_dim",128)
+        self.n_layer = getattr(args, "n_layer", 3)
+        self.activation = getattr(args,"activation",False)
+        # Observation gather indexes, padded with the appended zero column
+        observ_space = [list(range(self.n_state)) for _ in range(self.n_agents)] if observ_space is None else observ_space
+        self.n_obs = max([len(ob) for ob in observ_space])
+        self.obs_idx = np.array([list(ob) + [self.n_state]*(self.n_obs-len(ob)) for ob in observ_space],dtype=np.int32)
+        self.n_act = int(self.action_shape.max())
+        self.act_mask = tf.convert_to_tensor(np.arange(self.n_act)[None,:] < self.action_shape[:,None])
+        self.model = self.build_q_network()
+        self.target_model = self.build_q_network()
+        self.target_model.set_weights(self.model.get_weights())
+        self.agent_dir = args.agent_dir
+
+    def build_q_network(self):
+        x_in = Input(shape=(self.n_agents,self.n_obs,))
+        x = x_in
+        for _ in range(self.n_layer):
+            x = AgentDense(self.net_dim, activation=self.activation)(x)
+        output = AgentDense(self.n_act, activation='linear')(x)
+        model = Model(inputs=x_in, outputs=output)
+        return model
+
+    def get_input(self,observ):
+        # Selected states are behind the rainfall features
+        states = observ[...,-self.n_state:]
+        states = tf.concat([states,tf.zeros_like(states[...,:1])],axis=-1)
+        return tf.gather(states,self.obs_idx,axis=-1)
+
+    def forward(self,observ,act=None,target=False):
+        inp = self.get_input(observ)
+        q = self.target_model(inp) if target else self.model(inp)
+        q = tf.where(self.act_mask,q,-1e9*tf.ones_like(q))
+        if act is not None:
+            q = tf.gather(q,tf.cast(act,tf.int32),axis=-1,batch_dims=2)
+        return q
+
+    def _hard_update_target_model(self):
+        self.target_model.set_weights(self.model.get_weights())
+
+    def _soft_update_target_model(self,tau):
+        target_model_weights = array(self.target_model.get_weights())
+        model_weights = array(self.model.get_weights())
+        new_weight = (1. - tau) * target_model_weights \
+            + tau * model_weights
+        self.target_model.set_weights(new_weight)
+
+    def save(self,agent_dir=None,i=None):
+        i = '' if i is None else str(i)
+        agent_dir = agent_dir if agent_dir is not None else self.agent_dir
+        self.model.save_weights(join(agent_dir,'qnet_stacked%s.h5'%i))
+        self.target_model.save_weights(join(agent_dir,'qnet_stacked%s_target.h5'%i))
+
+    def load(self,agent_dir=None,i=None):
+        i = '' if i is None else str(i)
+        agent_dir = agent_dir if agent_dir is not None else self.agent_dir
+        self.model.load_weights(join(agent_dir,'qnet_stacked%s.h5'%i))
+        self.target_model.load_weights(join(agent_dir,'qnet_stacked%s_target.h5'%i))
+
 class VAgent:
     def __init__(self,
                  observ_size,
@@ -393,24 +516,32 @@ class VAgent:
             self.convnet = conv
         elif self.conv:
             self.convnet = ConvNet(args,self.conv)
+        self.shared = getattr(args,"shared_encoder",False) and bool(self.conv)
         self.model = self.build_v_network(self.convnet.model if self.conv else None)
-        self.target_model = self.build_v_network(self.convnet.model if self.conv else None)
+        self.target_model = self.build_v_network(self.convnet.model if self.conv else None,target=True)
         self.target_model.set_weights(self.model.get_weights())
         self.agent_dir = args.agent_dir
         # TODO value normalization
         self.value_tau = getattr(args,"value_tau",0.0)
         self.value_avg,self.value_std = tf.constant(0.0),tf.constant(1.0)
 
-    def build_v_network(self,conv=None):
+    def build_v_network(self,conv=None,target=False):
         if conv is None:
             inp = Input(shape=(self.observ_size,))
             x = inp
         else:
             inp = [Input(shape=ip.shape[1:]) for ip in conv.input]
             x = conv(inp)
+        if self.shared:
+            emb = x
+            x = emb_in = Input(shape=tuple(emb.shape[1:]))
         for _ in range(self.n_layer):
             x = Dense(self.net_dim, activation=self.activation)(x)
         output = Dense(1, activation='linear')(x)
+        if self.shared:
+            head = Model(inputs=emb_in, outputs=output)
+            setattr(self,'target_head' if target else 'head',head)
+            output = head(emb)
         model = Model(inputs=inp, outputs=output)
         return model
     
@@ -425,7 +556,9 @@ class VAgent:
             inp = observ
         return inp
 
-    def forward(self,observ,target=False):
+    def forward(self,observ,target=False,emb=None):
+        if emb is not None:
+            return self.target_head(emb) if target else self.head(emb)
         inp = self.get_input(observ)
         v = self.target_model(inp) if target else self.model(inp)
         return v
@@ -507,6 +640,12 @@ class AgentSAC:
 
             self.alpha_log = tf.Variable(-1,dtype=tf.float32,trainable=True)
             self.alpha_optimizer = Adam(learning_rate=getattr(args,"act_lr",1e-4),clipnorm=1.0)
+            # Fused update: one graph for all the losses and optimizers
+            self.shared = getattr(args,"shared_encoder",False) and bool(self.conv)
+            if self.shared:
+                self.update_eval = tf.function(self.shared_update,jit_compile=getattr(args,"jit_compile",False))
+            elif getattr(args,"fused",False):
+                self.update_eval = tf.function(self.fused_update,jit_compile=getattr(args,"jit_compile",False))
 
         self.agent_dir = args.agent_dir
         if args.load_agent:
@@ -653,9 +792,207 @@ class AgentSAC:
                 self.val_optimizer.apply_gradients(zip(grads, self.vnet.model.trainable_variables))
         return vf_loss
 
+    def _finite_grads(self,grads):
+        return [tf.where(tf.reduce_all(tf.math.is_finite(grad)),grad,tf.zeros_like(grad)) for grad in grads]
+
+    def fused_update(self,s,a,r,s_,train=True):
+        """
+        Same updates as update_eval traced into a single graph.
+
+        The actor runs once on the stacked batch [s,s_]: the s_ half gives the critic target
+        and the s half is shared by the alpha and policy losses. For the graph agents the critic
+        variables hold the shared ConvNet encoder, so the s half is recomputed after the critic
+        step, as alpha_update and actor_update do in update_eval.
+        The optimizers are applied in the order critic, alpha, actor, vnet.
+        """
+        variables = self.actor.model.trainable_variables
+        train_vars = self.qnet_0.model.trainable_variables+self.qnet_1.model.trainable_variables
+        vnet = getattr(self,"vnet",None)
+        n = tf.shape(r)[0]
+        with tf.GradientTape() as act_tape:
+            act_tape.watch(variables)
+            if self.conti or not self.mac:
+                ss = tf.nest.map_structure(lambda x,x_:tf.concat([x,x_],axis=0),s,s_)
+                outs = self.actor.get_action_probs(ss)
+                a_pg,log_probs = tf.nest.map_structure(lambda t:t[:n],outs)
+                a_,logprobs_ = tf.nest.map_structure(lambda t:tf.stop_gradient(t[n:]),outs)
+            else:
+                a_pg,log_probs = self.actor.get_action_probs(s)
+            with act_tape.stop_recording():
+                # Critic
+                if self.conti:
+                    q_ = tf.minimum(self.qnet_0.forward(s_,a_,target=True),self.qnet_1.forward(s_,a_,target=True))
+                    if len(logprobs_.shape)>1:
+                        logprobs_ = tf.reduce_mean(logprobs_,axis=-1)
+                    q_target = r + self.gamma * (tf.squeeze(q_,axis=-1) - tf.exp(self.alpha_log) * logprobs_)
+                elif self.mac:
+                    q_target = r + self.gamma * tf.squeeze(vnet.forward(s_,target=True),axis=-1)
+                else:
+                    q_ = tf.minimum(self.qnet_0.forward(s_,target=True),self.qnet_1.forward(s_,target=True))
+                    q_target = r + self.gamma * tf.reduce_sum((q_ - tf.exp(self.alpha_log) * logprobs_) * a_,axis=-1)
+                with tf.GradientTape() as tape:
+                    tape.watch(train_vars)
+                    q0,q1 = self.qnet_0.forward(s,a),self.qnet_1.forward(s,a)
+                    if len(q0.shape) > 1:
+                        q0,q1 = tf.reduce_mean(q0,axis=-1),tf.reduce_mean(q1,axis=-1)
+                    value_loss = self.mse(q_target,q0) + self.mse(q_target,q1)
+                if train:
+                    grads = self._finite_grads(tape.gradient(value_loss, train_vars))
+                    self.cri_optimizer.apply_gradients(zip(grads, train_vars))
+
+            if self.conv and train:
+                # The critic step also moved the shared ConvNet encoder: forward the actor again
+                a_pg,log_probs = self.actor.get_action_probs(s)
+
+            with act_tape.stop_recording():
+                # Alpha
+                if train:
+                    probs,logps = tf.nest.map_structure(tf.stop_gradient,(a_pg,log_probs))
+                    with tf.GradientTape() as tape:
+                        tape.watch(self.alpha_log)
+                        if self.conti:
+                            alpha_loss = self.alpha_log * tf.reduce_mean(self.action_shape-logps)
+                        elif self.mac and isinstance(self.action_shape,(list,np.ndarray)):
+                            alpha_loss = self.alpha_log * tf.reduce_mean([len(self.action_shape) - tf.reduce_sum(log_prob*prob,axis=-1)
+                                                          for prob,log_prob in zip(probs,logps)],axis=0)
+                        else:
+                            alpha_loss = self.alpha_log * tf.reduce_mean(1 - tf.reduce_sum(logps*probs,axis=-1),axis=0)
+                    grads = self._finite_grads(tape.gradient(alpha_loss, [self.alpha_log]))
+                    self.alpha_optimizer.apply_gradients(zip(grads, [self.alpha_log]))
+                alpha = tf.exp(self.alpha_log)
+                if vnet is not None:
+                    vpred = vnet.forward(s)
+
+            # Actor with the updated critics and alpha
+            if self.conti:
+                q_pg = tf.minimum(self.qnet_0.forward(s,a_pg), self.qnet_1.forward(s,a_pg))
+                if len(log_probs.shape) > 1:
+                    log_probs = tf.reduce_mean(log_probs,axis=-1)
+                policy_loss = tf.squeeze(q_pg,axis=-1) - log_probs * alpha
+            elif self.mac:
+                q_pg = self.qnet_0.forward(s),self.qnet_1.forward(s)
+                q_pg = [tf.minimum(q0,q1) for q0,q1 in zip(q_pg[0],q_pg[1])]
+                policy_loss = tf.reduce_mean([tf.reduce_sum(pg*(qi - vpred - lp * alpha),axis=-1)
+                                                for qi,pg,lp in zip(q_pg,a_pg,log_probs)],axis=0)
+            else:
+                q_pg = tf.minimum(self.qnet_0.forward(s),self.qnet_1.forward(s))
+                policy_loss = tf.reduce_sum(a_pg*(q_pg - log_probs * alpha),axis=-1)
+            policy_loss = tf.reduce_mean(policy_loss,axis=0)
+        if train:
+            grads = self._finite_grads(act_tape.gradient(-policy_loss, variables))
+            self.act_optimizer.apply_gradients(zip(grads, variables))
+        if vnet is not None:
+            # The value target needs the updated actor
+            vf_loss = self.vnet_update(s,train)
+            return value_loss,alpha,policy_loss,vf_loss
+        else:
+            return value_loss,alpha,policy_loss
+
+    def shared_update(self,s,a,r,s_,train=True):
+        """
+        Fused update with the ConvNet embedding computed once per batch.
+
+        One encoder pass on the stacked [s,s_] feeds the actor, critic, target and vnet heads.
+        The s_ half is a stop-gradient target. The critic, policy and vnet losses all reach the
+        encoder through the same s embedding, i.e. the policy and vnet encoder gradients are
+        taken before the critic step (their heads see the updated critics and alpha).
+        """
+        act_vars = self.actor.model.trainable_variables
+        cri_vars = self.qnet_0.model.trainable_variables+self.qnet_1.model.trainable_variables
+        vnet = getattr(self,"vnet",None)
+        n = tf.shape(r)[0]
+        with tf.GradientTape(persistent=True) as tape:
+            ss = tf.nest.map_structure(lambda x,x_:tf.concat([x,x_],axis=0),s,s_)
+            emb_all = self.convnet.model(self.actor.get_input(ss))
+            emb,emb_ = emb_all[:n],tf.stop_gradient(emb_all[n:])
+            a_pg,log_probs = self.actor.get_action_probs(None,emb)
+            with tape.stop_recording():
+                # Critic target from the s_ embedding
+                if self.conti:
+                    a_,logprobs_ = self.actor.get_action_probs(None,emb_)
+                    q_ = tf.minimum(self.qnet_0.forward(None,a_,target=True,emb=emb_),self.qnet_1.forward(None,a_,target=True,emb=emb_))
+                    if len(logprobs_.shape)>1:
+                        logprobs_ = tf.reduce_mean(logprobs_,axis=-1)
+                    q_target = r + self.gamma * (tf.squeeze(q_,axis=-1) - tf.exp(self.alpha_log) * logprobs_)
+                elif self.mac:
+                    q_target = r + self.gamma * tf.squeeze(vnet.forward(None,target=True,emb=emb_),axis=-1)
+                else:
+                    probs_,logprobs_ = self.actor.get_action_probs(None,emb_)
+                    q_ = tf.minimum(self.qnet_0.forward(None,target=True,emb=emb_),self.qnet_1.forward(None,target=True,emb=emb_))
+                    q_target = r + self.gamma * tf.reduce_sum((q_ - tf.exp(self.alpha_log) * logprobs_) * probs_,axis=-1)
+            q0,q1 = self.qnet_0.forward(None,a,emb=emb),self.qnet_1.forward(None,a,emb=emb)
+            if len(q0.shape) > 1:
+                q0,q1 = tf.reduce_mean(q0,axis=-1),tf.reduce_mean(q1,axis=-1)
+            value_loss = self.mse(q_target,q0) + self.mse(q_target,q1)
+            with tape.stop_recording():
+                if train:
+                    grads = self._finite_grads(tape.gradient(value_loss, cri_vars))
+                    self.cri_optimizer.apply_gradients(zip(grads, cri_vars))
+                    # Alpha
+                    probs,logps = tf.nest.map_structure(tf.stop_gradient,(a_pg,log_probs))
+                    with tf.GradientTape() as alpha_tape:
+                        alpha_tape.watch(self.alpha_log)
+                        if self.conti:
+                            alpha_loss = self.alpha_log * tf.reduce_mean(self.action_shape-logps)
+                        elif self.mac and isinstance(self.action_shape,(list,np.ndarray)):
+                            alpha_loss = self.alpha_log * tf.reduce_mean([len(self.action_shape) - tf.reduce_sum(log_prob*prob,axis=-1)
+                                                          for prob,log_prob in zip(probs,logps)],axis=0)
+                        else:
+                            alpha_loss = self.alpha_log * tf.reduce_mean(1 - tf.reduce_sum(logps*probs,axis=-1),axis=0)
+                    grads = self._finite_grads(alpha_tape.gradient(alpha_loss, [self.alpha_log]))
+                    self.alpha_optimizer.apply_gradients(zip(grads, [self.alpha_log]))
+                alpha = tf.exp(self.alpha_log)
+                if vnet is not None:
+                    vpred = vnet.forward(None,emb=tf.stop_gradient(emb))
+
+            # Actor
+            if self.conti:
+                q_pg = tf.minimum(self.qnet_0.forward(None,a_pg,emb=emb), self.qnet_1.forward(None,a_pg,emb=emb))
+                if len(log_probs.shape) > 1:
+                    log_probs = tf.reduce_mean(log_probs,axis=-1)
+                policy_loss = tf.squeeze(q_pg,axis=-1) - log_probs * alpha
+            elif self.mac:
+                q_pg = self.qnet_0.forward(None,emb=emb),self.qnet_1.forward(None,emb=emb)
+                q_pg = [tf.minimum(q0,q1) for q0,q1 in zip(q_pg[0],q_pg[1])]
+                policy_loss = tf.reduce_mean([tf.reduce_sum(pg*(qi - vpred - lp * alpha),axis=-1)
+                                                for qi,pg,lp in zip(q_pg,a_pg,log_probs)],axis=0)
+            else:
+                q_pg = tf.minimum(self.qnet_0.forward(None,emb=emb),self.qnet_1.forward(None,emb=emb))
+                policy_loss = tf.reduce_sum(a_pg*(q_pg - log_probs * alpha),axis=-1)
+            policy_loss = tf.reduce_mean(policy_loss,axis=0)
+            with tape.stop_recording():
+                if train:
+                    grads = self._finite_grads(tape.gradient(-policy_loss, act_vars))
+                    self.act_optimizer.apply_gradients(zip(grads, act_vars))
+
+            # VNet on the updated actor head
+            if vnet is not None:
+                with tape.stop_recording():
+                    emb_sg = tf.stop_gradient(emb)
+                    a_v,lp_v = self.actor.get_action_probs(None,emb_sg)
+                    if self.conti:
+                        q_v = tf.minimum(self.qnet_0.forward(None,a_v,emb=emb_sg),self.qnet_1.forward(None,a_v,emb=emb_sg))
+                        if len(lp_v.shape)>1:
+                            lp_v = tf.reduce_mean(lp_v,axis=-1)
+                        v_target = tf.squeeze(q_v,axis=-1) - alpha * lp_v
+                    else:
+                        q_v = self.qnet_0.forward(None,emb=emb_sg),self.qnet_1.forward(None,emb=emb_sg)
+                        q_v = [tf.minimum(q0,q1) for q0,q1 in zip(q_v[0],q_v[1])]
+                        v_target = tf.reduce_mean([tf.reduce_sum(pg*(qi - lp * alpha),axis=-1)
+                                                for qi,pg,lp in zip(q_v,a_v,lp_v)],axis=0)
+                vf_loss = self.mse(v_target,vnet.forward(None,emb=emb))
+                with tape.stop_recording():
+                    if train:
+                        grads = self._finite_grads(tape.gradient(vf_loss, vnet.model.trainable_variables))
+                        self.val_optimizer.apply_gradients(zip(grads, vnet.model.trainable_variables))
+        if vnet is not None:
+            return value_loss,alpha,policy_loss,vf_loss
+        else:
+            return value_loss,alpha,policy_loss
+
     def control(self,observ,train=False,batch=False):
         return self.actor.control(observ,train,batch)
-    
+
     def convert_setting_to_action(self,setting):
         return self.actor.convert_setting_to_action(setting)
 
@@ -758,14 +1095,23 @@ class AgentQMIX:
         if self.conv:
             self.convnet = ConvNet(args,self.conv)
             
-        if self.dec:
+        self.mac = getattr(args,"mac",False)
+        # Stacked: all agents' Q networks in one call (multi-agent action space only)
+        self.stacked = getattr(args,"stacked",False) and self.mac
+        if self.stacked:
+            if self.conv:
+                raise AssertionError("Stacked QMIX needs selected-state observations, got conv %s"%str(self.conv))
+            self.qnet = StackedQAgent(action_shape,observ_space if self.dec else None,args)
+            state_shape = len(getattr(args,"states")) if self.dec else len(observ_space)
+            self.space_table = tf.convert_to_tensor([list(space)+[space[-1]]*(self.qnet.n_act-len(space))
+                                                     for space in getattr(args,'action_space',{}).values()],dtype=tf.float32)
+        elif self.dec:
             self.qnet = [QAgent(action_shape[i],len(observ_space[i]),args) 
             for i in range(self.n_agents)]
             state_shape = len(getattr(args,"states"))
         else:
             state_shape = len(observ_space)
             self.qnet = QAgent(action_shape,state_shape,args,self.convnet if self.conv else None)
-        self.mac = getattr(args,"mac",False)
         self.epsilon_decay,self.epsilon_min = getattr(args,"epsilon_decay",0.9996),0.1
         self._epsilon_decay(getattr(args,"episode",0))
         self.act_only = act_only
@@ -786,6 +1132,11 @@ class AgentQMIX:
         self.reward_std = tf.constant(1.0)
 
     def control(self, observ,train=False,batch=False):
+        if self.stacked:
+            if not batch:
+                observ = observ[tf.newaxis,...]
+            settings = self._stacked_control(tf.convert_to_tensor(observ,tf.float32),tf.constant(self.epsilon if train else 0.0,tf.float32))
+            return tf.squeeze(settings)
         if train and np.random.uniform() < self.epsilon:
             action = [tf.random.uniform((1 if not batch else observ[0].shape[0] if isinstance(observ,list) else observ.shape[0],),
                                         maxval=self.action_shape[i],dtype=tf.int32)
@@ -798,7 +1149,19 @@ class AgentQMIX:
         settings = self.convert_action_to_setting(action)
         return tf.squeeze(settings)
 
+    @tf.function
+    def _stacked_control(self,observ,epsilon):
+        # Epsilon-greedy of all agents in one call: each agent explores independently
+        q = self.qnet.forward(observ)
+        greedy = tf.argmax(q,axis=-1,output_type=tf.int32)
+        logits = tf.where(self.qnet.act_mask,tf.zeros_like(q),-1e9*tf.ones_like(q))
+        rand = tf.reshape(tf.random.categorical(tf.reshape(logits,[-1,self.qnet.n_act]),1,dtype=tf.int32),tf.shape(greedy))
+        action = tf.where(tf.random.uniform(tf.shape(greedy)) < epsilon,rand,greedy)
+        return self.convert_action_to_setting(action)
+
     def convert_action_to_setting(self,action):
+        if self.stacked:
+            return tf.reduce_sum(tf.one_hot(action,self.qnet.n_act)*self.space_table,axis=-1)
         if isinstance(self.action_shape,(list,np.ndarray)):
             if self.mac:
                 return tf.stack([tf.gather(space,ai) for space,ai in zip(self.action_space,action)],axis=-1)
@@ -808,6 +1171,9 @@ class AgentQMIX:
             return tf.gather(self.action_space,action)
         
     def convert_setting_to_action(self,setting):
+        if self.stacked:
+            # Padded entries repeat the last setting, argmin keeps the first (valid) one
+            return tf.argmin(tf.abs(tf.expand_dims(tf.cast(setting,tf.float32),-1)-self.space_table),axis=-1,output_type=tf.int32)
         if isinstance(self.action_shape,(list,np.ndarray)):
             if self.mac:
                 return [tf.argmin([tf.abs(setting[...,i]-sp) for sp in space],axis=0)
@@ -828,14 +1194,18 @@ class AgentQMIX:
         variables += self.mix.model.trainable_variables
         with tf.GradientTape() as tape:
             tape.watch(variables)
-            q_values = self.qnet.forward(s)
-            if self.mac:
+            if self.stacked:
+                # (batch,n_agents) chosen Q values in one gather
+                q_tot = self.mix.forward(s,self.qnet.forward(s,a))
+            elif self.mac:
+                q_values = self.qnet.forward(s)
                 q_values = [tf.reduce_sum(q * tf.one_hot(a[idx],self.action_shape[idx]),axis=-1)
                         for idx,q in enumerate(q_values)]
                 q_values = tf.transpose(tf.convert_to_tensor(q_values))
                 q_tot = self.mix.forward(s,q_values)
                 # q_tot = tf.reduce_sum(q_values,axis=-1)
             else:
+                q_values = self.qnet.forward(s)
                 q_tot = tf.reduce_sum(q_values * tf.one_hot(a,self.action_shape),axis=-1)
             loss = self.mse(target, q_tot)
         if train:
@@ -846,7 +1216,12 @@ class AgentQMIX:
     @tf.function
     def _calculate_target(self,r,s_):
         tqs_ = self.qnet.forward(s_,target=True)
-        if self.mac:
+        if self.stacked:
+            # Masked (batch,n_agents,n_act) heads: padded actions are never the argmax
+            a_ = tf.argmax(self.qnet.forward(s_) if self.double else tqs_,axis=-1,output_type=tf.int32)
+            target_q_values = tf.gather(tqs_,a_,axis=-1,batch_dims=2)
+            target_q_tot = self.mix.forward(s_,target_q_values,target=True)
+        elif self.mac:
             if self.double:
                 qs_ = self.qnet.forward(s_)
                 target_q_values = [tf.reduce_sum(tq_*\
@@ -0,0 +1,55 @@
+import os
+os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+from mbrl import parser
+from agent import get_agent
+from envs import get_env
+import tensorflow as tf
+import numpy as np
+import time
+HERE = os.path.dirname(__file__)
+
+# Updates/s of the SAC graph agents on CPU: separate sub-updates (update_eval),
+# the fused graph, the XLA-compiled fused graph and the shared-encoder graph on the same random batch.
+
+def random_batch(ctrl,args,batch_size):
+    if ctrl.conv:
+        cn = ctrl.convnet
+        shapes = [(cn.n_node,cn.n_in)] + ([(cn.n_node,cn.b_in)] if cn.use_pred else []) + ([(cn.n_edge,cn.e_in)] if cn.use_edge else [])
+        s,s_ = [[tf.random.uniform((batch_size,)+shp) for shp in shapes] for _ in range(2)]
+    else:
+        s,s_ = [tf.random.uniform((batch_size,ctrl.actor.observ_size)) for _ in range(2)]
+    settings = tf.random.uniform((batch_size,len(args.action_space)))
+    a = ctrl.convert_setting_to_action(settings)
+    r = tf.random.normal((batch_size,))
+    return s,a,r,s_
+
+def benchmark(ctrl,batch,iters=50):
+    _ = ctrl.update_eval(*batch,train=True)
+    t0 = time.time()
+    for _ in range(iters):
+        _ = ctrl.update_eval(*batch,train=True)
+    return iters/(time.time()-t0)
+
+if __name__ == '__main__':
+    args,config = parser(os.path.join(HERE,'utils','policy.yaml'))
+    env = get_env(args.env)(initialize=False)
+    env_args = env.get_args(args.directed,args.length,args.order,act=args.act,dec=args.dec)
+    for k,v in env_args.items():
+        if k == 'act':
+            v = v and args.act
+        setattr(args,k,v)
+    args.load_agent = False
+
+    res = {}
+    for name,fused,jit,shared in [('separate',False,False,False),('fused',True,False,False),
+                                  ('fused_xla',True,True,False),('shared_encoder',True,False,True)]:
+        args.fused,args.jit_compile,args.shared_encoder = fused,jit,shared
+        ctrl = get_agent(args.agent)(args.action_shape,args.observ_space,args,act_only=False)
+        batch = random_batch(ctrl,args,args.batch_size)
+        try:
+            res[name] = benchmark(ctrl,batch)
+        except Exception as e:
+            print('%s failed: %s'%(name,str(e)))
+            continue
+        print('%s: %.1f updates/s (batch %s, conv %s)'%(name,res[name],args.batch_size,ctrl.conv))
@@ -0,0 +1,239 @@
+import os
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+from emulator import Emulator
+from dataloader import DataGenerator
+from envs import get_env
+from cem import CEM
+import tensorflow as tf
+import numpy as np
+import argparse,yaml,json,time,datetime,platform,tempfile
+from utils.dataset import load_shards
+HERE = os.path.dirname(__file__)
+
+# Throughput suite of the SWMM environments and the surrogate on each bundled network.
+# Data come from a capped run of the network's own .inp and the emulator has random weights
+# (config.yaml hyperparameters), so the numbers track speed across releases, not accuracy.
+# Metrics ending with _ms are latencies (lower is better), the others are rates (higher is better).
+
+ENVS = ['astlingen','shunqing','RedChicoSur','hague','chaohu']
+
+def parser():
+    parser = argparse.ArgumentParser(description='benchmark')
+    parser.add_argument('--envs',type=str,nargs='+',default=ENVS,help='drainage scenarios to benchmark')
+    parser.add_argument('--steps',type=int,default=600,help='number of SWMM steps to simulate')
+    parser.add_argument('--batch_sizes',type=int,nargs='+',default=[1,16,64,256],help='batch sizes of the emulator latency')
+    parser.add_argument('--batch_size',type=int,default=64,help='batch size of prepare_batch and training')
+    parser.add_argument('--iters',type=int,default=10,help='repeats per measurement')
+    parser.add_argument('--pop_size',type=int,default=64,help='population of each MPC decision')
+    parser.add_argument('--n_gen',type=int,default=5,help='generations of each MPC decision')
+    parser.add_argument('--out',type=str,default='./results/benchmark.json',help='output json file')
+    parser.add_argument('--baseline',type=str,default=None,help='baseline json file to compare with')
+    parser.add_argument('--tolerance',type=float,default=0.2,help='relative slowdown reported as regression')
+    return parser.parse_args()
+
+def timeit(func,iters=10,warmup=1):
+    for _ in range(warmup):
+        func()
+    t0 = time.perf_counter()
+    for _ in range(iters):
+        func()
+    return (time.perf_counter()-t0)/iters
+
+def get_margs(env,name,steps):
+    hyps = yaml.load(open(os.path.join(HERE,'utils','config.yaml'),'r'),yaml.FullLoader)
+    margs = argparse.Namespace(**hyps[name])
+    env_args = env.get_args(margs.directed,margs.length,margs.order)
+    for k,v in env_args.items():
+        if k == 'act':
+            v = False
+        setattr(margs,k,v)
+    margs.use_edge = margs.use_edge or margs.edge_fusion
+    # Ring buffer just above the simulated rows
+    margs.limit = int(np.ceil(np.log2(steps+1)))
+    return margs
+
+def bench_swmm(env,dG,steps):
+    # Same readouts as DataGenerator.simulate, capped at steps
+    res = {}
+    env.reset(env.config['swmm_input'],global_state=True)
+    states,perfs,rains,edge_states = [],[],[],[]
+    t_step = t_read = 0.0
+    done,i = False,0
+    while not done and i < steps:
+        t0 = time.perf_counter()
+        done = env.step()
+        t1 = time.perf_counter()
+        states.append(env.state_full())
+        perfs.append(env.flood())
+        rains.append(env.rainfall())
+        if dG.use_edge:
+            edge_states.append(env.state_full(typ='links'))
+        t_read += time.perf_counter()-t1
+        t_step += t1-t0
+        i += 1
+    res['swmm_step_ms'] = 1e3*t_step/i
+    res['swmm_readout_ms'] = 1e3*t_read/i
+    res['datagen_rows_per_s'] = i/(t_step+t_read)
+    trajs = [np.array(states),np.array(perfs),None,np.array(rains)]
+    trajs += [np.array(edge_states)] if dG.use_edge else []
+    trajs += [np.zeros(i)]
+    dG.update(trajs)
+    return res
+
+def bench_data(dG,seq,batch_size,iters):
+    res = {}
+    idxs = dG.get_data_idxs(None,seq)
+    batch_size = min(batch_size,idxs.shape[0])
+    res['prepare_batch_per_s'] = 1/timeit(lambda:dG.prepare_batch(idxs,seq,batch_size,trim=False),iters)
+    res['prepare_batch_rows_per_s'] = res['prepare_batch_per_s']*batch_size
+    return res
+
+def dir_size(path):
+    return sum(os.path.getsize(os.path.join(path,f)) for f in os.listdir(path))
+
+def bench_dataset(dG,iters):
+    # Monolithic npy files against the compressed shards (utils.dataset) of the same rows
+    res = {}
+    items = ['states','perfs','settings','rains'] + (['edge_states'] if dG.use_edge else []) + ['event_id']
+    with tempfile.TemporaryDirectory() as npy_dir,tempfile.TemporaryDirectory() as npz_dir:
+        dG.save(npy_dir,compress=False)
+        dG.save(npz_dir,compress=True)
+        mb = sum(dG.get_item(item).astype(np.float32).nbytes for item in items if dG.get_item(item) is not None)/2**20
+        res['dataset_compression_ratio'] = dir_size(npy_dir)/dir_size(npz_dir)
+        read_npy = lambda:[np.load(os.path.join(npy_dir,f)).astype(np.float32) for f in os.listdir(npy_dir)]
+        res['npy_read_mb_per_s'] = mb/timeit(read_npy,iters)
+        res['npz_read_mb_per_s'] = mb/timeit(lambda:load_shards(npz_dir,items),iters)
+        event = dG.get_item('event_id')[-1]
+        res['npz_event_read_ms'] = 1e3*timeit(lambda:load_shards(npz_dir,items,[event]),iters)
+    return res
+
+def get_batch(dG,emul,seq,batch_size,trim=True):
+    idxs = dG.get_data_idxs(None,seq)
+    dats = dG.prepare_batch(idxs,seq,min(batch_size,idxs.shape[0]),trim=trim)
+    x,a,b,y = dats[:4]
+    ex,ey = dats[-2:] if emul.use_edge else (None,None)
+    return x,a,b,y,ex,ey
+
+def bench_emulator(dG,emul,margs,args):
+    res = {}
+    seq = max(margs.seq_in,margs.seq_out) if margs.recurrent else 0
+    x,a,b,y,ex,ey = get_batch(dG,emul,seq,args.batch_size,trim=False)
+    if emul.norm:
+        x,b,y = [emul.normalize(dat,item) for dat,item in zip([x,b,y],'xby')]
+        ex,ey = [emul.normalize(dat,'e') for dat in [ex,ey]] if emul.use_edge else (None,None)
+    res['train_steps_per_s'] = 1/timeit(lambda:emul.fit_eval(x,a,b,y,ex,ey),args.iters)
+    n_rows = dG.get_data_idxs(None,seq).shape[0]
+    for bs in args.batch_sizes:
+        if bs > n_rows:
+            continue
+        x,a,b,y,ex,ey = get_batch(dG,emul,seq,bs)
+        res['predict_b%s_ms'%bs] = 1e3*timeit(lambda:emul.predict(x,b,a,ex),args.iters)
+        x_tf,b_tf = tf.convert_to_tensor(x),tf.convert_to_tensor(b)
+        ex_tf = tf.convert_to_tensor(ex) if ex is not None else None
+        res['predict_tf_b%s_ms'%bs] = 1e3*timeit(lambda:emul.predict_tf(x_tf,b_tf,a,ex_tf),args.iters)
+    if margs.recurrent:
+        # Event-wise autoregressive simulation as in main.py --test
+        states,perfs = [dG.expand_seq(dG.get_item(item),seq) for item in ['states','perfs']]
+        edge_states = dG.expand_seq(dG.get_item('edge_states'),seq) if emul.use_edge else None
+        states[...,1] = states[...,1] - states[...,-1]
+        r = states[margs.seq_out:,...,-1:]
+        if margs.tide:
+            r = np.concatenate([r,np.expand_dims(states[margs.seq_out:,...,0] * margs.is_outfall,axis=-1)],axis=-1)
+        if margs.if_flood:
+            states = np.concatenate([states[...,:-1],(perfs>0).astype(float),states[...,-1:]],axis=-1)
+        states = states[:-margs.seq_out]
+        if emul.use_edge:
+            edge_states = edge_states[:-margs.seq_out][:,-margs.seq_in:,...]
+        res['simulate_ms_per_step'] = 1e3*timeit(lambda:emul.simulate(states,r,None,edge_states),1,0)/states.shape[0]
+    return res
+
+def bench_mpc(env,dG,margs,args):
+    # One decision: n_gen CEM generations, each scoring the population of candidate settings in one
+    # predict_tf call of a random-weight emulator with action inputs, then objective_pred_tf.
+    # Scenarios without controllable assets (or a recurrent surrogate) have no decision to time.
+    act_edges = getattr(margs,'act_edges',None)
+    if not margs.recurrent or act_edges is None or len(act_edges) == 0:
+        return {}
+    amargs = argparse.Namespace(**vars(margs))
+    amargs.act,amargs.norm = 'conti',False
+    emul = Emulator(amargs.conv,amargs.resnet,amargs.recurrent,amargs)
+    seq = max(margs.seq_in,margs.seq_out)
+    x,a,b,y,ex,ey = get_batch(dG,emul,seq,1)
+    xs,bs = [tf.repeat(tf.convert_to_tensor(dat,dtype=tf.float32),args.pop_size,axis=0) for dat in [x,b]]
+    exs = tf.repeat(tf.convert_to_tensor(ex,dtype=tf.float32),args.pop_size,axis=0) if ex is not None else None
+    n_act = len(act_edges)
+    cem = CEM(np.zeros(n_act*margs.seq_out),np.ones(n_act*margs.seq_out),args.pop_size)
+    def decide():
+        cem.initialize()
+        for _ in range(args.n_gen):
+            cand = cem.sample()
+            settings = tf.reshape(tf.convert_to_tensor(cand,dtype=tf.float32),(-1,margs.seq_out,n_act))
+            preds = emul.predict_tf(xs,bs,settings,exs)
+            f = env.objective_pred_tf(preds if emul.use_edge else [preds,None],[xs,exs],settings)
+            f = tf.reduce_sum(f,axis=-1) if len(f.shape) > 1 else f
+            cem.update(cand,f.numpy())
+        return cem.x_best
+    sec = timeit(decide,args.iters)
+    return {'mpc_decisions_per_s':1/sec,'mpc_candidates_per_s':args.pop_size*args.n_gen/sec}
+
+def run(name,args):
+    res = {}
+    env = get_env(name)()
+    margs = get_margs(env,name,args.steps)
+    dG = DataGenerator(env.config,args=margs,ring=True)
+    res.update(bench_swmm(env,dG,args.steps))
+    seq = max(margs.seq_in,margs.seq_out) if margs.recurrent else 0
+    res.update(bench_data(dG,seq,args.batch_size,args.iters))
+    res.update(bench_dataset(dG,args.iters))
+    emul = Emulator(margs.conv,margs.resnet,margs.recurrent,margs)
+    if margs.norm:
+        emul.set_norm(*dG.get_norm())
+    res.update(bench_emulator(dG,emul,margs,args))
+    res.update(bench_mpc(env,dG,margs,args))
+    return res
+
+def compare(res,baseline,tolerance=0.2):
+    """
+    Relative change of each metric against the baseline, positive is faster.
+
+    Returns the changes and the metrics slower than the tolerance.
+    """
+    changes,regress = {},[]
+    for name,metrics in res['results'].items():
+        base = baseline.get('results',{}).get(name,{})
+        for k,v in metrics.items():
+            if k not in base or not isinstance(v,(int,float)) or not isinstance(base[k],(int,float)) or base[k] == 0:
+                continue
+            change = base[k]/v-1 if k.endswith('_ms') or '_ms_' in k else v/base[k]-1
+            changes['%s/%s'%(name,k)] = change
+            if change < -tolerance:
+                regress.append('%s/%s'%(name,k))
+    return changes,regress
+
+if __name__ == '__main__':
+    args = parser()
+    res = {'meta':{'time':datetime.datetime.now().isoformat(),'platform':platform.platform(),
+                   'python':platform.python_version(),'tensorflow':tf.__version__,'numpy':np.__version__,
+                   'args':vars(args)},
+           'results':{}}
+    for name in args.envs:
+        print('Benchmark %s'%name)
+        try:
+            res['results'][name] = run(name,args)
+        except Exception as e:
+            print('%s failed: %s'%(name,str(e)))
+            res['results'][name] = {'error':str(e)}
+            continue
+        for k,v in res['results'][name].items():
+            print('  %s: %.3f'%(k,v))
+    if os.path.dirname(args.out) and not os.path.exists(os.path.dirname(args.out)):
+        os.makedirs(os.path.dirname(args.out))
+    json.dump(res,open(args.out,'w'),indent=2)
+    print('Saved %s'%args.out)
+
+    if args.baseline is not None:
+        changes,regress = compare(res,json.load(open(args.baseline,'r')),args.tolerance)
+        for k,v in changes.items():
+            print('%s: %+.1f%%%s'%(k,100*v,' REGRESSION' if k in regress else ''))
+        if len(regress) > 0:
+            raise SystemExit('%s metrics slower than %.0f%% of the baseline'%(len(regress),100*args.tolerance))
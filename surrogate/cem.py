@@ -0,0 +1,106 @@
+import numpy as np
+from scipy.stats import truncnorm
+import argparse,time
+
+class CEM:
+    """
+    Cross-entropy method over box-bounded continuous or integer (action table) variables.
+
+    Parameters
+    ----------
+    xl, xu : np.ndarray
+        lower and upper bounds of each variable. For discrete variables xu is the largest index.
+    pop_size : int
+        number of candidates per generation.
+    elite : float
+        kept fraction of the population (plus archive) to refit the distribution.
+    alpha : float
+        smoothing rate: new = alpha * old + (1-alpha) * elite statistics.
+    archive : int
+        number of best candidates carried across generations.
+    discrete : bool
+        sample integer indexes from categorical logits instead of truncated normal.
+    """
+    def __init__(self,xl,xu,pop_size,elite=0.1,alpha=0.1,archive=0,discrete=False,min_std=1e-3):
+        self.xl,self.xu = np.asarray(xl,dtype=float),np.asarray(xu,dtype=float)
+        self.n_var = self.xl.shape[0]
+        self.pop_size = pop_size
+        self.n_elite = max(int(round(pop_size*elite)),1)
+        self.alpha = alpha
+        self.archive = archive
+        self.discrete = discrete
+        self.min_std = min_std
+        self.initialize()
+
+    def initialize(self,x0=None):
+        if self.discrete:
+            self.levels = self.xu.astype(int)+1
+            self.mask = np.arange(self.levels.max())[None,:] < self.levels[:,None]
+            self.probs = self.mask/self.mask.sum(axis=-1,keepdims=True)
+        else:
+            self.mu = (self.xl+self.xu)/2 if x0 is None else np.clip(np.asarray(x0,dtype=float),self.xl,self.xu)
+            self.std = np.maximum((self.xu-self.xl)/2,self.min_std)
+        self.x_arch,self.f_arch = np.zeros((0,self.n_var)),np.zeros((0,))
+        self.x_best,self.f_best = None,np.inf
+
+    def sample(self,n=None):
+        n = self.pop_size if n is None else n
+        if self.discrete:
+            # Gumbel-max trick: one argmax over all candidates and variables
+            logits = np.where(self.mask,np.log(np.maximum(self.probs,1e-12)),-np.inf)
+            g = -np.log(-np.log(np.random.uniform(1e-12,1.0,size=(n,)+logits.shape)))
+            return (logits+g).argmax(axis=-1)
+        else:
+            a,b = (self.xl-self.mu)/self.std,(self.xu-self.mu)/self.std
+            return truncnorm.rvs(a,b,loc=self.mu,scale=self.std,size=(n,self.n_var))
+
+    def update(self,x,f):
+        x,f = np.asarray(x),np.asarray(f).reshape(-1)
+        if f.min() < self.f_best:
+            self.x_best,self.f_best = x[f.argmin()].copy(),f.min()
+        x,f = np.concatenate([self.x_arch,x],axis=0),np.concatenate([self.f_arch,f],axis=0)
+        order = np.argsort(f)
+        elites = x[order[:self.n_elite]]
+        if self.archive > 0:
+            self.x_arch,self.f_arch = x[order[:self.archive]],f[order[:self.archive]]
+        if self.discrete:
+            freq = (elites.astype(int)[...,None] == np.arange(self.mask.shape[-1])).mean(axis=0)
+            self.probs = self.alpha*self.probs + (1-self.alpha)*freq*self.mask
+        else:
+            self.mu = self.alpha*self.mu + (1-self.alpha)*elites.mean(axis=0)
+            self.std = np.maximum(self.alpha*self.std + (1-self.alpha)*elites.std(axis=0),self.min_std)
+        return f[order[self.n_elite-1]]
+
+def benchmark(n_var=48,pop_size=256,levels=8,iters=50):
+    xl,xu = np.zeros(n_var),np.ones(n_var)
+    res = {}
+    for discrete in [False,True]:
+        cem = CEM(xl,xu*(levels-1 if discrete else 1),pop_size,discrete=discrete)
+        t0 = time.time()
+        for _ in range(iters):
+            x = cem.sample()
+            cem.update(x,(x**2).sum(axis=-1))
+        res['cem_%s'%('disc' if discrete else 'conti')] = pop_size*iters/(time.time()-t0)
+    # Reference: per-candidate sampling as in the former run_ce
+    mu,sig = np.full(n_var,0.5),np.full(n_var,0.5)
+    t0 = time.time()
+    for _ in range(iters):
+        x = np.array([truncnorm.rvs((xl-mu)/sig,(xu-mu)/sig)*sig+mu for _ in range(pop_size)])
+    res['loop_conti'] = pop_size*iters/(time.time()-t0)
+    pr = [np.ones(levels)/levels for _ in range(n_var)]
+    t0 = time.time()
+    for _ in range(iters):
+        x = np.array([np.random.choice(np.arange(levels),p=pri,size=pop_size) for pri in pr]).T
+    res['loop_disc'] = pop_size*iters/(time.time()-t0)
+    for k,v in res.items():
+        print('%s: %.1f candidates/s'%(k,v))
+    return res
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='cem benchmark')
+    parser.add_argument('--n_var',type=int,default=48,help='number of decision variables')
+    parser.add_argument('--pop_size',type=int,default=256,help='number of population')
+    parser.add_argument('--levels',type=int,default=8,help='number of discrete levels')
+    parser.add_argument('--iters',type=int,default=50,help='number of generations')
+    args = parser.parse_args()
+    benchmark(args.n_var,args.pop_size,args.levels,args.iters)
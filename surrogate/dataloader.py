@@ -4,9 +4,20 @@ import os
 from swmm_api import swmm5_run,read_inp_file
 from datetime import timedelta
 from envs import get_env
+from utils.profiler import profiler,timed
+from utils.dataset import save_shards,load_shards,is_sharded,clear_shards
+
+# One scenario per worker process, reused by all of its events
+_WORKER = {}
+
+def _init_worker(env_name):
+    _WORKER['env'] = get_env(env_name)(initialize=False)
+
+def _simulate(dG,event,seq,act):
+    return dG.simulate(_WORKER['env'],event,seq,act)
 
 class DataGenerator:
-    def __init__(self,env_config,data_dir=None,args=None):
+    def __init__(self,env_config,data_dir=None,args=None,ring=False):
         self.config = env_config
         self.data_dir = data_dir if data_dir is not None else './envs/data/{}/'.format(self.config['env_name'])
         self.pre_step = args.rainfall.get('pre_time',0) // self.config['interval']
@@ -24,7 +35,13 @@ class DataGenerator:
             # self.adj = env.get_adj()
             # self.act_edges = env.get_edge_list(list(self.action_space.keys()))
         self.limit = 2**getattr(args,"limit",22)
+        # Sharded compressed dataset (utils.dataset) instead of the npy files
+        self.compress = getattr(args,"compress",False)
+        self.shard_rows = getattr(args,"shard_rows",2**16)
         self.cur_capa = 0
+        # Ring buffer: preallocated arrays of limit rows written in place by update
+        self.ring = ring
+        self.ptr,self.n_seg = 0,0
 
     def simulate(self, env, event, seq = False, act = False, hotstart = False):
         state = env.reset(event,global_state=True,seq=seq)
@@ -46,33 +63,38 @@ class DataGenerator:
                 inp.write_file(eval_file)
                 _ = swmm5_run(eval_file)
             setting = env.controller(act,state,setting) if act and i % (self.setting_duration//self.config['interval']) == 0 else setting
-            done = env.step(setting)
-            state = env.state_full(seq=seq)
-            rain = env.rainfall(seq=seq)
-            perf = env.flood(seq=seq)
+            with profiler.timer('swmm_step'):
+                done = env.step(setting)
+            with profiler.timer('state_readout'):
+                state = env.state_full(seq=seq)
+                rain = env.rainfall(seq=seq)
+                perf = env.flood(seq=seq)
+                if self.use_edge:
+                    edge_state = env.state_full(seq,'links')
             states.append(state)
             perfs.append(perf)
             settings.append(setting)
             rains.append(rain)
             if self.use_edge:
-                edge_state = env.state_full(seq,'links')
                 edge_states.append(edge_state)
             i += 1
+        profiler.count('swmm_steps',i)
         if self.use_edge:
             return np.array(states),np.array(perfs),np.array(settings) if act else None,np.array(rains),np.array(edge_states)
         else:
             return np.array(states),np.array(perfs),np.array(settings) if act else None,np.array(rains)
         
     def generate(self,events,processes=1,repeats=1,seq=False,act=False):
-        env = get_env(self.config['env_name'])(initialize=False)
+        # events are inp files or forcing dicts (utils.utilities.get_inp_files with in_memory)
         if processes > 1:
-            pool = mp.Pool(processes)
-            res = [pool.apply_async(func=self.simulate,args=(env,event,seq,act,))
+            pool = mp.Pool(processes,initializer=_init_worker,initargs=(self.config['env_name'],))
+            res = [pool.apply_async(func=_simulate,args=(self,event,seq,act,))
                     for _ in range(repeats) for event in events]
             pool.close()
             pool.join()
             res = [r.get() for r in res]
         else:
+            env = get_env(self.config['env_name'])(initialize=False)
             res = [self.simulate(env,event,seq,act)
                     for _ in range(repeats) for event in events]
         self.states,self.perfs = [np.concatenate([r[i][self.pre_step:] for r in res],axis=0) for i in range(2)]
@@ -82,20 +104,51 @@ class DataGenerator:
             self.edge_states = np.concatenate([r[-1][self.pre_step:] for r in res],axis=0) if self.use_edge else None
         self.event_id = np.concatenate([np.repeat(i,res[idx][0][self.pre_step:].shape[0])
                                          for idx,i in enumerate([i for _ in range(repeats) for i,_ in enumerate(events)])],axis=0)
+        self.index_segments()
 
     def expand_seq(self,dats,seq,zeros=True):
         dats = np.stack([np.concatenate([np.tile(np.zeros_like(s) if zeros else np.ones_like(s),(max(seq-idx,0),)+tuple(1 for _ in s.shape)),dats[max(idx-seq,0):idx]],axis=0) for idx,s in enumerate(dats)])
         return dats
 
+    def index_segments(self):
+        # Contiguous event runs as (event, start, end) offsets, rebuilt when the data change
+        if self.ring:
+            ev,seg = self.event_id[:self.cur_capa],self.seg_id[:self.cur_capa]
+            brk = (np.diff(ev) != 0) | (np.diff(seg) != 0)
+        else:
+            ev = np.asarray(self.event_id)
+            brk = np.diff(ev) != 0
+        starts = np.concatenate([[0],np.where(brk)[0]+1]).astype(np.int64)[:ev.shape[0]]
+        ends = np.concatenate([starts[1:],[ev.shape[0]]]).astype(np.int64)[:starts.shape[0]]
+        self.segments = (ev[starts].astype(np.int64),starts,ends)
+        self.idx_cache = {}
+
     def get_data_idxs(self,event=None,seq=0,seq_out=None):
         event = np.arange(int(max(self.event_id))+1) if event is None else event
-        event_idxs = [np.argwhere(self.event_id == idx).flatten() for idx in event]
-        event_idxs = [np.split(data, np.where(np.diff(data) != 1)[0]+1) for data in event_idxs]
         seq_out = seq_out if seq_out is not None else seq
-        event_idxs = np.concatenate([np.concatenate([dat[seq:-seq_out] for dat in data],axis=0) for data in event_idxs],axis=0)
+        key = (tuple(np.asarray(event).astype(int).tolist()),seq,seq_out)
+        if key in getattr(self,'idx_cache',{}):
+            return self.idx_cache[key]
+        if getattr(self,'segments',None) is None:
+            self.index_segments()
+        seg_ev,starts,ends = self.segments
+        event = np.asarray(event).astype(np.int64)
+        # Runs of the selected events, ordered by event then position
+        lookup = np.full(max(seg_ev.max(initial=0),event.max(initial=0))+1,-1)
+        lookup[event[::-1]] = np.arange(event.shape[0])[::-1]
+        rank = lookup[seg_ev]
+        order = np.argsort(rank,kind='stable')
+        order = order[rank[order] >= 0]
+        # Same rows as run[seq:-seq_out]
+        lo = starts[order] + seq
+        hi = ends[order] - seq_out if seq_out > 0 else lo
+        lens = np.maximum(hi-lo,0)
+        offsets = np.concatenate([[0],np.cumsum(lens)[:-1]])
+        event_idxs = np.repeat(lo-offsets,lens) + np.arange(lens.sum())
+        self.idx_cache[key] = event_idxs
         return event_idxs
-        
 
+    @timed('batch_assembly')
     def prepare_batch(self,event_idxs,seq=0,batch_size=32,interval=1,trim=True,return_idx=False):
         if interval > 1:
             idxs = event_idxs[interval*np.random.choice(event_idxs.shape[0]//interval,batch_size,replace=False)]
@@ -161,6 +214,9 @@ class DataGenerator:
     def update(self,trajs,test_id=None):
         items = ['states','perfs','settings','rains']
         items += ['edge_states','event_id'] if self.use_edge else ['event_id']
+        if self.ring:
+            self.ring_update(dict(zip(items,trajs)))
+            return
         for traj,item in zip(trajs,items):
             if not hasattr(self,item):
                 setattr(self,item,np.zeros((0,)+traj.shape[1:],np.float32))
@@ -170,35 +226,100 @@ class DataGenerator:
                 setattr(self,item,np.concatenate([np.take(getattr(self,item),train_idxs,axis=0),np.take(getattr(self,item),test_idxs,axis=0),traj],axis=0)[-self.limit:])
             else:
                 setattr(self,item,np.concatenate([getattr(self,item),traj],axis=0)[-self.limit:])
+        self.index_segments()
 
-    def save(self,data_dir=None):
+    def ring_update(self,trajs):
+        trajs = {item:traj[-self.limit:] if traj is not None else None for item,traj in trajs.items()}
+        n = trajs['event_id'].shape[0]
+        for item,traj in trajs.items():
+            if traj is None:
+                setattr(self,item,None)
+            elif getattr(self,item,None) is None:
+                setattr(self,item,np.zeros((self.limit,)+traj.shape[1:],np.float32))
+        if getattr(self,'seg_id',None) is None:
+            self.seg_id = np.zeros((self.limit,),np.int64)
+        # O(n) in-place write, each event run of this write gets a new segment id
+        pos = (self.ptr + np.arange(n)) % self.limit
+        for item,traj in trajs.items():
+            if traj is not None:
+                getattr(self,item)[pos] = traj
+        seg = self.n_seg + np.concatenate([[0],np.cumsum(np.diff(trajs['event_id']) != 0)])
+        self.seg_id[pos] = seg
+        self.n_seg = seg[-1] + 1
+        self.ptr = (self.ptr + n) % self.limit
+        self.cur_capa = min(self.cur_capa + n,self.limit)
+        self.index_segments()
+
+    def get_item(self,item):
+        # Stored rows in chronological order
+        dat = getattr(self,item)
+        if not self.ring or dat is None:
+            return dat
+        if self.cur_capa < self.limit:
+            return dat[:self.cur_capa]
+        return np.concatenate([dat[self.ptr:],dat[:self.ptr]],axis=0)
+
+    @timed('checkpoint_io')
+    def save(self,data_dir=None,compress=None):
         data_dir = data_dir if data_dir is not None else self.data_dir
+        compress = self.compress if compress is None else compress
         if not os.path.exists(data_dir):
             os.mkdir(data_dir)
-        np.save(os.path.join(data_dir,'states.npy'),self.states)
-        np.save(os.path.join(data_dir,'perfs.npy'),self.perfs)
+        items = ['states','perfs','settings','rains'] + (['edge_states'] if self.use_edge else [])
+        if compress:
+            save_shards(data_dir,{item:self.get_item(item) for item in items},self.get_item('event_id'),self.shard_rows)
+            # drop the npy files of an earlier save
+            for item in items + ['event_id']:
+                if os.path.isfile(os.path.join(data_dir,item+'.npy')):
+                    os.remove(os.path.join(data_dir,item+'.npy'))
+            return
+        clear_shards(data_dir)
+        np.save(os.path.join(data_dir,'states.npy'),self.get_item('states'))
+        np.save(os.path.join(data_dir,'perfs.npy'),self.get_item('perfs'))
         if self.use_edge:
-            np.save(os.path.join(data_dir,'edge_states.npy'),self.edge_states)
+            np.save(os.path.join(data_dir,'edge_states.npy'),self.get_item('edge_states'))
         if self.settings is not None:
-            np.save(os.path.join(data_dir,'settings.npy'),self.settings)
-        np.save(os.path.join(data_dir,'rains.npy'),self.rains)
-        np.save(os.path.join(data_dir,'event_id.npy'),self.event_id)
+            np.save(os.path.join(data_dir,'settings.npy'),self.get_item('settings'))
+        elif os.path.isfile(os.path.join(data_dir,'settings.npy')):
+            os.remove(os.path.join(data_dir,'settings.npy'))
+        np.save(os.path.join(data_dir,'rains.npy'),self.get_item('rains'))
+        np.save(os.path.join(data_dir,'event_id.npy'),self.get_item('event_id'))
 
 
-    def load(self,data_dir=None):
+    @timed('checkpoint_io')
+    def load(self,data_dir=None,events=None):
+        # events: ids to keep, None loads all
         data_dir = data_dir if data_dir is not None else self.data_dir
-        for name in ['states','perfs','settings','rains','event_id']:
-            if os.path.isfile(os.path.join(data_dir,name+'.npy')):
-                dat = np.load(os.path.join(data_dir,name+'.npy'),mmap_mode='r').astype(np.float32)
-            else:
-                dat = None
-            setattr(self,name,dat)
-        if self.use_edge:
-            self.edge_states = np.load(os.path.join(data_dir,'edge_states.npy'),mmap_mode='r').astype(np.float32)
+        items = ['states','perfs','settings','rains'] + (['edge_states'] if self.use_edge else []) + ['event_id']
+        if is_sharded(data_dir):
+            dats = load_shards(data_dir,items,events)
+            for name in items:
+                setattr(self,name,dats[name].astype(np.float32) if dats[name] is not None else None)
+        else:
+            rows = None
+            if events is not None:
+                rows = np.isin(np.load(os.path.join(data_dir,'event_id.npy'),mmap_mode='r'),np.asarray(events))
+            for name in items:
+                if os.path.isfile(os.path.join(data_dir,name+'.npy')):
+                    dat = np.load(os.path.join(data_dir,name+'.npy'),mmap_mode='r')
+                    dat = (dat if rows is None else dat[rows]).astype(np.float32)
+                else:
+                    dat = None
+                setattr(self,name,dat)
+        if self.ring:
+            items = ['states','perfs','settings','rains'] + (['edge_states'] if self.use_edge else []) + ['event_id']
+            trajs = {item:getattr(self,item) for item in items}
+            for item in items:
+                setattr(self,item,None)
+            self.ptr,self.n_seg,self.cur_capa,self.seg_id = 0,0,0,None
+            self.ring_update(trajs)
+        else:
+            self.index_segments()
         self.get_norm()
 
     def get_norm(self):
-        norm = np.concatenate([self.states,self.perfs],axis=-1)
+        states,perfs,rains = [self.get_item(item) for item in ['states','perfs','rains']]
+        norm = np.concatenate([states,perfs],axis=-1)
         norm[...,1] = norm[...,1] - norm[...,3]
         while len(norm.shape) > 2:
             norm = norm.max(axis=0)
@@ -218,7 +339,7 @@ class DataGenerator:
         norm_x = norm_x.astype(np.float32)
         norm_y = norm_y.astype(np.float32)
         if self.config['global_state'][0][-1] == 'head':
-            norm_hmin = np.tile(np.float32(self.states[...,0].min()),(norm.shape[0],1))
+            norm_hmin = np.tile(np.float32(states[...,0].min()),(norm.shape[0],1))
             if self.config['tide']:
                 norm_b = np.stack([norm_b,np.concatenate([np.zeros_like(norm_b[...,:1],dtype=np.float32),norm_hmin],axis=-1)])
             else:
@@ -229,11 +350,11 @@ class DataGenerator:
             norm_b = np.stack([norm_b,np.zeros_like(norm_b,dtype=np.float32)])
             norm_x = np.stack([norm_x,np.zeros_like(norm_x,dtype=np.float32)])
             norm_y = np.stack([norm_y,np.zeros_like(norm_y,dtype=np.float32)])
-        norm_r = self.rains.max(axis=0).astype(np.float32)
+        norm_r = rains.max(axis=0).astype(np.float32)
         norm_r = np.stack([norm_r,np.zeros_like(norm_r,dtype=np.float32)])
 
         if self.use_edge:
-            norm_e = np.abs(self.edge_states.copy())
+            norm_e = np.abs(self.get_item('edge_states'))
             while len(norm_e.shape) > 2:
                 norm_e = norm_e.max(axis=0)
             norm_e = np.concatenate([norm_e[:,:-1]+1e-6,norm_e[:,-1:]],axis=-1) if self.act else norm_e+1e-6
@@ -11,6 +11,7 @@ import os
 # from line_profiler import LineProfiler
 from spektral.layers import GCNConv,GATConv,ECCConv,GeneralConv,DiffusionConv
 import tensorflow as tf
+from utils.profiler import profiler,timed
 tf.config.list_physical_devices(device_type='GPU')
 # os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
 # os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
@@ -595,7 +596,8 @@ class Emulator:
                 inp += [expand_dims(self.normalize(ex,'e') if self.norm else ex,0)]
                 inp += [self.edge_filter] if self.conv else []
                 inp += [ae[idx:idx+1]] if self.act else []
-            y = self.model(inp,training=False) if self.dropout else self.model(inp)
+            with profiler.timer('model_forward'):
+                y = self.model(inp,training=False) if self.dropout else self.model(inp)
 
             if self.use_edge:
                 y,ey = y
@@ -679,7 +681,8 @@ class Emulator:
             inp += [self.normalize(ex,'e') if self.norm else ex]
             inp += [self.edge_filter] if self.conv else []
             inp += [ae] if self.act else []
-        y = self.model(inp,training=False) if self.dropout else self.model(inp)
+        with profiler.timer('model_forward'):
+            y = self.model(inp,training=False) if self.dropout else self.model(inp)
         if self.use_edge:
             y,ey = y
             ey = ey.numpy()
@@ -805,6 +808,7 @@ class Emulator:
         y = tf.concat([y,tf.expand_dims(q_w,axis=-1)],axis=-1)
         return y,ey if self.use_edge else y
         
+    @timed('constrain')
     def constrain(self,y,r,h0=None):
         h,q_us,q_ds = [y[...,i] for i in range(3)]
         r = np.squeeze(r,axis=-1)
@@ -892,6 +896,7 @@ class Emulator:
 
 
 
+    @timed('checkpoint_io')
     def save(self,model_dir=None):
         model_dir = model_dir if model_dir is not None else self.model_dir
         if not os.path.exists(model_dir):
@@ -907,6 +912,7 @@ class Emulator:
                 if hasattr(self,'norm_%s'%item):
                     np.save(os.path.join(model_dir,'norm_%s.npy'%item),getattr(self,'norm_%s'%item))
 
+    @timed('checkpoint_io')
     def load(self,model_dir=None):
         model_dir = model_dir if model_dir is not None else self.model_dir
         if model_dir.endswith('.h5'):
@@ -0,0 +1,151 @@
+import numpy as np
+import multiprocessing as mp
+import os
+os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
+import tensorflow as tf
+from envs import get_env
+from utils.observ import ObsSpec
+from utils.runoff import RunoffCache,TimeIndex
+
+# Persistent SWMM workers for closed-loop sampling with a central (batched) policy.
+# Each worker keeps one live scenario and only exchanges raw observations and settings,
+# so the agent weights never leave the main process. Runoff windows are read from the
+# runoff cache (a local mmap) in each worker, only the event path goes through the pipe.
+
+class EnvWorker:
+    def __init__(self,args,cache_dir=None):
+        self.args = args
+        self.seq = args.setting_duration
+        self.horizon = args.setting_duration//args.interval
+        self.env = get_env(args.env)(initialize=False)
+        cache_dir = os.path.join('./envs/data/',args.env,'runoff') if cache_dir is None else cache_dir
+        self.cache = RunoffCache(cache_dir,args.interval,tide=args.tide)
+
+    def reset(self,event):
+        ts,self.runoff = self.cache.get(self.env,event,self.horizon)
+        self.tss = TimeIndex(ts)
+        self.env.reset(event,global_state=True)
+        env = self.env
+        self.state = env.state_full(seq=self.seq)
+        if self.args.if_flood:
+            self.flood = env.flood(seq=self.seq)
+        self.edge_state = env.state_full(self.seq,'links')
+        self.states = [self.state[-1]]
+        self.perfs,self.objects = [env.flood()],[env.objective()]
+        self.edge_states = [self.edge_state[-1]]
+        self.settings = [env.controller('default')]
+        self.rains = [env.rainfall()]
+        self.i = 0
+        return self.observe()
+
+    def observe(self):
+        state = self.state
+        state[...,1] = state[...,1] - state[...,-1]
+        if self.args.if_flood:
+            f = (self.flood>0).astype(float)
+            state = np.concatenate([state[...,:-1],f,state[...,-1:]],axis=-1)
+        self.state = state
+        t = self.env.env.methods['simulation_time']()
+        b = self.runoff[self.tss.asof(t)][:self.seq]
+        return state,b,self.edge_state,self.env.rainfall(seq=self.seq)
+
+    def step(self,setting):
+        env,args = self.env,self.args
+        setting = env.controller('safe',self.state[-1],setting)
+        done = False
+        while not done:
+            done = env.step([float(sett) for sett in setting.tolist()])
+            self.state = env.state_full(seq=self.seq)
+            if args.if_flood:
+                self.flood = env.flood(seq=self.seq)
+            self.edge_state = env.state_full(self.seq,'links')
+            self.states.append(self.state[-1])
+            self.perfs.append(env.flood())
+            self.objects.append(env.objective())
+            self.edge_states.append(self.edge_state[-1])
+            self.settings.append(setting)
+            self.rains.append(env.rainfall())
+            self.i += 1
+            if self.i*args.interval % args.control_interval == 0:
+                break
+        return done,None if done else self.observe()
+
+    def collect(self):
+        self.env.initialize_logger()
+        return [np.array(dat) for dat in [self.states,self.perfs,self.settings,self.rains,self.edge_states,self.rains,self.objects]]
+
+def env_worker(conn,args,cache_dir=None):
+    worker = EnvWorker(args,cache_dir)
+    while True:
+        cmd,dat = conn.recv()
+        if cmd == 'close':
+            break
+        conn.send(getattr(worker,cmd)(*dat))
+    conn.close()
+
+def get_observ(ctrl,obs_spec,args,obs):
+    # Batched version of the observation in mbrl.interact_steps
+    state,b,edge_state,rain = [np.stack([ob[i] for ob in obs]) for i in range(4)]
+    x_norm,b_norm,e_norm = [ctrl.normalize(dat,item) if dat is not None else None
+                            for dat,item in zip([state,b,edge_state if args.use_edge else None],'xbe')]
+    r_norm = ctrl.normalize(rain,'r') if not ctrl.conv else None
+    return obs_spec(x_norm,b_norm,e_norm,r_norm,batch=True)
+
+class VecEnv:
+    def __init__(self,args,processes=1,cache_dir=None):
+        self.args = args
+        ctx = mp.get_context("spawn")
+        self.conns,self.procs = [],[]
+        for _ in range(processes):
+            parent,child = ctx.Pipe()
+            proc = ctx.Process(target=env_worker,args=(child,args,cache_dir),daemon=True)
+            proc.start()
+            child.close()
+            self.conns.append(parent)
+            self.procs.append(proc)
+
+    def run(self,ctrl,events,train=False):
+        """
+        Run the events closed-loop with one batched policy call per control step.
+
+        Returns the trajectories in the order of events, same as mbrl.interact_steps.
+        """
+        res = [None for _ in events]
+        obs_spec = ObsSpec(self.args,ctrl.conv)
+        todo = list(range(len(events)))[::-1]
+        slots,obs = {},{}
+        # Fill the workers, then refill each one when its event is done
+        for w,conn in enumerate(self.conns):
+            if len(todo) == 0:
+                break
+            k = todo.pop()
+            conn.send(('reset',(events[k],)))
+            slots[w] = k
+        for w in slots:
+            obs[w] = self.conns[w].recv()
+        while len(slots) > 0:
+            ws = sorted(slots)
+            observ = get_observ(ctrl,obs_spec,self.args,[obs[w] for w in ws])
+            settings = np.reshape(ctrl.control(observ,train,batch=True).numpy(),(len(ws),-1))
+            for w,setting in zip(ws,settings):
+                self.conns[w].send(('step',(setting,)))
+            for w in ws:
+                done,ob = self.conns[w].recv()
+                if not done:
+                    obs[w] = ob
+                    continue
+                self.conns[w].send(('collect',()))
+                res[slots.pop(w)] = self.conns[w].recv()
+                if len(todo) > 0:
+                    k = todo.pop()
+                    self.conns[w].send(('reset',(events[k],)))
+                    obs[w] = self.conns[w].recv()
+                    slots[w] = k
+        return res
+
+    def close(self):
+        for conn in self.conns:
+            conn.send(('close',()))
+            conn.close()
+        for proc in self.procs:
+            proc.join()
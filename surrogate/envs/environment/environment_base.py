@@ -22,6 +22,8 @@ class env_base(environment):
     _isFinished
     _log
     ini_log
+    fast_stride: if the 1s-routing stride uses swmm_stride when no attribute is averaged (config key, default False, opt-in as it may change the routing results)
+    set_forcing: in-memory event, gage rainfall and node inflows set at each step on the base network
 
     
     Attributes
@@ -50,6 +52,9 @@ class env_base(environment):
         super().__init__(config, ctrl, binary)
         self._isFinished = False
         self._advance_seconds = None
+        self.fast_stride = config.get('fast_stride',False)
+        self.forcing = None
+        self.log_objs = None
         self.log = self.ini_log(self.sim._model.curSimTime)
         self.sec_per_day = 3600.0 * 24.0
         self.flow_unit = self.sim._model.getSimUnit(tkai.SimulationUnits.FlowUnits.value)  # unit must be LPS or CMS
@@ -114,6 +119,8 @@ class env_base(environment):
                 )
         
         self._advance_seconds = advance_seconds
+        if self.forcing is not None:
+            self._apply_forcing()
         # take the step !
         # add the swmm_stride option for a longer control step
         if self._advance_seconds is None:
@@ -130,16 +137,21 @@ class env_base(environment):
                 # Try swmm_stride(routestep), works similar
                 ctime = self.sim._model.curSimTime
                 self.log = self.ini_log(ctime)
-                advanceDays = self._advance_seconds / self.sec_per_day
-                eps = advanceDays * 0.00001
-                elapsed_time = 0
-                while self.sim._model.curSimTime <= ctime + advanceDays - eps:
-                    elapsed_time = self.sim._model.swmm_step()
-                    # elapsed_time = self.sim._model.swmm_stride(routing_step)
+                if self.fast_stride and len(self.log_objs) == 0:
+                    # nothing averaged within the stride: no need to visit each routing step
+                    elapsed_time = self.sim._model.swmm_stride(self._advance_seconds)
                     self._log(elapsed_time)
-                    if elapsed_time == 0:
-                        break
-                    self.sim._model.curSimTime = elapsed_time
+                else:
+                    advanceDays = self._advance_seconds / self.sec_per_day
+                    eps = advanceDays * 0.00001
+                    elapsed_time = 0
+                    while self.sim._model.curSimTime <= ctime + advanceDays - eps:
+                        elapsed_time = self.sim._model.swmm_step()
+                        # elapsed_time = self.sim._model.swmm_stride(routing_step)
+                        self._log(elapsed_time)
+                        if elapsed_time == 0:
+                            break
+                        self.sim._model.curSimTime = elapsed_time
             
         done = False if elapsed_time > 0 else True
         return done
@@ -168,6 +180,8 @@ class env_base(environment):
         # Start the next simulation
         self.sim._model = PySWMM(self.config["swmm_input"])
         self.sim._model.swmm_open()
+        if self.forcing is not None:
+            self._set_times(self.forcing['start'],self.forcing['end'])
         self.sim._model.swmm_start()
 
         # get the state
@@ -176,34 +190,91 @@ class env_base(environment):
         self.log = self.ini_log(self.sim._model.curSimTime)
         return state
 
-    def ini_log(self,etime):
-        log = {'elapsed_time':[etime]}
+    def set_forcing(self,forcing=None,step=None):
+        r"""
+        Drive the next runs from in-memory series instead of the inp timeseries.
+        Takes effect at the next reset, None goes back to the inp.
+
+        Parameters
+        ----------
+        forcing : dict
+            start, end : datetime of the simulation
+            interval : seconds of each value
+            rain : {gage: intensity array} set by setGagePrecip
+            inflow : {node: flow array} set by setNodeInflow
+        step : int, optional
+            control step (s): finer series are averaged over it (volume-preserving),
+            as a value is held for the whole stride.
+        """
+        if forcing is not None and step is not None and forcing['interval'] < step:
+            k = int(step // forcing['interval'])
+            forcing = dict(forcing,interval=forcing['interval']*k)
+            for key in ['rain','inflow']:
+                if key in forcing:
+                    forcing[key] = {ID:np.pad(np.asarray(vals,dtype=float),(0,-len(vals)%k)).reshape(-1,k).mean(axis=1)
+                                    for ID,vals in forcing[key].items()}
+        self.forcing = forcing
+
+    def _apply_forcing(self):
+        idx = int((self.sim._model.getCurrentSimulationTime()-self.forcing['start']).total_seconds()//self.forcing['interval'])
+        for ID,vals in self.forcing.get('rain',{}).items():
+            self._setGagePrecip(ID,float(vals[idx]) if 0 <= idx < len(vals) else 0.0)
+        for ID,vals in self.forcing.get('inflow',{}).items():
+            self._setNodeInflow(ID,float(vals[idx]) if 0 <= idx < len(vals) else 0.0)
+
+    def _set_times(self,start,end):
+        # Only between swmm_open and swmm_start
+        self.sim._model.setSimulationDateTime(tkai.SimulationTime.EndDateTime,end)
+        self.sim._model.setSimulationDateTime(tkai.SimulationTime.StartDateTime,start)
+        self.sim._model.setSimulationDateTime(tkai.SimulationTime.ReportStartDateTime,start)
+
+    def get_log_objs(self):
+        # Objects of the attributes averaged or accumulated within a stride ('_' in the name)
+        log_objs = {}
         for col in ['states','global_state','performance_targets','flood']:
             for item in self.config.get(col,[]):
                 obj,attr = item[0],item[1]
-                if '_' in attr and attr not in log:
-                    log[attr] = {}
+                if '_' in attr and attr not in log_objs:
                     if obj == 'nodes':
                         objs = self._getNodeIdList()
                     elif obj == 'links':
                         objs = self._getLinkIdList()
                     else:
                         objs = [obj]
-                    for obj in objs:
-                        log[attr][obj] = []
+                    log_objs[attr] = (objs,{obj:i for i,obj in enumerate(objs)})
+        return log_objs
+
+    def ini_log(self,etime):
+        # Running sums over the stride per attribute, all objects at once:
+        # readouts for '_avg' (averaged by n_log) and time-weighted volumes for '_vol'
+        if self.log_objs is None:
+            self.log_objs = self.get_log_objs()
+        log = getattr(self,'log',None)
+        if log is None:
+            log = {attr:np.zeros(len(objs)) for attr,(objs,_) in self.log_objs.items()}
+        else:
+            for attr in self.log_objs:
+                log[attr].fill(0)
+        log['elapsed_time'] = etime
+        self.n_log = 0
         return log
     
     def _log(self,etime):
-        self.log['elapsed_time'].append(etime)
-        for attr in self.log.keys():
-            if attr == 'elapsed_time':
-                continue
-            for obj in self.log[attr].keys():
-                self.log[attr][obj].append(self.methods[attr.split('_')[0]](obj))
-    
-    def _get_step_value(self,attr,ID):
-        return [max(t,0)*v*self.sec_per_day
-                 for t,v in zip(np.diff(self.log['elapsed_time']),self.log[attr][ID])]
+        log = self.log
+        dt = max(etime-log['elapsed_time'],0)*self.sec_per_day
+        log['elapsed_time'] = etime
+        for attr,(objs,_) in self.log_objs.items():
+            read = self.methods[attr.split('_')[0]]
+            vals = np.fromiter((read(obj) for obj in objs),dtype=float,count=len(objs))
+            log[attr] += vals*dt if attr.endswith('_vol') else vals
+        self.n_log += 1
+
+    def _get_avg(self,attr,ID):
+        return self.log[attr][self.log_objs[attr][1][ID]]/self.n_log
+
+    def _get_vol(self,attr,ID):
+        vol = self.log[attr][self.log_objs[attr][1][ID]]
+        return vol/1e3 if self.flow_unit == 'LPS' else vol
 
     # ------ Get necessary Params  ----------------------------------------------
     def _getNodeinvertElev(self,ID):
@@ -224,15 +295,13 @@ class env_base(environment):
         return self.sim._model.getObjectIDList(tkai.ObjectType.LINK.value)
 
     def _getNodeAvgDepth(self,ID):
-        dat = self.log['depthN_avg'][ID]
-        return np.mean(dat) if len(dat) > 0 else self.methods['depthN'](ID)
+        return self._get_avg('depthN_avg',ID) if self.n_log > 0 else self.methods['depthN'](ID)
 
     def _getNodeHead(self,ID):
         return self.sim._model.getNodeResult(ID,tkai.NodeResults.newHead.value)
 
     def _getNodeAvgHead(self,ID):
-        dat = self.log['head_avg'][ID]
-        return np.mean(dat) if len(dat) > 0 else self.methods['head'](ID)
+        return self._get_avg('head_avg',ID) if self.n_log > 0 else self.methods['head'](ID)
     
     def _getFlooding(self,ID):
         # Flooding rate
@@ -264,10 +333,7 @@ class env_base(environment):
         return self.sim._model.getNodeResult(ID,tkai.NodeResults.outflow.value)
         
     def _getNodeCumOutflow(self,ID):
-        if self.flow_unit == 'LPS':
-            return sum(self._get_step_value('totaloutflow_vol',ID))/1e3
-        else:
-            return sum(self._get_step_value('totaloutflow_vol',ID))
+        return self._get_vol('totaloutflow_vol',ID)
     
     def _getNodeLateralInflow(self,ID):
         # Lateral inflow rate
@@ -279,22 +345,17 @@ class env_base(environment):
         return self.sim._model.node_statistics(ID)['lateral_infow_vol']
 
     def _getLinkAvgDepth(self,ID):
-        dat = self.log['depthL_avg'][ID]
-        return np.mean(dat) if len(dat) > 0 else self.methods['depthL'](ID)
+        return self._get_avg('depthL_avg',ID) if self.n_log > 0 else self.methods['depthL'](ID)
     
     def _getLinkAvgVolume(self,ID):
-        dat = self.log['volumeL_avg'][ID]
-        return np.mean(dat) if len(dat) > 0 else self.methods['volumeL'](ID)
+        return self._get_avg('volumeL_avg',ID) if self.n_log > 0 else self.methods['volumeL'](ID)
 
     def _getLinkFlow(self,ID):
         # return self.sim._model.getLinkResult(ID,tkai.LinkResults.newFlow.value) * self.config['interval'] * 60
         return self.sim._model.getLinkResult(ID,tkai.LinkResults.newFlow.value)
     
     def _getLinkCumFlow(self,ID):
-        if self.flow_unit == 'LPS':
-            return sum(self._get_step_value('flow_vol',ID))/1e3
-        else:
-            return sum(self._get_step_value('flow_vol',ID))
+        return self._get_vol('flow_vol',ID)
 
     def _getSystemRainfall(self,ID):
         return self.sim._model.runoff_routing_stats()['rainfall']
@@ -408,4 +469,8 @@ class env_base(environment):
     def _setNodeInflow(self,ID,flow_rate):
         # Set lateral inflow rate
         return self.sim._model.setNodeInflow(ID,flow_rate)
+
+    def _setGagePrecip(self,ID,intensity):
+        # Set gage rainfall intensity, overrides its timeseries
+        return self.sim._model.setGagePrecip(ID,intensity)
                 
\ No newline at end of file
@@ -40,57 +40,55 @@ class astlingen(basescenario):
             if config_file is None else config_file
         super().__init__(config_file,swmm_file,global_state,initialize)
         
+    def compile_objective(self):
+        spec = super().compile_objective()
+        ids,attrs,w = spec['ids'],spec['attrs'],spec['weight']
+        wwtp = np.array(['WWTP' in idx for idx in ids])
+        # control roughness of the inflow to the tanks, flow to the WWTP and CSO volumes
+        spec['diff'] = (attrs == 'cuminflow') & ~wwtp
+        groups = {'flood':attrs == 'cumflooding',
+                  'outflow':(attrs == 'cuminflow') & wwtp,
+                  'inflow':spec['diff']}
+        for k,mask in groups.items():
+            spec[k+'_w'] = w[mask]
+            if self.global_state:
+                spec[k+'_idx'] = self.get_index([idx for idx,m in zip(ids,mask) if m])
+        return spec
+
     def objective(self, seq = False):
-        # __object = np.zeros(seq) if seq else 0.0
-        __object = []
+        spec = self.get_obj_spec()
         perfs = self.performance(seq = max(seq,1) + 1 if seq else 2)
-        for i,(idx,attr,weight) in enumerate(self.config['performance_targets']):
-            if attr == 'cuminflow' and idx != 'Out_to_WWTP':
-                # __object += np.abs(np.diff(perfs[:,i],axis=0)) * weight
-                __object += [np.abs(np.diff(perfs[:,i],axis=0)).squeeze() * weight]
-            else:
-                # __object += perfs[1:,i] * weight
-                __object += [perfs[1:,i].squeeze() * weight]
-        # return __object
-        return np.array(__object).sum(axis=-1) if seq else np.array(__object)
+        __object = np.where(spec['diff'],np.abs(np.diff(perfs,axis=0)),perfs[1:]) * spec['weight']
+        __object = __object.T if __object.shape[0] > 1 else __object[0]
+        return __object.sum(axis=-1) if seq else __object
          
     def objective_pred(self,preds,states,settings,gamma=None,norm=False):
+        spec = self.get_obj_spec()
         preds,_ = preds
         state,_ = states
         q_w = preds[...,-1]
         q_in = np.concatenate([state[:,-1:,:,1],preds[...,1]],axis=1)
-        flood = [q_w[...,self.elements['nodes'].index(idx)] * weight
-                for idx,attr,weight in self.config['performance_targets'] if attr == 'cumflooding']
-        inflow = [np.abs(np.diff(q_in[...,self.elements['nodes'].index(idx)],axis=1)) * weight
-                for idx,attr,weight in self.config['performance_targets']
-                    if attr == 'cuminflow' and 'WWTP' not in idx]
-        outflow = [q_in[:,1:,self.elements['nodes'].index(idx)] * weight
-                for idx,attr,weight in self.config['performance_targets']
-                    if attr == 'cuminflow' and 'WWTP' in idx]
-        obj = np.stack(flood + outflow + inflow,axis=1)
+        obj = np.concatenate([q_w[...,spec['flood_idx']] * spec['flood_w'],
+                              q_in[:,1:,spec['outflow_idx']] * spec['outflow_w'],
+                              np.abs(np.diff(q_in[...,spec['inflow_idx']],axis=1)) * spec['inflow_w']],axis=-1)
         gamma = np.ones(preds.shape[1]) if gamma is None else np.array(gamma,dtype=np.float32)
-        obj *= gamma
+        obj = (obj * np.expand_dims(gamma,axis=-1)).sum(axis=1)
         if norm:
-            obj /= (state[...,-1].sum(axis=-1).sum(axis=-1)+1e-5)
-        return obj.sum(axis=-1)
+            obj /= np.expand_dims(state[...,-1].sum(axis=-1).sum(axis=-1)+1e-5,axis=-1)
+        return obj
     
     def objective_pred_tf(self,preds,states,settings,gamma=None,norm=False):
         import tensorflow as tf
+        spec = self.get_obj_spec()
         preds,_ = preds
         state,_ = states
         q_w = preds[...,-1]
         q_in = tf.concat([state[:,-1:,:,1],preds[...,1]],axis=1)
-        flood = [q_w[...,self.elements['nodes'].index(idx)] * weight
-                for idx,attr,weight in self.config['performance_targets'] if attr == 'cumflooding']
-        inflow = [tf.abs(tf.experimental.numpy.diff(q_in[...,self.elements['nodes'].index(idx)],axis=1)) * weight
-                for idx,attr,weight in self.config['performance_targets']
-                    if attr == 'cuminflow' and 'WWTP' not in idx]
-        outflow = [q_in[:,1:,self.elements['nodes'].index(idx)] * weight
-                for idx,attr,weight in self.config['performance_targets']
-                    if attr == 'cuminflow' and 'WWTP' in idx]
-        obj = tf.reduce_sum(flood,axis=0) + tf.reduce_sum(inflow,axis=0) + tf.reduce_sum(outflow,axis=0)
+        obj = tf.concat([tf.gather(q_w,spec['flood_idx'],axis=-1) * spec['flood_w'],
+                         tf.gather(q_in[:,1:],spec['outflow_idx'],axis=-1) * spec['outflow_w'],
+                         tf.abs(tf.experimental.numpy.diff(tf.gather(q_in,spec['inflow_idx'],axis=-1),axis=1)) * spec['inflow_w']],axis=-1)
         gamma = tf.ones((preds.shape[1],)) if gamma is None else tf.convert_to_tensor(gamma,dtype=tf.float32)
-        obj = tf.reduce_sum(obj*gamma,axis=-1)
+        obj = tf.reduce_sum(tf.reduce_sum(obj,axis=-1)*gamma,axis=-1)
         if norm:
             obj /= (tf.reduce_sum(tf.reduce_sum(state[...,-1],axis=-1),axis=-1)+1e-5)
         return obj
@@ -40,14 +40,15 @@ class basescenario(scenario):
         # Network configuration
 
         self.config = yaml.load(open(config_file, "r"), yaml.FullLoader)
-        self.config["swmm_input"] = os.path.join(os.path.dirname(HERE),"network",self.config["env_name"],self.config["env_name"] +'.inp') \
-            if swmm_file is None else swmm_file
+        self.base_input = os.path.join(os.path.dirname(HERE),"network",self.config["env_name"],self.config["env_name"] +'.inp')
+        self.config["swmm_input"] = self.base_input if swmm_file is None else swmm_file
         
         # Create the environment based on the physical parameters
         if initialize:
             self.env = env_base(self.config, ctrl=True)
         
         self.global_state = global_state # If use global state as input
+        self.obj_spec = None
 
         # initialize logger
         self.initialize_logger()
@@ -65,26 +66,14 @@ class basescenario(scenario):
         if log:
             self._logger()
 
-        # Log the performance
-        __performance = []
-        for typ, attribute, _ in self.config["performance_targets"]:
-            if typ in ['nodes','links','subcatchments']:
-                features = self.elements[typ]
-                __volume = [self.env.methods[attribute](ID) for ID in features]
-                if 'cum' in attribute:
-                    __lastvolume = [self.data_log[attribute][ID][-2] if len(self.data_log[attribute][ID])>1 else 0 for ID in features]
-                    __perf = np.array(__volume) - np.array(__lastvolume)
-                else:
-                    __perf = np.array(__volume)
-            else:
-                __volume = self.env.methods[attribute](typ)
-                if 'cum' in attribute:
-                    __lastvolume = self.data_log[attribute][typ][-2] if len(self.data_log[attribute][typ])>1 else 0
-                    __perf = __volume - __lastvolume
-                else:
-                    __perf = __volume
-            __performance.append(__perf)
-        __performance = np.array(__performance).T if typ in ['nodes','links','subcatchments'] else np.array(__performance)
+        # Log the performance: cumulative targets are differenced with the volumes of the last step
+        __volume = [np.array([self.env.methods[attribute](ID) for ID in self.elements[typ]])
+                    if typ in ['nodes','links','subcatchments'] else self.env.methods[attribute](typ)
+                    for typ, attribute, _ in self.config["performance_targets"]]
+        __volume = np.array(__volume)
+        __performance = __volume - self.last_volume * self.perf_cum
+        self.last_volume = __volume
+        __performance = __performance.T if self.perf_cum.ndim > 1 else __performance
 
         # Record the _performance
         self.data_log["performance_measure"].append(__performance)
@@ -207,16 +196,29 @@ class basescenario(scenario):
 
     def reset(self,swmm_file=None, global_state=True,seq=False):
         # clear the data log and reset the environment
+        # swmm_file may be a forcing dict (see env_base.set_forcing): the event is injected into the base network
+        forcing = None
+        if isinstance(swmm_file,dict):
+            forcing = swmm_file
+            swmm_file = forcing.get('swmm_input',self.base_input)
+            if swmm_file == self.config["swmm_input"] and getattr(self,'env',None) is not None:
+                swmm_file = None
         if swmm_file is not None:
             self.config["swmm_input"] = swmm_file
-        if getattr(self,'env',None) is None:
-            self.env = env_base(self.config, ctrl=True)
-        elif swmm_file is not None:
-            self.env.terminate()
+        if getattr(self,'env',None) is None or swmm_file is not None:
+            if getattr(self,'env',None) is not None:
+                self.env.terminate()
             self.env = env_base(self.config, ctrl=True)
+            if forcing is not None:
+                self.env.set_forcing(forcing,self.config.get('interval',0)*60 or None)
+                _ = self.env.reset()
         else:
+            self.env.set_forcing(forcing,self.config.get('interval',0)*60 or None)
             _ = self.env.reset()
 
+        if global_state != self.global_state:
+            # the compiled objective depends on the state layout (*_idx keys)
+            self.obj_spec = None
         self.global_state = global_state
         self.initialize_logger()
         if self.global_state:
@@ -246,6 +248,12 @@ class basescenario(scenario):
                 self.data_log[attribute] = {}
             self.data_log[attribute][ID] = [] if maxlen is None else deque(maxlen=maxlen)
 
+        # Volumes of the performance targets in the last step
+        self.perf_cum = np.array([float('cum' in attribute) for _,attribute,_ in config["performance_targets"]])
+        if any(typ in ['nodes','links','subcatchments'] for typ,_,_ in config["performance_targets"]):
+            self.perf_cum = np.expand_dims(self.perf_cum,axis=-1)
+        self.last_volume = 0.0
+
         # Data logger for storing _performance & _state data
         for ID, attribute, _ in config["performance_targets"]:
             if attribute not in self.data_log.keys():
@@ -275,6 +283,25 @@ class basescenario(scenario):
     def _logger(self):
         super()._logger()
 
+    def get_obj_spec(self):
+        # Objective spec shared by objective, objective_pred and objective_pred_tf, compiled once
+        if self.obj_spec is None:
+            self.obj_spec = self.compile_objective()
+        return self.obj_spec
+
+    def compile_objective(self):
+        # Weights and attribute masks of the performance targets, extended by each scenario
+        targets = self.config['performance_targets']
+        spec = {'ids':[idx for idx,_,_ in targets],
+                'attrs':np.array([attr for _,attr,_ in targets])}
+        spec['weight'] = np.array([w if not isinstance(w,str) else 0 for _,_,w in targets],dtype=np.float32)
+        return spec
+
+    def get_index(self,ids,typ='nodes'):
+        # Positions of the elements in the state arrays
+        index = {ID:i for i,ID in enumerate(self.elements[typ])}
+        return np.array([index[ID] for ID in ids],dtype=np.int32)
+
 
     def get_args(self,directed=False,length=0,order=1,act=False):
         args = self.config.copy()
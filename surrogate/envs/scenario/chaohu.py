@@ -52,97 +52,69 @@ class chaohu(basescenario):
                               for node in getattr(inp,sec,dict()).values()])
         self.pumps = {k:(inp.PUMPS[k].FromNode,inp.PUMPS[k].ToNode) for k in self.config['action_space']}
         
+    def compile_objective(self):
+        spec = super().compile_objective()
+        ids,attrs,w = spec['ids'],spec['attrs'],spec['weight']
+        spec['penal'] = (attrs == 'cumflooding') & np.array([idx.endswith('storage') for idx in ids])
+        spec['setting'] = attrs == 'setting'
+        if not self.global_state:
+            return spec
+        groups = {'penal':attrs == 'cumflooding',
+                  'outflow':(attrs == 'cuminflow') & (w > 0),
+                  'wwtp':(attrs == 'cuminflow') & (w < 0)}
+        for k,mask in groups.items():
+            spec[k+'_w'] = w[mask]
+            spec[k+'_idx'] = self.get_index([idx for idx,m in zip(ids,mask) if m])
+        # Energy consumption (kWh): refer from swmm engine link_getPower in link.c
+        pumps = [idx for idx,attr in zip(ids,attrs) if attr == 'cumpumpenergy']
+        spec['energy_w'] = (w[attrs == 'cumpumpenergy'] / ft_m / cfs_cms / 8.814 * KWperHP/3600.0).astype(np.float32)
+        spec['pump_us'] = self.get_index([self.pumps[idx][0] for idx in pumps])
+        spec['pump_ds'] = self.get_index([self.pumps[idx][1] for idx in pumps])
+        spec['pump_idx'] = self.get_index(pumps,'links')
+        if self.config['global_state'][0][-1] == 'head':
+            spec['pump_dh'] = np.zeros(len(pumps),dtype=np.float32)
+        else:
+            spec['pump_dh'] = (self.hmin[spec['pump_us']] - self.hmin[spec['pump_ds']]).astype(np.float32)
+        return spec
+
     # TODO
     def objective(self, seq = False):
-        # __object = np.zeros(seq) if seq else 0.0
-        # __object += self.flood(seq).squeeze().sum(axis=-1)
-        __object = []
-        __object += [self.flood(seq).squeeze().sum(axis=-1)]
+        spec = self.get_obj_spec()
+        flood = self.flood(seq).squeeze().sum(axis=-1)
         perfs = self.performance(seq = max(seq,1) + 1 if seq else 2)
-        # _is_raining = False
-        for i,(ID,attr,target) in enumerate(self.config['performance_targets']):
-            # __value = perfs[:,i] if seq else perfs[i]
-            __value = perfs[:,i] if attr == 'setting' else perfs[1:,i]
-            # if attr == 'rainfall':
-            #     _is_raining = sum(self.data_log[attr][ID][target:])>0
-            # if attr == 'depthN':
-            #     __object -= __value/self.hmax[i] * target if _is_raining else (1-__value/self.hmax[i]) * target
-            if attr == 'cumflooding' and ID.endswith('storage'):
-                # __object += (__value>0) * target
-                __object += [(__value>0).squeeze() * target]
-            elif attr == 'setting':
-                __object += [np.abs(np.diff(__value,axis=0)).squeeze() * target]
-            else:
-                # __object += __value * target
-                __object += [__value.squeeze() * target]
-        # return __object
-        return np.array(__object).sum(axis=-1) if seq else np.array(__object)
-     
+        __value = np.where(spec['penal'],perfs[1:]>0,perfs[1:])
+        __value = np.where(spec['setting'],np.abs(np.diff(perfs,axis=0)),__value) * spec['weight']
+        __object = np.concatenate([np.reshape(flood,(1,-1)),__value.T],axis=0)
+        __object = __object if __object.shape[1] > 1 else __object[:,0]
+        return __object.sum(axis=-1) if seq else __object
      
     def objective_pred(self,preds,states,settings,gamma=None):
+        spec = self.get_obj_spec()
         preds,edge_preds = preds
         h,q_in,q_w,q = preds[...,0],preds[...,1],preds[...,-1],edge_preds[...,-1]
-        flood = q_w.sum(axis=-1)
-        nodes,links = self.elements['nodes'],self.elements['links']
-        targets = self.config['performance_targets']
-        penal = [(q_w[...,nodes.index(idx)]>0) * weight
-                for idx,attr,weight in targets if attr == 'cumflooding']
-        outflow = [q_in[...,nodes.index(idx)] * weight
-                for idx,attr,weight in targets if attr == 'cuminflow' and weight>0]
-        wwtp = [q_in[...,nodes.index(idx)] * weight
-                for idx,attr,weight in targets if attr == 'cuminflow' and weight<0]
-        # Energy consumption (kWh): refer from swmm engine link_getPower in link.c
-        if self.config['global_state'][0][-1] == 'head':
-            energy = [(np.abs(h[...,nodes.index(self.pumps[idx][0])]-h[...,nodes.index(self.pumps[idx][1])])/ft_m * np.abs(q[...,links.index(idx)])/cfs_cms)/ 8.814 * KWperHP/3600.0 * weight
-                for idx,attr,weight in targets if attr == 'cumpumpenergy']
-        else:
-            energy = [(np.abs(self.hmin[nodes.index(self.pumps[idx][0])]+h[...,nodes.index(self.pumps[idx][0])]-self.hmin[nodes.index(self.pumps[idx][1])]-h[...,nodes.index(self.pumps[idx][1])])/ft_m * np.abs(q[...,links.index(idx)])/cfs_cms)/ 8.814 * KWperHP/3600.0 * weight
-                for idx,attr,weight in targets if attr == 'cumpumpenergy']
-        # Control Roughness
-        # asp = list(self.config['action_space'])
-        # _,edge_state = states
-        # sett = np.concatenate([edge_state[:,-1:,[links.index(idx) for idx,attr,_  in targets if attr == 'setting'],-1],
-        #                        settings[...,[asp.index(idx) for idx,attr,_  in targets if attr == 'setting']]],axis=1)
-        # rough = [np.abs(np.diff(sett[...,i],axis=1)*gamma).sum(axis=1) * weight
-        #          for i,weight in enumerate([weight for _,attr,weight in targets if attr == 'setting'])]
-        obj = np.stack([flood] + penal + outflow + wwtp + energy,axis=1)
+        energy = np.abs(h[...,spec['pump_us']]-h[...,spec['pump_ds']]+spec['pump_dh']) * np.abs(q[...,spec['pump_idx']]) * spec['energy_w']
+        obj = np.concatenate([q_w.sum(axis=-1,keepdims=True),
+                              (q_w[...,spec['penal_idx']]>0) * spec['penal_w'],
+                              q_in[...,spec['outflow_idx']] * spec['outflow_w'],
+                              q_in[...,spec['wwtp_idx']] * spec['wwtp_w'],
+                              energy],axis=-1)
         gamma = np.ones(preds.shape[1]) if gamma is None else np.array(gamma,dtype=np.float32)
-        obj *= gamma
-        # if norm:
-        #     obj /= state[...,-1].sum(axis=-1)
-        return obj.sum(axis=-1)
-        # return np.array([flood] + penal + outflow + wwtp + energy + rough).T
+        return (obj * np.expand_dims(gamma,axis=-1)).sum(axis=1)
     
     def objective_pred_tf(self,preds,states,settings,gamma=None):
         import tensorflow as tf
+        spec = self.get_obj_spec()
         preds,edge_preds = preds
         h,q_in,q_w,q = preds[...,0],preds[...,1],preds[...,-1],edge_preds[...,-1]
+        energy = tf.abs(tf.gather(h,spec['pump_us'],axis=-1)-tf.gather(h,spec['pump_ds'],axis=-1)+spec['pump_dh'])
+        energy *= tf.abs(tf.gather(q,spec['pump_idx'],axis=-1)) * spec['energy_w']
+        obj = tf.concat([tf.reduce_sum(q_w,axis=-1,keepdims=True),
+                         tf.cast(tf.gather(q_w,spec['penal_idx'],axis=-1)>0,tf.float32) * spec['penal_w'],
+                         tf.gather(q_in,spec['outflow_idx'],axis=-1) * spec['outflow_w'],
+                         tf.gather(q_in,spec['wwtp_idx'],axis=-1) * spec['wwtp_w'],
+                         energy],axis=-1)
         gamma = tf.ones((preds.shape[1],)) if gamma is None else tf.convert_to_tensor(gamma,dtype=tf.float32)
-        flood = tf.reduce_sum(tf.reduce_sum(q_w,axis=-1)*gamma,axis=1)
-        nodes,links = self.elements['nodes'],self.elements['links']
-        targets = self.config['performance_targets']
-        penal = [tf.reduce_sum(tf.cast(q_w[...,nodes.index(idx)]>0,tf.float32)*gamma,axis=1) * weight
-                for idx,attr,weight in targets if attr == 'cumflooding']
-        outflow = [tf.reduce_sum(q_in[...,nodes.index(idx)]*gamma,axis=1) * weight
-                   for idx,attr,weight in targets if attr == 'cuminflow' and weight>0]
-        wwtp = [tf.reduce_sum(q_in[...,nodes.index(idx)]*gamma,axis=1) * weight
-                for idx,attr,weight in targets if attr == 'cuminflow' and weight>0]
-        # Energy consumption (kWh): refer from swmm engine link_getPower in link.c
-        if self.config['global_state'][0][-1] == 'head':
-            energy = [tf.reduce_sum((tf.abs(h[...,nodes.index(self.pumps[idx][0])]-h[...,nodes.index(self.pumps[idx][1])])/ft_m * tf.abs(q[...,links.index(idx)])/cfs_cms)*gamma,axis=1)/ 8.814 * KWperHP/3600.0 * weight
-                for idx,attr,weight in targets if attr == 'cumpumpenergy']
-        else:
-            energy = [tf.reduce_sum((tf.abs(self.hmin[nodes.index(self.pumps[idx][0])]+h[...,nodes.index(self.pumps[idx][0])]-self.hmin[nodes.index(self.pumps[idx][1])]-h[...,nodes.index(self.pumps[idx][1])])/ft_m * tf.abs(q[...,links.index(idx)])/cfs_cms)*gamma,axis=1)/ 8.814 * KWperHP/3600.0 * weight
-                for idx,attr,weight in targets if attr == 'cumpumpenergy']
-        # Control Roughness
-        # asp = list(self.config['action_space'])
-        # _,edge_state = states
-        # sett = tf.concat([edge_state[:,-1:,[links.index(idx) for idx,attr,_  in targets if attr == 'setting'],-1],
-        #                   settings[...,[asp.index(idx) for idx,attr,_  in targets if attr == 'setting']]],axis=1)
-        # rough = [tf.reduce_sum(tf.abs(tf.experimental.numpy.diff(sett[...,i],axis=1))*gamma,axis=1) * weight
-        #          for i,weight in enumerate([weight for _,attr,weight in targets if attr == 'setting'])]
-        return flood + tf.reduce_sum(penal,axis=0) + tf.reduce_sum(outflow,axis=0) + tf.reduce_sum(wwtp,axis=0) + tf.reduce_sum(energy,axis=0)
-        # return flood + tf.reduce_sum(penal,axis=0) + tf.reduce_sum(outflow,axis=0) + tf.reduce_sum(wwtp,axis=0) + tf.reduce_sum(energy,axis=0) + tf.reduce_sum(rough,axis=0)
+        return tf.reduce_sum(tf.reduce_sum(obj,axis=-1)*gamma,axis=1)
 
     def get_action_table(self,act='rand'):
         asp = self.config['action_space'].copy()
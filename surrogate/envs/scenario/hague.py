@@ -41,53 +41,52 @@ class hague(basescenario):
         super().__init__(config_file,swmm_file,global_state,initialize)
 
         
+    def compile_objective(self):
+        spec = super().compile_objective()
+        ids,attrs = spec['ids'],spec['attrs']
+        targets = self.config['performance_targets']
+        # depth targets as 'threshold,weight' penalize exceedance, numeric ones the distance to the target
+        spec['exced'] = np.array([attr == 'depthN' and isinstance(t,str) for _,attr,t in targets])
+        spec['depth'] = np.array([attr == 'depthN' and not isinstance(t,str) for _,attr,t in targets])
+        spec['thres'] = np.array([eval(t.split(',')[0]) if isinstance(t,str) else t for _,_,t in targets],dtype=np.float32)
+        spec['weight'] = np.array([eval(t.split(',')[1]) if isinstance(t,str) else 1 if attr == 'depthN' else t
+                                   for _,attr,t in targets],dtype=np.float32)
+        if self.global_state:
+            for k,mask in {'flood':attrs == 'cumflooding','depth':spec['depth'],'exced':spec['exced']}.items():
+                spec[k+'_idx'] = self.get_index([idx for idx,m in zip(ids,mask) if m])
+                spec[k+'_w'],spec[k+'_thres'] = spec['weight'][mask],spec['thres'][mask]
+        return spec
+
     # TODO
     def objective(self, seq = False):
-        # __object = np.zeros(seq) if seq else 0.0
-        # __object += self.flood(seq).squeeze().sum(axis=-1)
-        __object = []
-        __object += [self.flood(seq).squeeze().sum(axis=-1)]
+        spec = self.get_obj_spec()
+        flood = self.flood(seq).squeeze().sum(axis=-1)
         perfs = self.performance(seq)
-        for i,(_,attr,target) in enumerate(self.config['performance_targets']):
-            if attr == 'depthN':
-                if type(target) is str:
-                    target,weight = eval(target.split(',')[0]),eval(target.split(',')[1])
-                    # __object += (perfs[:,i]>target)*weight if seq else (perfs[i]>target)*weight
-                    __object += [(perfs[:,i]>target)*weight if seq else (perfs[i]>target)*weight]
-                else:
-                    # __object += np.abs(perfs[:,i] - target if seq else perfs[i] - target)
-                    __object += [np.abs(perfs[:,i] - target if seq else perfs[i] - target)]
-            else:
-                # __object += perfs[:,i] * target if seq else perfs[i] * target
-                __object += [perfs[:,i] * target if seq else perfs[i] * target]
-        # return __object
-        return np.array(__object).sum(axis=-1)
+        __value = np.where(spec['exced'],perfs>spec['thres'],np.where(spec['depth'],np.abs(perfs-spec['thres']),perfs))
+        __value = __value * spec['weight']
+        __object = np.concatenate([np.reshape(flood,(1,-1)),np.reshape(__value.T,(__value.shape[-1],-1))],axis=0)
+        return __object.sum(axis=-1) if seq else __object.sum()
      
     def objective_pred(self,preds,state):
+        spec = self.get_obj_spec()
         preds,_ = preds
         h,q_w = preds[...,0],preds[...,-1]
-        flood = [q_w[...,self.elements['nodes'].index(idx)].sum(axis=1) * weight
-                for idx,attr,weight in self.config['performance_targets'] if attr == 'cumflooding']
-        depth = [np.abs(h[...,self.elements['nodes'].index(idx)]-target).sum(axis=1)
-                for idx,attr,target in self.config['performance_targets']
-                if attr == 'depthN' and type(target) is not str]
-        exced = [eval(target.split(',')[1])*(h[...,self.elements['nodes'].index(idx)]>eval(target.split(',')[0])).sum(axis=1)
-                for idx,attr,target in self.config['performance_targets']
-                if attr == 'depthN' and type(target) is str]
-        # return q_w.sum(axis=-1).sum(axis=-1) + sum(flood) + sum(depth) + sum(exced)
-        return np.array([q_w.sum(axis=-1).sum(axis=-1)] + flood + depth + exced).T
+        obj = np.concatenate([q_w.sum(axis=-1,keepdims=True),
+                              q_w[...,spec['flood_idx']] * spec['flood_w'],
+                              np.abs(h[...,spec['depth_idx']]-spec['depth_thres']),
+                              (h[...,spec['exced_idx']]>spec['exced_thres']) * spec['exced_w']],axis=-1)
+        return obj.sum(axis=1)
     
     def objective_pred_tf(self,preds,state):
         import tensorflow as tf
+        spec = self.get_obj_spec()
         preds,_ = preds
         h,q_w = preds[...,0],preds[...,-1]
-        flood = [tf.reduce_sum(q_w[...,self.elements['nodes'].index(idx)],axis=1) * weight
-                for idx,attr,weight in self.config['performance_targets'] if attr == 'cumflooding']
-        depth = [tf.reduce_sum(tf.abs(h[...,self.elements['nodes'].index(idx)]-target),axis=1)
-                for idx,attr,target in self.config['performance_targets'] if attr == 'depthN' and type(target) is not str]
-        exced = [tf.reduce_sum(eval(target.split(',')[1])*tf.cast(h[...,self.elements['nodes'].index(idx)]>eval(target.split(',')[0]),tf.float32),axis=1)
-                for idx,attr,target in self.config['performance_targets'] if attr == 'depthN' and type(target) is str]
-        return tf.reduce_sum(tf.reduce_sum(q_w,axis=-1),axis=-1) + tf.reduce_sum(flood,axis=0) + tf.reduce_sum(depth,axis=0) + tf.reduce_sum(exced,axis=0)   
+        obj = tf.concat([tf.reduce_sum(q_w,axis=-1,keepdims=True),
+                         tf.gather(q_w,spec['flood_idx'],axis=-1) * spec['flood_w'],
+                         tf.abs(tf.gather(h,spec['depth_idx'],axis=-1)-spec['depth_thres']),
+                         tf.cast(tf.gather(h,spec['exced_idx'],axis=-1)>spec['exced_thres'],tf.float32) * spec['exced_w']],axis=-1)
+        return tf.reduce_sum(tf.reduce_sum(obj,axis=-1),axis=-1)
 
     def get_action_space(self,act='rand'):
         asp = self.config['action_space'].copy()
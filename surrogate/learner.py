@@ -0,0 +1,141 @@
+import numpy as np
+import os,queue,threading
+os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
+import tensorflow as tf
+from utils.observ import ObsSpec
+
+def get_act_edges(args):
+    # Position of each edge in [1,settings]: 0 for the uncontrolled edges, i for the i-th action
+    act_edges = [i for act_edge in args.act_edges for i in np.where((args.edges==act_edge).all(1))[0]]
+    act_edges = sorted(list(set(act_edges)),key=act_edges.index)
+    ae = np.zeros(args.edges.shape[0],dtype=np.int32)
+    ae[act_edges] = range(1,len(act_edges)+1)
+    return tf.convert_to_tensor(ae)
+
+class Learner:
+    """
+    Model-free updates of the agent on minibatches split from one super-batch per episode.
+
+    Parameters
+    ----------
+    ctrl : agent
+        agent with normalize, convert_setting_to_action, update_eval and conv.
+    env : scenario
+        scenario with objective_pred_tf for the rewards.
+    args : argparse.Namespace
+        mbrl arguments (setting_duration, batch_size, repeats, utd, async_learner, use_edge, norm, scale).
+
+    Notes
+    -----
+    The number of updates per episode is `repeats`, or `utd` * new buffer rows / batch_size
+    if the update-to-data ratio is set. With `async_learner` the updates run in a background
+    thread while the next episode is sampled; at most one super-batch waits in the queue.
+    The updates are capped by the windows in the buffer: each cap is printed and the requested
+    and run totals are kept in n_requested and n_run for the reported UTD.
+    """
+    def __init__(self,ctrl,env,args):
+        self.ctrl,self.env,self.args = ctrl,env,args
+        self.sd = args.setting_duration
+        self.batch_size = args.batch_size
+        self.obs_spec = ObsSpec(args,ctrl.conv)
+        self.ae = get_act_edges(args) if args.use_edge else None
+        self.losses = []
+        self.n_requested,self.n_run = 0,0
+        self.lock = threading.Lock()
+        self.thread = None
+        if getattr(args,"async_learner",False):
+            self.queue = queue.Queue(maxsize=1)
+            self.thread = threading.Thread(target=self.run,daemon=True)
+            self.thread.start()
+
+    def n_updates(self,n_new=0):
+        utd = getattr(self.args,"utd",0)
+        if utd > 0:
+            return max(int(np.ceil(utd*n_new/self.batch_size)),1)
+        return self.args.repeats
+
+    def transitions(self,dats):
+        # (s,a,r,s_) of the whole super-batch in one pass
+        ctrl,args,sd = self.ctrl,self.args,self.sd
+        x,settings,b,y = dats[:4]
+        x_norm,b_norm,y_norm = [ctrl.normalize(dat,item) for dat,item in zip([x,b,y],'xby')]
+        b0,b1 = b_norm[:,:sd,...],b_norm[:,sd:,...]
+        x0,x1 = x_norm[:,-sd:,...],tf.concat([y_norm[:,:sd,:,:-1],b0],axis=-1)
+        settings = tf.repeat(settings[:,0:1,:],sd,axis=1)
+        if args.use_edge:
+            ex,ey = dats[-2:]
+            ex_norm,ey_norm = [ctrl.normalize(dat,'e') for dat in [ex,ey]]
+            ex0,ex1 = ex_norm[:,-sd:,...],ey_norm[:,:sd,...]
+            # Edge action from the precomputed mapping
+            ae = tf.gather(tf.concat([tf.ones_like(settings[...,:1]),settings],axis=-1),self.ae,axis=-1)
+            ex1 = tf.concat([ex1,tf.expand_dims(ae,axis=-1)],axis=-1)
+        # Reduce temporal dimension and extract observs
+        if ctrl.conv:
+            s = self.obs_spec(x0,b0,ex0 if args.use_edge else None,batch=True)
+            s_ = self.obs_spec(x1,b1,ex1 if args.use_edge else None,batch=True)
+            s,s_ = [[o for o in si if o is not None] for si in [s,s_]]
+        else:
+            r0,r1 = ctrl.normalize(dats[4],'r')[:,-sd:,...],ctrl.normalize(dats[5],'r')[:,:sd,...]
+            s,s_ = self.obs_spec(x0,None,ex0,r0,batch=True),self.obs_spec(x1,None,ex1,r1,batch=True)
+        # Get reward from env as -obj_pred
+        states = (x[:,-sd:,...],ex[:,-sd:,...] if args.use_edge else None)
+        preds = (y[:,:sd,...],ey[:,:sd,...] if args.use_edge else None)
+        r = - self.env.objective_pred_tf(preds,states,settings,norm=args.norm)
+        r *= args.scale
+        a = ctrl.convert_setting_to_action(settings[:,0,:])
+        return s,a,r,s_
+
+    def sample(self,dG,event_ids,n_updates):
+        sd = self.sd
+        idxs = dG.get_data_idxs(event_ids,sd,sd*2)
+        requested = n_updates
+        n_updates = max(min(n_updates,(idxs.shape[0]//sd)//self.batch_size),1)
+        if n_updates < requested:
+            print('Updates capped at %s of %s requested: %s windows in the buffer'%(n_updates,requested,idxs.shape[0]//sd))
+        self.n_requested += requested
+        self.n_run += n_updates
+        dats = dG.prepare_batch(idxs,sd*2,n_updates*self.batch_size,sd,trim=False)
+        return self.transitions(dats),n_updates
+
+    def update(self,batch,n_updates):
+        s,a,r,s_ = batch
+        losses = []
+        for i in range(n_updates):
+            sl = slice(i*self.batch_size,(i+1)*self.batch_size)
+            si,ai,si_ = tf.nest.map_structure(lambda t:t[sl],(s,a,s_))
+            loss = self.ctrl.update_eval(si,ai,r[sl],si_,train=True)
+            losses.append([los.numpy() for los in loss] if isinstance(loss,(list,tuple)) else loss.numpy())
+        with self.lock:
+            self.losses += losses
+        return losses
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            self.update(*item)
+
+    def step(self,dG,event_ids,n_new=0):
+        """
+        Sample one super-batch and train on it (or hand it to the learner thread).
+
+        Returns the number of updates.
+        """
+        batch,n_updates = self.sample(dG,event_ids,self.n_updates(n_new))
+        if self.thread is not None:
+            self.queue.put((batch,n_updates))
+        else:
+            self.update(batch,n_updates)
+        return n_updates
+
+    def pop_losses(self):
+        with self.lock:
+            losses,self.losses = self.losses,[]
+        return losses
+
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
@@ -1,6 +1,7 @@
 from emulator import Emulator # Emulator should be imported before env
 from dataloader import DataGenerator
 from utils.utilities import get_inp_files
+from utils.profiler import profiler
 import argparse,yaml
 from envs import get_env
 import numpy as np
@@ -22,6 +23,8 @@ def parser(config=None):
     parser.add_argument('--rain_dir',type=str,default='./envs/config/',help='path of the rainfall events')
     parser.add_argument('--rain_suffix',type=str,default=None,help='suffix of the rainfall names')
     parser.add_argument('--rain_num',type=int,default=1,help='number of the rainfall events')
+    parser.add_argument('--in_memory',action="store_true",help='if inject the rainfall events into the base network instead of writing inp files')
+    parser.add_argument('--profile',action="store_true",help='if time the simulation, training and testing stages')
 
     # simulate args
     parser.add_argument('--simulate',action="store_true",help='if simulate rainfall events for training data')
@@ -32,6 +35,7 @@ def parser(config=None):
     parser.add_argument('--processes',type=int,default=1,help='number of simulation processes')
     parser.add_argument('--repeats',type=int,default=1,help='number of simulation repeats of each event')
     parser.add_argument('--use_edge',action='store_true',help='if models edge attrs')
+    parser.add_argument('--compress',action='store_true',help='if save the data as compressed shards with an event index')
 
     # train args
     parser.add_argument('--train',action="store_true",help='if train the emulator')
@@ -85,6 +89,7 @@ def parser(config=None):
 
 if __name__ == "__main__":
     args,config = parser(os.path.join(HERE,'utils','config.yaml'))
+    profiler.enable(args.profile)
 
     # simu_de = {'simulate':True,
     #            'env':'RedChicoSur',
@@ -159,6 +164,8 @@ if __name__ == "__main__":
             rain_arg['suffix'] = args.rain_suffix
         if 'rain_num' in config:
             rain_arg['rain_num'] = args.rain_num
+        if args.in_memory:
+            rain_arg['in_memory'] = True
         events = get_inp_files(env.config['swmm_input'],rain_arg)
         dG.generate(events,processes=args.processes,repeats=args.repeats,act=args.act)
         dG.save(args.data_dir)
@@ -201,31 +208,35 @@ if __name__ == "__main__":
         for epoch in range(args.epochs):
             train_dats = dG.prepare_batch(train_idxs,seq,args.batch_size,trim=False)
             x,a,b,y = [dat if dat is not None else dat for dat in train_dats[:4]]
-            if args.norm:
-                x,b,y = [emul.normalize(dat,item) for dat,item in zip([x,b,y],'xby')]
-            if args.use_edge:
-                ex,ey = [dat for dat in train_dats[-2:]]
+            with profiler.timer('normalize'):
                 if args.norm:
-                    ex,ey = [emul.normalize(dat,'e') for dat in [ex,ey]]
-            else:
-                ex,ey = None,None
-            train_loss = emul.fit_eval(x,a,b,y,ex,ey)
-            train_loss = train_loss.numpy()
+                    x,b,y = [emul.normalize(dat,item) for dat,item in zip([x,b,y],'xby')]
+                if args.use_edge:
+                    ex,ey = [dat for dat in train_dats[-2:]]
+                    if args.norm:
+                        ex,ey = [emul.normalize(dat,'e') for dat in [ex,ey]]
+                else:
+                    ex,ey = None,None
+            with profiler.timer('train_step'):
+                train_loss = emul.fit_eval(x,a,b,y,ex,ey)
+                train_loss = train_loss.numpy()
             if epoch >= 500:
                 train_losses.append(train_loss)
 
             test_dats = dG.prepare_batch(test_idxs,seq,args.batch_size,trim=False)
             x,a,b,y = [dat if dat is not None else dat for dat in test_dats[:4]]
-            if args.norm:
-                x,b,y = [emul.normalize(dat,item) for dat,item in zip([x,b,y],'xby')]
-            if args.use_edge:
-                ex,ey = [dat for dat in test_dats[-2:]]
+            with profiler.timer('normalize'):
                 if args.norm:
-                    ex,ey = [emul.normalize(dat,'e') for dat in [ex,ey]]
-            else:
-                ex,ey = None,None
-            test_loss = emul.fit_eval(x,a,b,y,ex,ey,fit=False)
-            test_loss = [los.numpy() for los in test_loss]
+                    x,b,y = [emul.normalize(dat,item) for dat,item in zip([x,b,y],'xby')]
+                if args.use_edge:
+                    ex,ey = [dat for dat in test_dats[-2:]]
+                    if args.norm:
+                        ex,ey = [emul.normalize(dat,'e') for dat in [ex,ey]]
+                else:
+                    ex,ey = None,None
+            with profiler.timer('test_step'):
+                test_loss = emul.fit_eval(x,a,b,y,ex,ey,fit=False)
+                test_loss = [los.numpy() for los in test_loss]
             if epoch >= 500:
                 test_losses.append(test_loss)
 
@@ -268,6 +279,8 @@ if __name__ == "__main__":
         np.save(os.path.join(args.model_dir,'train_loss.npy'),np.array(train_losses))
         np.save(os.path.join(args.model_dir,'test_loss.npy'),np.array(test_losses))
         np.save(os.path.join(args.model_dir,'time.npy'),np.array(secs[1:]))
+        profiler.export(os.path.join(args.model_dir,'profile'),args.epochs)
+        profiler.reset()
         plt.plot(train_losses,label='train')
         plt.plot(np.array(test_losses).sum(axis=1),label='test')
         plt.legend()
@@ -300,12 +313,14 @@ if __name__ == "__main__":
             rain_arg['suffix'] = args.rain_suffix
         if 'rain_num' in config:
             rain_arg['rain_num'] = args.rain_num
+        if args.in_memory:
+            rain_arg['in_memory'] = True
         events = get_inp_files(env.config['swmm_input'],rain_arg)
         if 'train_event_id' in config and os.path.isfile(os.path.join(args.data_dir,config['train_event_id'])):
             train_ids = np.load(os.path.join(args.data_dir,config['train_event_id']))
             events = [eve for i,eve in enumerate(events) if i not in train_ids]
         for event in events:
-            name = os.path.basename(event).strip('.inp')
+            name = event['name'] if isinstance(event,dict) else os.path.basename(event).strip('.inp')
             if os.path.exists(os.path.join(args.result_dir,name + '_states.npy')):
                 states = np.load(os.path.join(args.result_dir,name + '_states.npy'))
                 perfs = np.load(os.path.join(args.result_dir,name + '_perfs.npy'))
@@ -396,4 +411,7 @@ if __name__ == "__main__":
                 np.save(os.path.join(args.result_dir,name + '_edge_true.npy'),edge_true.astype(np.float32))
                 np.save(os.path.join(args.result_dir,name + '_edge_pred.npy'),edge_pred.astype(np.float32))
 
-
+    if args.test:
+        profiler.export(os.path.join(args.result_dir,'profile'))
+    elif args.simulate and not args.train:
+        profiler.export(os.path.join(args.data_dir,'profile'))
@@ -1,4 +1,5 @@
 from utils.utilities import get_inp_files
+from utils.runoff import RunoffCache,TimeIndex
 import pandas as pd
 import os,time,gc
 import multiprocessing as mp
@@ -116,27 +117,6 @@ class mpc_problem(Problem):
         F = [r.get() for r in res]
         out['F'] = np.array(F)
 
-def get_runoff(env,event,rate=False,tide=False):
-    _ = env.reset(event,global_state=True)
-    runoffs = []
-    t0 = env.env.methods['simulation_time']()
-    done = False
-    while not done:
-        done = env.step()
-        if rate:
-            runoff = np.array([[env.env._getNodeLateralinflow(node)
-                        if not env.env._isFinished else 0.0]
-                       for node in env.elements['nodes']])
-        else:
-            runoff = env.state_full()[...,-1:]
-        if tide:
-            ti = env.state_full()[...,:1]
-            runoff = np.concatenate([runoff,ti],axis=-1)
-        runoffs.append(runoff)
-    ts = [t0]+env.data_log['simulation_time'][:-1]
-    runoff = np.array(runoffs)
-    return ts,runoff
-
 if __name__ == '__main__':
     args,config = parser(os.path.join(HERE,'utils','config.yaml'))
     # mp.set_start_method('spawn', force=True)    # use gpu in multiprocessing
@@ -169,9 +149,8 @@ if __name__ == '__main__':
         if os.path.exists(os.path.join(args.result_dir,name + '_state.npy')):
             continue
         t0 = time.time()
-        ts,runoff_rate = get_runoff(env,event,True)
-        tss = pd.DataFrame.from_dict({'Time':ts,'Index':np.arange(len(ts))}).set_index('Time')
-        tss.index = pd.to_datetime(tss.index)
+        ts,runoff_rate = RunoffCache(os.path.join('./envs/data/',args.env,'runoff'),args.interval,rate=True).get(env,event)
+        tss = TimeIndex(ts)
         t1 = time.time()
         print('Runoff time: {} s'.format(t1-t0))
 
@@ -1,5 +1,4 @@
 import os,yaml
-import multiprocessing as mp
 import numpy as np
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 # os.environ['CUDA_DEVICE_ORDER'] = 'PCI_BUS_ID'
@@ -12,7 +11,10 @@ tf.config.list_physical_devices(device_type='GPU')
 from emulator import Emulator
 from dataloader import DataGenerator
 from agent import get_agent
-from mpc import get_runoff
+from envpool import VecEnv
+from rollout import RolloutEngine
+from learner import Learner
+from utils.runoff import RunoffCache
 from envs import get_env
 from utils.utilities import get_inp_files
 import pandas as pd
@@ -61,7 +63,13 @@ def parser(config=None):
     parser.add_argument('--cri_lr',type=float,default=1e-3,help='critic learning rate')
     parser.add_argument('--update_interval',type=float,default=0.005,help='target update interval')
     parser.add_argument('--epsilon_decay',type=float,default=0.9996,help='epsilon decay rate in QMIX')
+    parser.add_argument('--stacked',action="store_true",help='if evaluate all QMIX agents in one stacked network')
     parser.add_argument('--value_tau',type=float,default=0.0,help='value running average tau')
+    parser.add_argument('--fused',action="store_true",help='if fuse the SAC updates into one graph')
+    parser.add_argument('--jit_compile',action="store_true",help='if compile the fused update with XLA')
+    parser.add_argument('--shared_encoder',action="store_true",help='if encode the graph once per batch for actor and critics')
+    parser.add_argument('--utd',type=float,default=0,help='update-to-data ratio: trained samples per new buffer row (0 uses repeats)')
+    parser.add_argument('--async_learner',action="store_true",help='if update the agent in a background thread')
     parser.add_argument('--model_based',action="store_true",help='if use model-based sampling')
     parser.add_argument('--sample_gap',type=int,default=0,help='sample data with swmm per sample gap')
     parser.add_argument('--start_gap',type=int,default=100,help='start updating agent after start gap')
@@ -94,118 +102,6 @@ def parser(config=None):
     print('MBRL configs: {}'.format(args))
     return args,config
 
-# TODO: if use_pred for not conv
-def interact_steps(args,event,runoff,ctrl=None,train=False):
-    os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
-    # with tf.device('/cpu:0'):
-    if ctrl is None:
-        args.load_agent = True
-        ctrl = get_agent(args.agent)(args.action_shape,args.observ_space,args,act_only=True)
-    # trajs = []
-    tss,runoff = runoff
-    env = get_env(args.env)(swmm_file=event)
-    state = env.state_full(seq=args.setting_duration)
-    if args.if_flood:
-        flood = env.flood(seq=args.setting_duration)
-    states = [state[-1]]
-    perfs,objects = [env.flood()],[env.objective()]
-    edge_state = env.state_full(args.setting_duration,'links')
-    edge_states = [edge_state[-1]]
-    setting = env.controller('default')
-    settings = [setting]
-    rains = [env.rainfall()]
-    done,i = False,0
-    while not done:
-        if i*args.interval % args.control_interval == 0:
-            state[...,1] = state[...,1] - state[...,-1]
-            if args.if_flood:
-                f = (flood>0).astype(float)
-                # f = np.eye(2)[f].squeeze(-2)
-                state = np.concatenate([state[...,:-1],f,state[...,-1:]],axis=-1)
-            t = env.env.methods['simulation_time']()
-            b = runoff[int(tss.asof(t)['Index'])][:args.setting_duration]
-            x_norm,b_norm,e_norm = [ctrl.normalize(dat,item) if dat is not None else None
-                                    for dat,item in zip([state,b,edge_state if args.use_edge else None],'xbe')]
-            if ctrl.conv:
-                x_norm,e_norm = [tf.stack([tf.reduce_sum(dat[...,i],axis=0) if 'cum' in attr or '_vol' in attr else dat[-1,:,i]
-                                        for i,attr in enumerate(args.attrs[items])],axis=-1)
-                                          for dat,items in zip([x_norm,e_norm],['nodes','links'])]
-                if args.use_pred:
-                    b_norm = tf.stack([tf.reduce_sum(b_norm[...,i],axis=0) if i==0 else b_norm[-1,:,i]
-                                    for i in range(b_norm.shape[-1])],axis=-1)
-                observ = [x_norm,b_norm,e_norm] if args.use_pred else [x_norm,e_norm]
-            else:
-                r_norm = ctrl.normalize(env.rainfall(seq=args.setting_duration),'r')
-                observ = tf.stack([x_norm[...,args.elements['nodes'].index(idx),args.attrs['nodes'].index(attr)] if attr in args.attrs['nodes'] 
-                                    else e_norm[...,args.elements['links'].index(idx),args.attrs['links'].index(attr)]
-                                        for idx,attr in args.states if attr in args.attrs['nodes']+args.attrs['links']],axis=-1)
-                observ = tf.concat([r_norm,observ],axis=-1)
-                observ = tf.stack([tf.reduce_sum(observ[...,i],axis=-1) if 'cum' in attr or '_vol' in attr else observ[...,-1,i]
-                                   for i,(_,attr) in enumerate(args.states)],axis=-1)
-            setting = ctrl.control(observ,train).numpy()
-            setting = env.controller('safe',state[-1],setting)
-        done = env.step([float(sett) for sett in setting.tolist()])
-        state = env.state_full(seq=args.setting_duration)
-        if args.if_flood:
-            flood = env.flood(seq=args.setting_duration)
-        edge_state = env.state_full(args.setting_duration,'links')
-        states.append(state[-1])
-        perfs.append(env.flood())
-        objects.append(env.objective())
-        edge_states.append(edge_state[-1])
-        settings.append(setting)        
-        rains.append(env.rainfall())
-        i += 1
-    env.initialize_logger()
-    return [np.array(dat) for dat in [states,perfs,settings,rains,edge_states,rains,objects]]
-
-@tf.function
-def rollout(ctrl,dat,emul,args):
-    args = argparse.Namespace(**args)
-    n_step,r_step = args.horizon//args.setting_duration,args.setting_duration//args.interval
-    x,a,b,y = dat[:4]
-    r = tf.concat(dat[4:6],axis=1)
-    ex = dat[-2]
-    # Initial perf is not included in the rollout
-    xs,exs,settings,perfs = [x],[ex],[a[:,:args.seq_in,:]],[y[:,:args.seq_in,:,-1:]]
-    for i in range(n_step):
-        bi = b[:,i*r_step:(i+1)*r_step,:]
-        x_norm,b_norm,e_norm = [ctrl.normalize(dat,item) if dat is not None else None
-                                for dat,item in zip([x,bi,ex],'xbe')]
-        if ctrl.conv:
-            x_norm,e_norm = [tf.stack([tf.reduce_sum(dat[...,i],axis=1) if 'cum' in attr or '_vol' in attr else dat[:,-1,:,i]
-                                       for i,attr in enumerate(args.attrs[items])],axis=-1)
-                                         for dat,items in zip([x_norm,e_norm],['nodes','links'])]
-            if args.use_pred:
-                b_norm = tf.stack([tf.reduce_sum(b_norm[...,i],axis=1) if i==0 else b_norm[:,-1,:,i]
-                                   for i in range(b_norm.shape[-1])],axis=-1)
-            s_norm = [x_norm,b_norm,e_norm] if args.use_pred else [x_norm,e_norm]
-        else:
-            r_norm = ctrl.normalize(r[:,i*r_step:(i+1)*r_step,:],'r')
-            s_norm = tf.stack([x_norm[...,args.elements['nodes'].index(idx),args.attrs['nodes'].index(attr)] if attr in args.attrs['nodes']
-                               else e_norm[...,args.elements['links'].index(idx),args.attrs['links'].index(attr)]
-                               for idx,attr in args.states if attr in args.attrs['nodes']+args.attrs['links']],axis=-1)
-            s_norm = tf.concat([r_norm,s_norm],axis=-1)
-            s_norm = tf.stack([tf.reduce_sum(s_norm[...,i],axis=-1) if 'cum' in attr or '_vol' in attr else s_norm[...,-1,i]
-                                for i,(_,attr) in enumerate(args.states)],axis=-1)
-        setting = ctrl.control(s_norm,train=True,batch=True)
-        setting = tf.repeat(setting[:,tf.newaxis,:],r_step,axis=1)
-        settings.append(setting)
-        preds = emul.predict_tf(x,bi,setting,ex)
-        if emul.if_flood:
-            x = tf.concat([preds[0][...,:-2],tf.cast(preds[0][...,-2:-1]>0.5,tf.float32),bi],axis=-1)
-        else:
-            x = tf.concat([preds[0][...,:-1],bi],axis=-1)
-        if emul.use_edge:
-            ae = emul.get_edge_action(setting,True)
-            ex = tf.concat([preds[1],ae],axis=-1)
-        else:
-            ex = None
-        xs.append(x)
-        exs.append(ex)
-        perfs.append(preds[0][...,-1:])
-    return [tf.concat(tf.concat(dat,axis=1),axis=0) for dat in [xs,exs,settings,perfs]]+[tf.concat(r,axis=0)]
-
 if __name__ == '__main__':
     args,config = parser(os.path.join(HERE,'utils','policy.yaml'))
 
@@ -290,36 +186,16 @@ if __name__ == '__main__':
             rain_arg['rain_num'] = hyp['rain_num']
         # events = get_inp_files(env.config['swmm_input'],rain_arg)
         events = ['./envs/network/astlingen/astlingen_03_05_2006_01.inp', './envs/network/astlingen/astlingen_07_30_2004_21.inp', './envs/network/astlingen/astlingen_01_13_2002_12.inp', './envs/network/astlingen/astlingen_08_12_2003_08.inp', './envs/network/astlingen/astlingen_10_05_2005_16.inp', './envs/network/astlingen/astlingen_04_12_2003_18.inp', './envs/network/astlingen/astlingen_05_27_2004_06.inp', './envs/network/astlingen/astlingen_12_02_2004_23.inp', './envs/network/astlingen/astlingen_12_28_2006_08.inp', './envs/network/astlingen/astlingen_12_13_2006_23.inp', './envs/network/astlingen/astlingen_03_11_2002_09.inp', './envs/network/astlingen/astlingen_08_11_2003_19.inp', './envs/network/astlingen/astlingen_09_16_2006_05.inp', './envs/network/astlingen/astlingen_03_23_2006_08.inp', './envs/network/astlingen/astlingen_06_13_2000_20.inp', './envs/network/astlingen/astlingen_11_15_2003_17.inp', './envs/network/astlingen/astlingen_02_07_2001_07.inp', './envs/network/astlingen/astlingen_04_17_2005_12.inp', './envs/network/astlingen/astlingen_06_29_2002_07.inp', './envs/network/astlingen/astlingen_05_06_2004_19.inp', './envs/network/astlingen/astlingen_08_21_2001_08.inp', './envs/network/astlingen/astlingen_04_30_2001_09.inp', './envs/network/astlingen/astlingen_03_13_2001_16.inp', './envs/network/astlingen/astlingen_07_27_2000_14.inp', './envs/network/astlingen/astlingen_04_27_2005_00.inp', './envs/network/astlingen/astlingen_08_01_2002_11.inp', './envs/network/astlingen/astlingen_11_28_2006_01.inp', './envs/network/astlingen/astlingen_10_29_2004_11.inp', './envs/network/astlingen/astlingen_07_25_2000_01.inp', './envs/network/astlingen/astlingen_09_11_2006_11.inp', './envs/network/astlingen/astlingen_06_01_2005_10.inp', './envs/network/astlingen/astlingen_02_10_2004_00.inp', './envs/network/astlingen/astlingen_03_07_2003_20.inp', './envs/network/astlingen/astlingen_10_25_2000_13.inp', './envs/network/astlingen/astlingen_12_23_2000_19.inp', './envs/network/astlingen/astlingen_08_08_2005_22.inp', './envs/network/astlingen/astlingen_12_15_2006_17.inp', './envs/network/astlingen/astlingen_04_17_2000_07.inp', './envs/network/astlingen/astlingen_11_12_2005_09.inp', './envs/network/astlingen/astlingen_03_07_2006_18.inp', './envs/network/astlingen/astlingen_10_13_2003_15.inp', './envs/network/astlingen/astlingen_09_26_2002_16.inp', './envs/network/astlingen/astlingen_10_28_2000_08.inp', './envs/network/astlingen/astlingen_10_23_2004_17.inp', './envs/network/astlingen/astlingen_06_11_2006_01.inp', './envs/network/astlingen/astlingen_12_16_2004_17.inp', './envs/network/astlingen/astlingen_03_27_2004_11.inp', './envs/network/astlingen/astlingen_01_04_2004_17.inp', './envs/network/astlingen/astlingen_11_17_2001_18.inp', './envs/network/astlingen/astlingen_04_17_2000_22.inp', './envs/network/astlingen/astlingen_08_22_2006_02.inp']
-        if os.path.exists(os.path.join(args.agent_dir,'train_runoff.npy')):
-            res = [np.load(os.path.join(args.agent_dir,'train_runoff_ts.npy'),allow_pickle=True),
-                   np.load(os.path.join(args.agent_dir,'train_runoff.npy'),allow_pickle=True)]
-            res = [(ts,runoff) for ts,runoff in zip(res[0],res[1])]
-        else:
-            pool = mp.Pool(args.processes)
-            res = [pool.apply_async(func=get_runoff,args=(env,event,False,args.tide,))
-                   for event in events]
-            pool.close()
-            pool.join()
-            res = [r.get() for r in res]
-            np.save(os.path.join(args.agent_dir,'train_runoff_ts.npy'),np.array([r[0] for r in res]))
-            np.save(os.path.join(args.agent_dir,'train_runoff.npy'),np.array([r[1] for r in res]))
-        runoffs = []
-        for ts,runoff in res:
-            # Use mp to get runoff
-            # ts,runoff = get_runoff(env,event,tide=args.tide)
-            tss = pd.DataFrame.from_dict({'Time':ts,'Index':np.arange(len(ts))}).set_index('Time')
-            tss.index = pd.to_datetime(tss.index)
-            seq = args.setting_duration//args.interval
-            runoff = np.stack([np.concatenate([runoff[idx:idx+seq],np.tile(np.zeros_like(s),(max(idx+seq-runoff.shape[0],0),)+tuple(1 for _ in s.shape))],axis=0)
-                                for idx,s in enumerate(runoff)])
-            runoffs.append([tss,runoff])
+        cache = RunoffCache(os.path.join('./envs/data/',args.env,'runoff'),args.interval,tide=args.tide)
+        # the sampling workers read their windows from the cache
+        cache.compute(env,events,args.processes)
         print("Finish training events runoff")
 
         # Real data for sampling base points
         dG = DataGenerator(env.config,args.data_dir,args)
         dG.load(args.data_dir)
         # Virtual data buffer for model-based rollout trajs
-        dGv = DataGenerator(env.config,args=args)
+        dGv = DataGenerator(env.config,args=args,ring=True)
         ctrl = get_agent(args.agent)(args.action_shape,args.observ_space,args,act_only=False)
         ctrl.set_norm(*dG.get_norm())
         args.use_edge = args.use_edge or not ctrl.conv
@@ -327,27 +203,25 @@ if __name__ == '__main__':
         train_ids = np.load(os.path.join(margs.model_dir,'train_id.npy') if args.model_based else os.path.join(args.data_dir,'train_id.npy'))
         test_ids = [ev for ev in range(n_events) if ev not in train_ids]
         train_events,test_events = [events[ix] for ix in train_ids],[events[ix] for ix in test_ids]
+        learner = Learner(ctrl,env,args)
+        engine = RolloutEngine(ctrl,emul,args) if args.model_based or args.sample_gap == 0 else None
+        # Persistent SWMM workers driven by the live agent
+        venv = VecEnv(args,args.processes,cache.cache_dir) if args.sample_gap > 0 or args.eval_gap > 0 else None
 
         train_losses,train_objss,test_objss,secs = [],[],[],[]
         log_dir = "logs/agent/" + datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
         tensorboard_callback = tf.keras.callbacks.TensorBoard(log_dir=log_dir, histogram_freq=1)
         for episode in range(args.episodes):
             setattr(args,"episode",episode)
-            sec,t = [],time.time()
+            sec,t,n_new = [],time.time(),0
             # Model-free sampling
             if args.sample_gap > 0 and episode % args.sample_gap == 0:
                 print(f"{episode}/{args.episodes} Start model-free sampling")
-                args.load_agent = True
-                ctrl.save()
-                pool = mp.Pool(args.processes)
-                res = [pool.apply_async(func=interact_steps,args=(args,event,runoffs[idx],None,True,))
-                    for idx,event in zip(train_ids,train_events)]
-                pool.close()
-                pool.join()
-                res = [r.get() for r in res]
+                res = venv.run(ctrl,train_events,train=True)
                 trajs = [np.concatenate([r[i] for r in res],axis=0) for i in range(5)]
                 trajs.append(np.concatenate([[idx]*r[0].shape[0] for idx,r in zip(train_ids,res)],axis=-1))
                 dGv.update(trajs)
+                n_new += trajs[0].shape[0]
                 if args.model_based:
                     dG.update(trajs)
                 train_objss.append(np.array([np.sum(r[-1]) for r in res]))
@@ -375,7 +249,9 @@ if __name__ == '__main__':
                     i += 1
                     if i > 100:
                         break
-                trajs_v = rollout(ctrl,train_dats[:-1],emul,vars(args))
+                t_r = time.time()
+                trajs_v = engine(train_dats[:-1])
+                t_r = time.time() - t_r
                 xs,exs,settings,perfs,rains = [traj.numpy().reshape((-1,)+tuple(traj.shape[2:])) for traj in trajs_v]
                 xs[...,1] += xs[...,-1]
                 if emul.if_flood:
@@ -383,91 +259,45 @@ if __name__ == '__main__':
                 idxs = np.repeat(train_dats[-1],args.horizon+args.seq_in)
                 trajs_v = [xs,perfs,settings,rains,exs,idxs]
                 dGv.update(trajs_v)
+                n_new += xs.shape[0]
                 # data num: batch * (horizon + seq_in)
                 sec.append(time.time()-t)
                 t = time.time()
-                print("{}/{} Finish model-based sampling: {:.2f}s".format(episode,args.episodes,sec[-1]))
+                print("{}/{} Finish model-based sampling: {:.2f}s Rollouts: {:.1f}/s".format(episode,args.episodes,sec[-1],train_dats[0].shape[0]/t_r))
 
             # Model-free update
             if episode > args.start_gap:
                 print(f"{episode}/{args.episodes} Start model-free update")
-                for _ in range(args.repeats):
-                    train_idxs = dGv.get_data_idxs(train_ids,args.setting_duration,args.setting_duration*2)
-                    train_dats = dGv.prepare_batch(train_idxs,args.setting_duration*2,args.batch_size,args.setting_duration,trim=False)
-                    x,settings,b,y = [dat if dat is not None else dat for dat in train_dats[:4]]
-                    x_norm,b_norm,y_norm = [ctrl.normalize(dat,item) for dat,item in zip([x,b,y],'xby')]
-                    b0,b1 = b_norm[:,:args.setting_duration,...],b_norm[:,args.setting_duration:,...]
-                    x0,x1 = x_norm[:,-args.setting_duration:,...],tf.concat([y_norm[:,:args.setting_duration,:,:-1],b0],axis=-1)
-                    settings = tf.repeat(settings[:,0:1,:],args.setting_duration,axis=1)
-                    if args.use_edge:
-                        ex,ey = train_dats[-2:]
-                        ex_norm,ey_norm = [ctrl.normalize(dat,'e') for dat in [ex,ey]]
-                        ex0,ex1 = ex_norm[:,-args.setting_duration:,...],ey_norm[:,:args.setting_duration,...]
-                        # Get edge action and concat into ex1
-                        act_edges = [i for act_edge in args.act_edges for i in np.where((args.edges==act_edge).all(1))[0]]
-                        act_edges = sorted(list(set(act_edges)),key=act_edges.index)
-                        ae = np.zeros(args.edges.shape[0])
-                        ae[act_edges] = range(1,settings.shape[-1]+1)
-                        ae = tf.expand_dims(tf.gather(tf.concat([tf.ones_like(settings[...,:1]),settings],axis=-1),tf.cast(ae,tf.int32),axis=-1),axis=-1) 
-                        ex1 = tf.concat([ex1,ae],axis=-1)
-                    # Reduce temporal dimension and extract observs 
-                    if ctrl.conv:
-                        x0,x1 = [tf.stack([tf.reduce_sum(xi[...,i],axis=1) if 'cum' in attr or '_vol' in attr else xi[:,-1,:,i]
-                                            for i,attr in enumerate(args.attrs['nodes'])],axis=-1) for xi in [x0,x1]]
-                        s,s_ = [x0],[x1]
-                        if args.use_pred:
-                            b0,b1 = [tf.stack([tf.reduce_sum(bi[...,i],axis=1) if i==0 else bi[:,-1,:,i]
-                                               for i in range(bi.shape[-1])],axis=-1) for bi in [b0,b1]]
-                            s,s_ = s+[b0],s_+[b1]
-                        if args.use_edge:
-                            ex0,ex1 = [tf.stack([tf.reduce_sum(ei[...,i],axis=1) if 'cum' in attr or '_vol' in attr else ei[:,-1,:,i]
-                                                 for i,attr in enumerate(args.attrs['links'])],axis=-1) for ei in [ex0,ex1]]
-                            s,s_ = s+[ex0],s_+[ex1]
-                    else:
-                        r0,r1 = ctrl.normalize(train_dats[4],'r')[:,-args.setting_duration:,...],ctrl.normalize(train_dats[5],'r')[:,:args.setting_duration,...]
-                        s,s_ = [tf.stack([xi[...,args.elements['nodes'].index(idx),args.attrs['nodes'].index(attr)] if attr in args.attrs['nodes']
-                                           else ei[...,args.elements['links'].index(idx),args.attrs['links'].index(attr)]
-                                           for idx,attr in args.states if attr in args.attrs['nodes']+args.attrs['links']],axis=-1)
-                                             for xi,ei in zip([x0,x1],[ex0,ex1])]
-                        s,s_ = [tf.concat([ri,si],axis=-1) for ri,si in zip([r0,r1],[s,s_])]
-                        s,s_ = [tf.stack([tf.reduce_sum(si[...,i],axis=-1) if 'cum' in attr or '_vol' in attr else si[...,-1,i]
-                                          for i,(_,attr) in enumerate(args.states)],axis=-1) for si in [s,s_]]
-                    # Get reward from env as -obj_pred
-                    states = (x[:,-args.setting_duration:,...],ex[:,-args.setting_duration:,...] if args.use_edge else None)
-                    preds = (y[:,:args.setting_duration,...],ey[:,:args.setting_duration,...] if args.use_edge else None)
-                    r = - env.objective_pred_tf(preds,states,settings,norm=args.norm)
-                    r *= args.scale
-                    # r = tf.clip_by_value(r, -10, 10)
-                    a = ctrl.convert_setting_to_action(settings[:,0,:])
-                    train_loss = ctrl.update_eval(s,a,r,s_,train=True)
-                    train_losses.append([los.numpy() for los in train_loss] if isinstance(train_loss,list) else train_loss)
+                n_updates = learner.step(dGv,train_ids,n_new)
                 sec.append(time.time()-t)
                 t = time.time()
-                loss = np.mean(train_losses[-args.repeats:],axis=0)
-                if isinstance(train_loss,list):
-                    print("{}/{} Finish model-free update: {:.2f}s Mean loss:".format(episode,args.episodes,sec[-1])+ (len(loss)*" {:.2f}").format(*loss))
+                losses = learner.pop_losses()
+                train_losses += losses
+                if len(losses) == 0:
+                    print("{}/{} Submit {} model-free updates: {:.2f}s".format(episode,args.episodes,n_updates,sec[-1]))
+                elif isinstance(losses[-1],list):
+                    loss = np.mean(losses,axis=0)
+                    print("{}/{} Finish {} model-free updates: {:.2f}s Mean loss:".format(episode,args.episodes,len(losses),sec[-1])+ (len(loss)*" {:.2f}").format(*loss))
                     with tf.summary.create_file_writer(log_dir).as_default():
                         tf.summary.scalar('Value loss', loss[0], step=episode)
                         tf.summary.scalar('Alpha', loss[1], step=episode)
                         tf.summary.scalar('Policy loss', loss[2], step=episode)
                         if hasattr(ctrl,'vnet'):
                             tf.summary.scalar('VNet loss', loss[3], step=episode)
+                        tf.summary.scalar('Updates per second', len(losses)/sec[-1], step=episode)
                 else:
-                    print("{}/{} Finish model-free update: {:.2f}s Mean loss: {:.2f}".format(episode,args.episodes,sec[-1],loss))
+                    loss = np.mean(losses,axis=0)
+                    print("{}/{} Finish {} model-free updates: {:.2f}s Mean loss: {:.2f}".format(episode,args.episodes,len(losses),sec[-1],loss))
                     with tf.summary.create_file_writer(log_dir).as_default():
                         tf.summary.scalar('Value loss', loss, step=episode)
                         tf.summary.scalar('Epsilon', ctrl.epsilon, step=episode)
+                        tf.summary.scalar('Updates per second', len(losses)/sec[-1], step=episode)
 
             # Evaluate the model in several episodes
             if episode > args.start_gap and args.eval_gap > 0 and episode % args.eval_gap == 0:
                 print(f"{episode}/{args.episodes} Start model-free interaction")
-                ctrl.save()
-                pool = mp.Pool(args.processes)
-                res = [pool.apply_async(func=interact_steps,args=(args,event,runoffs[idx],None,False,))
-                        for idx,event in zip(test_ids,test_events)]
-                pool.close()
-                pool.join()
-                res = [np.sum(r.get()[-1]) for r in res]
+                res = venv.run(ctrl,test_events,train=False)
+                res = [np.sum(r[-1]) for r in res]
                 # data = [np.concatenate([r[i] for r in res],axis=0) for i in range(4)]
                 test_objss.append(np.array(res))
                 sec.append(time.time()-t)
@@ -484,6 +314,10 @@ if __name__ == '__main__':
             if episode % args.save_gap == 0:
                 ctrl.save()
             ctrl.update_func(episode)
+        if venv is not None:
+            venv.close()
+        learner.close()
+        train_losses += learner.pop_losses()
         ctrl.save()
         dGv.save(args.agent_dir)
         np.save(os.path.join(ctrl.agent_dir,'train_loss.npy'),np.array(train_losses))
@@ -1,10 +1,12 @@
 from emulator import Emulator # Emulator should be imported before env
 from utils.utilities import get_inp_files
+from utils.runoff import get_runoff,RunoffCache,TimeIndex
+from utils.profiler import profiler,timed
 import pandas as pd
 import os,time,gc
 import multiprocessing as mp
 import numpy as np
-from scipy.stats import truncnorm
+from cem import CEM
 os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
 import tensorflow as tf
 from tensorflow.keras.optimizers import Adam,SGD
@@ -49,6 +51,7 @@ def parser(config=None):
     parser.add_argument('--act',type=str,default='rand',help='what control actions')
 
     parser.add_argument('--processes',type=int,default=1,help='number of simulation processes')
+    parser.add_argument('--workers',type=int,default=1,help='number of event workers in mpc_bench')
     parser.add_argument('--pop_size',type=int,default=32,help='number of population')
     parser.add_argument('--use_current',action="store_true",help='if use current setting as initial')
     parser.add_argument('--sampling',type=float,default=0.4,help='sampling rate')
@@ -58,8 +61,12 @@ def parser(config=None):
     parser.add_argument('--termination',nargs='+',type=str,default=['n_eval','256'],help='Iteration termination criteria')
     
     parser.add_argument('--surrogate',action='store_true',help='if use surrogate for dynamic emulation')
+    parser.add_argument('--hybrid',type=int,default=0,help='number of emulator-screened candidates verified by simulation')
     parser.add_argument('--gradient',action='store_true',help='if use gradient-based optimization')
     parser.add_argument('--cross_entropy',type=float,default=0,help=' if use cross-entropy method and the kept percentage')
+    parser.add_argument('--ce_alpha',type=float,default=0.1,help='smoothing rate of the cross-entropy distribution')
+    parser.add_argument('--ce_archive',type=int,default=0,help='number of elites kept across cross-entropy generations')
+    parser.add_argument('--ce_forward',action='store_true',help='with --gradient and --cross_entropy, if run the forward cross-entropy engine on the emulator instead of the distribution gradient')
     parser.add_argument('--model_dir',type=str,default='./model/',help='path of the surrogate model')
     parser.add_argument('--epsilon',type=float,default=-1.0,help='the depth threshold of flooding')
     parser.add_argument('--result_dir',type=str,default='./result/',help='path of the control results')
@@ -70,6 +77,7 @@ def parser(config=None):
     # stochastic MPC for surrogate-based internal model
     parser.add_argument('--stochastic',type=int,default=0,help='number of stochastic scenarios')
     parser.add_argument('--error',type=float,default=0.0,help='error range of stochastic scenarios')
+    parser.add_argument('--profile',action='store_true',help='if time the optimization and simulation stages')
     args = parser.parse_args()
     if config is not None:
         hyps = yaml.load(open(config,'r'),yaml.FullLoader)
@@ -88,27 +96,6 @@ def parser(config=None):
     print('MPC configs: {}'.format(args))
     return args,config
 
-def get_runoff(env,event,rate=False,tide=False):
-    _ = env.reset(event,global_state=True)
-    runoffs = []
-    t0 = env.env.methods['simulation_time']()
-    done = False
-    while not done:
-        done = env.step()
-        if rate:
-            runoff = np.array([[env.env._getNodeLateralinflow(node)
-                        if not env.env._isFinished else 0.0]
-                       for node in env.elements['nodes']])
-        else:
-            runoff = env.state_full()[...,-1:]
-        if tide:
-            ti = env.state_full()[...,:1]
-            runoff = np.concatenate([runoff,ti],axis=-1)
-        runoffs.append(runoff)
-    ts = [t0]+env.data_log['simulation_time'][:-1]
-    runoff = np.array(runoffs)
-    return ts,runoff
-
 def pred_simu(y,file,args,r=None,act=True):
     # n_step = args.prediction['control_horizon']//args.setting_duration
     # r_step = args.setting_duration//args.interval
@@ -136,6 +123,23 @@ def pred_simu(y,file,args,r=None,act=True):
     # return np.array(perf)
     return env.objective(idx)
 
+def init_simu(env_name):
+    global simu_env
+    simu_env = get_env(env_name)(initialize=False)
+
+def eval_simu(y,file,log=None,runoff_rate=None,actions=None):
+    _ = simu_env.reset(swmm_file = file)
+    if log is not None:
+        simu_env.data_log.update({k:v for k,v in log.items() if 'cum' not in k})
+    done,idx = False,0
+    while not done and idx < y.shape[0]:
+        if runoff_rate is not None:
+            for node,ri in zip(simu_env.elements['nodes'],runoff_rate[idx]):
+                simu_env.env._setNodeInflow(node,ri)
+        done = simu_env.step(y[idx] if actions is None else actions[tuple(y[idx].astype(int))])
+        idx += 1
+    return simu_env.objective(idx).sum()
+
 class mpc_problem(Problem):
     def __init__(self,args,margs=None):
         self.args = args
@@ -144,6 +148,8 @@ class mpc_problem(Problem):
             self.emul = Emulator(margs.conv,margs.resnet,margs.recurrent,margs)
             self.emul.load(margs.model_dir)
             self.stochastic = getattr(args,"stochastic",False)
+        self.hybrid = getattr(args,"hybrid",0) if margs is not None else 0
+        self.err_log = []
         self.step = args.interval
         self.eval_hrz = args.prediction['eval_horizon']
         self.n_step = args.prediction['control_horizon']//args.setting_duration
@@ -180,28 +186,31 @@ class mpc_problem(Problem):
     def load_file(self,eval_file,log=None,runoff_rate=None):
         self.file,self.runoff_rate,self.log = eval_file,runoff_rate,log
 
-    def pred_simu(self,y):
+    def expand(self,y):
         y = y.reshape((self.n_step,self.n_act))
         y = np.repeat(y,self.r_step,axis=0)
         if y.shape[0] < self.eval_hrz // self.step:
             y = np.concatenate([y,np.repeat(y[-1:,:],self.eval_hrz // self.step-y.shape[0],axis=0)],axis=0)
+        return y
+
+    def get_pool(self):
+        # Persistent simulation workers, each holding its own scenario
+        if getattr(self,'pool',None) is None:
+            self.pool = mp.Pool(self.args.processes,initializer=init_simu,initargs=(self.args.env,))
+        return self.pool
+
+    def close(self):
+        if getattr(self,'pool',None) is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def pred_simu(self,x):
+        rr = self.runoff_rate if self.args.prediction['no_runoff'] else None
+        actions = None if self.args.act.startswith('conti') else self.actions
+        F = self.get_pool().starmap(eval_simu,[(self.expand(xi),self.file,self.log,rr,actions) for xi in x])
+        return np.array(F)
 
-        _ = self.env.reset(swmm_file = self.file)
-        if getattr(self,'log') is not None:
-            self.env.data_log.update({k:v for k,v in self.log.items() if 'cum' not in k})
-        done,idx = False,0
-        # perf = 0
-        while not done and idx < y.shape[0]:
-            if self.args.prediction['no_runoff']:
-                for node,ri in zip(self.env.elements['nodes'],self.runoff_rate[idx]):
-                    self.env.env._setNodeInflow(node,ri)
-            yi = y[idx]
-            # done = env.step([act if self.args.act.startswith('conti') else self.actions[i][act] for i,act in enumerate(yi)])
-            done = self.env.step(yi if self.args.act.startswith('conti') else self.actions[tuple(yi.astype(int))])
-            # perf += env.performance().sum()
-            idx += 1
-        return self.env.objective(idx).sum()
-    
     def pred_emu(self,y):
         y = y.reshape((-1,self.n_step,self.n_act))
         pop_size = y.shape[0]
@@ -223,27 +232,32 @@ class mpc_problem(Problem):
         objs = self.env.objective_pred(preds if self.emul.use_edge else [preds,None],[state,edge_state],settings).sum(axis=-1)
         return np.array([objs[i*self.stochastic:(i+1)*self.stochastic].mean() for i in range(pop_size)]) if self.stochastic else objs
         
+    def pred_hybrid(self,x):
+        # Screen the population with the emulator and verify the top-k with SWMM
+        f = self.pred_emu(x)
+        idx = np.argsort(f)[:min(self.hybrid,x.shape[0])]
+        fs = self.pred_simu(x[idx])
+        err = f[idx] - fs
+        corr = np.corrcoef(f[idx],fs)[0,1] if idx.shape[0] > 2 and fs.std() > 0 and f[idx].std() > 0 else np.nan
+        self.err_log.append([np.abs(err).mean(),err.mean(),np.abs(err/(np.abs(fs)+1e-6)).mean(),corr])
+        print('Emulator error: mae %.4f bias %.4f mape %.4f corr %.4f'%tuple(self.err_log[-1]))
+        # Unverified candidates are shifted by the emulator bias to stay comparable
+        F = f - err.mean()
+        F[idx] = fs
+        return F
+
     def _evaluate(self,x,out,*args,**kwargs):        
-        if hasattr(self,'emul'):
-            out['F'] = self.pred_emu(x)+1e-6
-        else:
-            pool = mp.Pool(self.args.processes)
-            res = [pool.apply_async(func=self.pred_simu,args=(xi,)) for xi in x]
-            pool.close()
-            pool.join()
-            F = [r.get() for r in res]
-            out['F'] = np.array(F)+1e-6
+        with profiler.timer('optimizer_generation'):
+            out['F'] = self.pred(x)
+        profiler.count('candidates',x.shape[0])
 
     def pred(self,x):
-        if hasattr(self,'emul'):
+        if hasattr(self,'emul') and self.hybrid:
+            return self.pred_hybrid(x)+1e-6
+        elif hasattr(self,'emul'):
             return self.pred_emu(x)+1e-6
         else:
-            pool = mp.Pool(self.args.processes)
-            res = [pool.apply_async(func=self.pred_simu,args=(xi,)) for xi in x]
-            pool.close()
-            pool.join()
-            F = [r.get() for r in res]
-            return np.array(F)+1e-6
+            return self.pred_simu(x)+1e-6
 
 class BestCallback(Callback):
 
@@ -321,62 +335,50 @@ def run_ea(prob,args,setting=None):
     # gc.collect()
     return ctrls.tolist(),vals
 
-# TODO: cross-entropy method
 def run_ce(prob,args,setting=None):
     print('Running cross entropy')
-    def sample_conti(mu,sig,n=1):
-        return np.array([truncnorm.rvs((prob.xl-mu)/sig,(prob.xu-mu)/sig)*sig+mu for _ in range(n)])
-    def sample_disc(pr,n=1):
-        pr = [np.array(pri)/np.sum(pri) for pri in pr]
-        return np.array([np.random.choice(np.arange(pri.shape[0]),p=pri,size=n) for pri in pr]).T
-    
-    # Initialize
-    if args.act.startswith('conti'):
-        mu,sig = np.random.uniform(low=prob.xl,high=prob.xu,size=prob.n_var),np.random.uniform(low=0.001,size=prob.n_var)
-    else:
-        pr = [np.random.uniform(low=0.001,size=int(xui)+1) for xui in prob.xu]
+    conti = args.act.startswith('conti') or isinstance(prob,mpc_problem_gr)
+    cem = CEM(prob.xl,prob.xu,args.pop_size,args.cross_entropy,
+              getattr(args,"ce_alpha",0.1),getattr(args,"ce_archive",0),discrete=not conti)
+    if args.use_current and setting is not None and conti:
+        cem.initialize(setting*prob.n_step)
 
     def if_terminate(item,vm,rec):
         if item == 'n_gen':
             return rec[0] >= vm
+        elif item == 'n_eval':
+            return rec[0]*args.pop_size >= vm
         elif item == 'obj':
-            return rec[1] <= vm  # TODO
+            return rec[1] <= vm
         elif item == 'time':
             return rec[2] >= vm
         
-    t0,rec,vals = time.time(),[0,1e6,time.time()],[]
+    t0,rec,vals = time.time(),[0,1e6,0],[]
     print('=======================================================')
-    print(' n_gen |     f_lam     |     f_min     |     g_min     ')
+    print(' n_gen |     f_avg     |     f_min     |     f_elite   ')
     print('=======================================================')
-    obj = np.random.uniform(size=(args.pop_size,))
     while not if_terminate(*args.termination,rec):
-        x = sample_conti(mu,sig,args.pop_size) if args.act.startswith('conti') else sample_disc(pr,args.pop_size)
-        obj = prob.pred(x)
+        with profiler.timer('optimizer_generation'):
+            x = cem.sample()
+            obj = prob.pred(x)
+            # formulate a new distribution with elites
+            f_elite = cem.update(x,obj)
+        profiler.count('candidates',x.shape[0])
         rec[0] += 1
-        if obj.min() < rec[1]:
-            ctrls = np.clip(x[obj.argmin()],prob.xl,prob.xu)
-            ctrls = ctrls.reshape((prob.n_step,prob.n_act))
-            if not args.act.startswith('conti'):
-                # ctrls = np.stack([np.vectorize(prob.actions[i].get)(ctrls[...,i]) for i in range(prob.n_act)],axis=-1)
-                ctrls = np.apply_along_axis(lambda x:prob.actions.get(tuple(x)),-1,ctrls)
-            ctrls = ctrls.tolist()
-        # formulate a new distribution with elites
-        rec[1] = min(obj.argsort()[int(args.pop_size*args.cross_entropy)],rec[1])
-        x_new = x[obj<=rec[1]]
-        if args.act.startswith('conti'):
-            mu,sig = x_new.mean(axis=0),x_new.std(axis=0)
-        else:
-            pr = [np.bincount(x_ni) for x_ni in x_new.T]
-        
+        rec[1] = cem.f_best
         rec[2] = time.time() - t0
         vals.append(obj.min())
         log = str(rec[0]).center(7)+'|'
         log += str(round(obj.mean(),4)).center(15)+'|'
         log += str(round(obj.min(),4)).center(15)+'|'
-        log += str(round(rec[1],4)).center(15)
+        log += str(round(f_elite,4)).center(15)
         print(log)
-    # print('Initial solution: ',sampling.reshape((-1,prob.n_step,prob.n_act)).tolist())
+    ctrls = np.clip(cem.x_best,prob.xl,prob.xu).reshape((prob.n_step,prob.n_act))
+    if not conti:
+        ctrls = np.apply_along_axis(lambda x:prob.actions.get(tuple(x)),-1,ctrls.astype(int))
+    ctrls = ctrls.tolist()
     print('Best solution: ',ctrls)
+    print('Throughput: %.1f candidates/s'%(rec[0]*args.pop_size/max(rec[2],1e-6)))
     return ctrls,vals
 
 class mpc_problem_gr:
@@ -423,6 +425,7 @@ class mpc_problem_gr:
 
     # TODO: distr.sample does not work in autograph
     # @tf.function
+    @timed('optimizer_generation')
     def pred_fit(self):
         # assert getattr(self,'y',None) is not None
         if self.stochastic:
@@ -458,6 +461,30 @@ class mpc_problem_gr:
         self.optimizer.apply_gradients(zip(grads,self.train_vars)) # How to regulate y in (xl,xu)
         return obj,grads
 
+    def pred(self,x):
+        # Forward-only objective of candidate controls for sampling-based optimizers (run_ce)
+        pop_size = x.shape[0]
+        if self.stochastic:
+            runoff = tf.cast(tf.tile(self.runoff,(pop_size,)+tuple([1 for _ in range(self.runoff.ndim-1)])),tf.float32)
+        else:
+            runoff = tf.cast(tf.repeat(tf.expand_dims(self.runoff,0),pop_size,axis=0),tf.float32)
+        state = tf.cast(tf.repeat(tf.expand_dims(self.state,0),pop_size*max(self.stochastic,1),axis=0),tf.float32)
+        edge_state = tf.cast(tf.repeat(tf.expand_dims(self.edge_state,0),pop_size*max(self.stochastic,1),axis=0),tf.float32) if self.edge_state is not None else None
+        settings = tf.reshape(tf.clip_by_value(x,self.xl,self.xu),(-1,self.n_step,self.n_act))
+        settings = tf.cast(tf.repeat(settings,self.r_step,axis=1),tf.float32)
+        if settings.shape[1] < self.eval_hrz // self.step:
+            settings = tf.concat([settings,tf.repeat(settings[:,-1:,:],self.eval_hrz // self.step-settings.shape[1],axis=1)],axis=1)
+        if self.stochastic:
+            settings = tf.repeat(settings,self.stochastic,axis=0)
+        preds = self.emul.predict_tf(state,runoff,settings,edge_state)
+        env = get_env(self.args.env)(initialize=False)
+        obj = env.objective_pred_tf(preds if self.emul.use_edge else [preds,None],[state,edge_state],settings)
+        obj = tf.reduce_sum(obj,axis=-1) if len(obj.shape) > 1 else obj
+        if self.stochastic:
+            obj = tf.reshape(obj,(pop_size,self.stochastic))
+            obj = tf.reduce_mean(obj,axis=1)
+        return obj.numpy()+1e-6
+
 def run_gr(prob,args,setting=None):
     print('Running gradient inversion')
     # prob = mpc_problem_gr(args,margs)
@@ -503,26 +530,146 @@ def run_gr(prob,args,setting=None):
     return ctrls,vals
 
 
-if __name__ == '__main__':
-    args,config = parser(os.path.join(HERE,'utils','mpc.yaml'))
-    # mp.set_start_method('spawn', force=True)    # use gpu in multiprocessing
-    ctx = mp.get_context("spawn")
-    # de = {'env':'astlingen',
-    #       'act':'rand3',
-    #       'processes':5,
-    #       'pop_size':128,
-    #       'sampling':0.4,
-    #       'learning_rate':0.1,
-    #       'termination':['n_gen',200],
-    #       'surrogate':True,
-    #       'gradient':True,
-    #       'rain_dir':'./envs/config/ast_test5_events.csv',
-    #       'model_dir':'./model/astlingen/30s_20k_3act_1000ledgef_res_norm_flood_gat_2tcn',
-    #       'result_dir':'./results/astlingen/30s_20k_3actgmpc_1000ledgef_res_norm_flood_gat_2tcn'}
-    # config['rain_dir'] = de['rain_dir']
-    # for k,v in de.items():
-    #     setattr(args,k,v)
+def run_event(env,event,args,margs=None):
+    item = 'emul' if args.surrogate else 'simu'
+    name = os.path.basename(event).strip('.inp')
+    t0 = time.time()
+    horizon = args.prediction['eval_horizon']//args.interval
+    if args.surrogate:
+        cache = RunoffCache(os.path.join('./envs/data/',args.env,'runoff'),args.interval,tide=args.tide)
+        ts,runoff = cache.get(env,event,horizon)
+        tss = TimeIndex(ts)
+    if (not args.surrogate or args.hybrid) and args.prediction['no_runoff']:
+        # runoff rates fed into the evaluation simulations
+        rcache = RunoffCache(os.path.join('./envs/data/',args.env,'runoff'),args.interval,rate=True)
+        rts,runoff_rate = rcache.get(env,event,horizon)
+        rtss = TimeIndex(rts)
+
+
+    t1 = time.time()
+    print('Runoff time: {} s'.format(t1-t0))
+    opt_times = []
+    state = env.reset(event,global_state=True,seq=margs.seq_in if args.surrogate else False)
+    if args.surrogate and margs.if_flood:
+        flood = env.flood(seq=margs.seq_in)
+    states = [state[-1] if args.surrogate else state]
+    perfs,objects = [env.flood()],[env.objective()]
+
+    edge_state = env.state_full(typ='links',seq=margs.seq_in if args.surrogate else False)
+    edge_states = [edge_state[-1] if args.surrogate else edge_state]
+    
+    # setting = [1 for _ in args.action_space]
+    setting = env.controller('default')
+    if args.keep != 'False':
+        setting = env.controller(args.keep,states[0],setting)
+    settings = [setting]
+
+    if args.surrogate and args.gradient:
+        prob = mpc_problem_gr(args,margs)
+    else:
+        prob = mpc_problem(args,margs=margs if args.surrogate else None)
+
+    done,i,valss = False,0,[]
+    while not done:
+        if i*args.interval % args.control_interval == 0:
+            t2 = time.time()
+            if args.surrogate:
+                state[...,1] = state[...,1] - state[...,-1]
+                if margs.if_flood:
+                    f = (flood>0).astype(float)
+                    # f = np.eye(2)[f].squeeze(-2)
+                    state = np.concatenate([state[...,:-1],f,state[...,-1:]],axis=-1)
+                t = env.env.methods['simulation_time']()
+                r = runoff[tss.asof(t)]
+                if args.error > 0:
+                    std = np.array([ri*args.error*i/r.shape[0] for i,ri in enumerate(r)])
+                    if args.stochastic:
+                        err = np.array([np.random.uniform(-std,std) for _ in range(args.stochastic)])
+                        r = np.abs(np.tile(r,(args.stochastic,)+tuple([1 for _ in range(r.ndim)])) + err)
+                    else:
+                        r = r + np.random.uniform(-std,std)
+                # margs.state = state
+                # margs.runoff = r
+                # if margs.use_edge:
+                    # margs.edge_state = edge_state
+                prob.load_state(state,r,edge_state if margs.use_edge else None)
+                if args.hybrid:
+                    eval_file = env.get_eval_file(args.prediction['no_runoff'])
+                    rr = runoff_rate[rtss.asof(t),...,0] if args.prediction['no_runoff'] else None
+                    prob.load_file(eval_file,env.data_log,rr)
+                if args.gradient and not (args.cross_entropy and getattr(args,'ce_forward',False)):
+                    setting,vals = run_gr(prob,args,setting=setting)
+                elif args.cross_entropy:
+                    # mpc_problem_gr.pred with --gradient, mpc_problem.pred otherwise
+                    setting,vals = run_ce(prob,args,setting=setting)
+                else:
+                    setting,vals = run_ea(prob,args,setting=setting)
+            else:
+                eval_file = env.get_eval_file(args.prediction['no_runoff'])
+                if args.prediction['no_runoff']:
+                    t = env.env.methods['simulation_time']()
+                    rr = runoff_rate[rtss.asof(t),...,0]
+                prob.load_file(eval_file,env.data_log,rr if args.prediction['no_runoff'] else None)
+                if args.cross_entropy:
+                    setting,vals = run_ce(prob,args,setting=setting)
+                else:
+                    setting,vals = run_ea(prob,args,setting=setting)
+            valss.append(vals)
+            t3 = time.time()
+            print('Optimization time: {} s'.format(t3-t2))
+            opt_times.append(t3-t2)
+            # Only used to keep the same condition to test internal model efficiency
+            # setting = [env.controller(mode='bc')
+            #             for _ in range(args.prediction['control_horizon']//args.setting_duration)]
+            j = 0
+            sett = env.controller('safe',state[-1] if args.surrogate else state,setting[j]) if args.keep == 'False' else settings[0]
+        elif i*args.interval % args.setting_duration == 0:
+            j += 1
+            sett = env.controller('safe',state[-1] if args.surrogate else state,setting[j]) if args.keep == 'False' else settings[0]
+        with profiler.timer('swmm_step'):
+            done = env.step(sett)
+        with profiler.timer('state_readout'):
+            state = env.state_full(seq=margs.seq_in if args.surrogate else False)
+            if args.surrogate and margs.if_flood:
+                flood = env.flood(seq=margs.seq_in)
+            edge_state = env.state_full(margs.seq_in if args.surrogate else False,'links')
+        states.append(state[-1] if args.surrogate else state)
+        perfs.append(env.flood())
+        objects.append(env.objective())
+        edge_states.append(edge_state[-1] if args.surrogate else edge_state)
+        settings.append(sett)
+        i += 1
+        print('Simulation time: %s'%env.data_log['simulation_time'][-1])            
+    
+    np.save(os.path.join(args.result_dir,name + '_%s_state.npy'%item),np.stack(states))
+    np.save(os.path.join(args.result_dir,name + '_%s_perf.npy'%item),np.stack(perfs))
+    np.save(os.path.join(args.result_dir,name + '_%s_object.npy'%item),np.array(objects))
+    np.save(os.path.join(args.result_dir,name + '_%s_settings.npy'%item),np.array(settings))
+    np.save(os.path.join(args.result_dir,name + '_%s_edge_states.npy'%item),np.stack(edge_states))
+    np.save(os.path.join(args.result_dir,name + '_%s_vals.npy'%item),np.array(valss))
+    if getattr(prob,'err_log',[]):
+        np.save(os.path.join(args.result_dir,name + '_%s_emul_err.npy'%item),np.array(prob.err_log))
+    if hasattr(prob,'close'):
+        prob.close()
+    return [t1-t0,np.mean(opt_times),np.stack(perfs).sum(),np.stack(objects).sum()],opt_times
+
+def get_margs(env,args):
+    hyps = yaml.load(open(os.path.join(HERE,'utils','config.yaml'),'r'),yaml.FullLoader)
+    margs = argparse.Namespace(**hyps[args.env])
+    margs.model_dir = args.model_dir
+    known_hyps = yaml.load(open(os.path.join(margs.model_dir,'parser.yaml'),'r'),yaml.FullLoader)
+    for k,v in known_hyps.items():
+        if k == 'model_dir':
+            continue
+        setattr(margs,k,v)
+    setattr(margs,'epsilon',args.epsilon)
+    env_args = env.get_args(margs.directed,margs.length,margs.order)
+    for k,v in env_args.items():
+        setattr(margs,k,v)
+    margs.use_edge = margs.use_edge or margs.edge_fusion
+    return margs
 
+def setup(args,config):
     env = get_env(args.env)()
     env_args = env.get_args(args.directed,args.length,args.order,args.act)
     for k,v in env_args.items():
@@ -541,23 +688,36 @@ if __name__ == '__main__':
         rain_arg['rain_num'] = args.rain_num
     events = get_inp_files(env.config['swmm_input'],rain_arg)
 
+    margs = None
     if args.surrogate:
-        hyps = yaml.load(open(os.path.join(HERE,'utils','config.yaml'),'r'),yaml.FullLoader)
-        margs = argparse.Namespace(**hyps[args.env])
-        margs.model_dir = args.model_dir
-        known_hyps = yaml.load(open(os.path.join(margs.model_dir,'parser.yaml'),'r'),yaml.FullLoader)
-        for k,v in known_hyps.items():
-            if k == 'model_dir':
-                continue
-            setattr(margs,k,v)
-        setattr(margs,'epsilon',args.epsilon)
-        env_args = env.get_args(margs.directed,margs.length,margs.order)
-        for k,v in env_args.items():
-            setattr(margs,k,v)
-        margs.use_edge = margs.use_edge or margs.edge_fusion
+        margs = get_margs(env,args)
         args.prediction['eval_horizon'] = args.prediction['control_horizon'] = margs.seq_out * args.interval
     else:
         args.prediction['eval_horizon'] = args.prediction['control_horizon'] = args.horizon * args.interval
+    return env,events,margs
+
+if __name__ == '__main__':
+    args,config = parser(os.path.join(HERE,'utils','mpc.yaml'))
+    profiler.enable(args.profile)
+    # mp.set_start_method('spawn', force=True)    # use gpu in multiprocessing
+    ctx = mp.get_context("spawn")
+    # de = {'env':'astlingen',
+    #       'act':'rand3',
+    #       'processes':5,
+    #       'pop_size':128,
+    #       'sampling':0.4,
+    #       'learning_rate':0.1,
+    #       'termination':['n_gen',200],
+    #       'surrogate':True,
+    #       'gradient':True,
+    #       'rain_dir':'./envs/config/ast_test5_events.csv',
+    #       'model_dir':'./model/astlingen/30s_20k_3act_1000ledgef_res_norm_flood_gat_2tcn',
+    #       'result_dir':'./results/astlingen/30s_20k_3actgmpc_1000ledgef_res_norm_flood_gat_2tcn'}
+    # config['rain_dir'] = de['rain_dir']
+    # for k,v in de.items():
+    #     setattr(args,k,v)
+
+    env,events,margs = setup(args,config)
 
     if not os.path.exists(args.result_dir):
         os.mkdir(args.result_dir)
@@ -570,118 +730,6 @@ if __name__ == '__main__':
         name = os.path.basename(event).strip('.inp')
         if os.path.exists(os.path.join(args.result_dir,name + '_%s_state.npy'%item)):
             continue
-        t0 = time.time()
-        if args.surrogate:
-            ts,runoff = get_runoff(env,event,tide=args.tide)
-            tss = pd.DataFrame.from_dict({'Time':ts,'Index':np.arange(len(ts))}).set_index('Time')
-            tss.index = pd.to_datetime(tss.index)
-            horizon = args.prediction['eval_horizon']//args.interval
-            runoff = np.stack([np.concatenate([runoff[idx:idx+horizon],np.tile(np.zeros_like(s),(max(idx+horizon-runoff.shape[0],0),)+tuple(1 for _ in s.shape))],axis=0)
-                                for idx,s in enumerate(runoff)])
-        elif args.prediction['no_runoff']:
-            ts,runoff_rate = get_runoff(env,event,True)
-            tss = pd.DataFrame.from_dict({'Time':ts,'Index':np.arange(len(ts))}).set_index('Time')
-            tss.index = pd.to_datetime(tss.index)
-            horizon = args.prediction['eval_horizon']//args.interval
-            runoff_rate = np.stack([np.concatenate([runoff_rate[idx:idx+horizon],np.tile(np.zeros_like(s),(max(idx+horizon-runoff_rate.shape[0],0),)+tuple(1 for _ in s.shape))],axis=0)
-                                for idx,s in enumerate(runoff_rate)])
-
-
-        t1 = time.time()
-        print('Runoff time: {} s'.format(t1-t0))
-        opt_times = []
-        state = env.reset(event,global_state=True,seq=margs.seq_in if args.surrogate else False)
-        if args.surrogate and margs.if_flood:
-            flood = env.flood(seq=margs.seq_in)
-        states = [state[-1] if args.surrogate else state]
-        perfs,objects = [env.flood()],[env.objective()]
-
-        edge_state = env.state_full(typ='links',seq=margs.seq_in if args.surrogate else False)
-        edge_states = [edge_state[-1] if args.surrogate else edge_state]
-        
-        # setting = [1 for _ in args.action_space]
-        setting = env.controller('default')
-        if args.keep != 'False':
-            setting = env.controller(args.keep,states[0],setting)
-        settings = [setting]
-
-        if args.surrogate and args.gradient:
-            prob = mpc_problem_gr(args,margs)
-        else:
-            prob = mpc_problem(args,margs=margs if args.surrogate else None)
-
-        done,i,valss = False,0,[]
-        while not done:
-            if i*args.interval % args.control_interval == 0:
-                t2 = time.time()
-                if args.surrogate:
-                    state[...,1] = state[...,1] - state[...,-1]
-                    if margs.if_flood:
-                        f = (flood>0).astype(float)
-                        # f = np.eye(2)[f].squeeze(-2)
-                        state = np.concatenate([state[...,:-1],f,state[...,-1:]],axis=-1)
-                    t = env.env.methods['simulation_time']()
-                    r = runoff[int(tss.asof(t)['Index'])]
-                    if args.error > 0:
-                        std = np.array([ri*args.error*i/r.shape[0] for i,ri in enumerate(r)])
-                        if args.stochastic:
-                            err = np.array([np.random.uniform(-std,std) for _ in range(args.stochastic)])
-                            r = np.abs(np.tile(r,(args.stochastic,)+tuple([1 for _ in range(r.ndim)])) + err)
-                        else:
-                            r += np.random.uniform(-std,std)
-                    # margs.state = state
-                    # margs.runoff = r
-                    # if margs.use_edge:
-                        # margs.edge_state = edge_state
-                    prob.load_state(state,r,edge_state if margs.use_edge else None)
-                    if args.gradient:
-                        setting,vals = run_gr(prob,args,setting=setting)
-                    elif args.cross_entropy:
-                        setting,vals = run_ce(prob,args,setting=setting)
-                    else:
-                        setting,vals = run_ea(prob,args,setting=setting)
-                else:
-                    eval_file = env.get_eval_file(args.prediction['no_runoff'])
-                    if args.prediction['no_runoff']:
-                        t = env.env.methods['simulation_time']()
-                        rr = runoff_rate[int(tss.asof(t)['Index']),...,0]
-                    prob.load_file(eval_file,env.data_log,rr if args.prediction['no_runoff'] else None)
-                    if args.cross_entropy:
-                        setting,vals = run_ce(prob,args,setting=setting)
-                    else:
-                        setting,vals = run_ea(prob,args,setting=setting)
-                valss.append(vals)
-                t3 = time.time()
-                print('Optimization time: {} s'.format(t3-t2))
-                opt_times.append(t3-t2)
-                # Only used to keep the same condition to test internal model efficiency
-                # setting = [env.controller(mode='bc')
-                #             for _ in range(args.prediction['control_horizon']//args.setting_duration)]
-                j = 0
-                sett = env.controller('safe',state[-1] if args.surrogate else state,setting[j]) if args.keep == 'False' else settings[0]
-            elif i*args.interval % args.setting_duration == 0:
-                j += 1
-                sett = env.controller('safe',state[-1] if args.surrogate else state,setting[j]) if args.keep == 'False' else settings[0]
-            done = env.step(sett)
-            state = env.state_full(seq=margs.seq_in if args.surrogate else False)
-            if args.surrogate and margs.if_flood:
-                flood = env.flood(seq=margs.seq_in)
-            edge_state = env.state_full(margs.seq_in if args.surrogate else False,'links')
-            states.append(state[-1] if args.surrogate else state)
-            perfs.append(env.flood())
-            objects.append(env.objective())
-            edge_states.append(edge_state[-1] if args.surrogate else edge_state)
-            settings.append(sett)
-            i += 1
-            print('Simulation time: %s'%env.data_log['simulation_time'][-1])            
-        
-        np.save(os.path.join(args.result_dir,name + '_%s_state.npy'%item),np.stack(states))
-        np.save(os.path.join(args.result_dir,name + '_%s_perf.npy'%item),np.stack(perfs))
-        np.save(os.path.join(args.result_dir,name + '_%s_object.npy'%item),np.array(objects))
-        np.save(os.path.join(args.result_dir,name + '_%s_settings.npy'%item),np.array(settings))
-        np.save(os.path.join(args.result_dir,name + '_%s_edge_states.npy'%item),np.stack(edge_states))
-        np.save(os.path.join(args.result_dir,name + '_%s_vals.npy'%item),np.array(valss))
-
-        results.loc[name] = [t1-t0,np.mean(opt_times),np.stack(perfs).sum(),np.stack(objects).sum()]
+        results.loc[name],_ = run_event(env,event,args,margs)
     results.to_csv(os.path.join(args.result_dir,'results_%s.csv'%item))
-
+    profiler.export(os.path.join(args.result_dir,'profile'))
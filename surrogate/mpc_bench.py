@@ -0,0 +1,102 @@
+from mpc import parser,setup,run_event
+from envs import get_env
+import pandas as pd
+import numpy as np
+import multiprocessing as mp
+import os,time,yaml,queue,traceback
+HERE = os.path.dirname(__file__)
+COLUMNS = ['rr time','fl time','perf','objective']
+
+# Closed-loop MPC over the test events with one scenario (and emulator) per worker process.
+# Workers are plain processes instead of a Pool as the simulation-based
+# mpc_problem opens its own Pool and daemonic workers cannot have children.
+
+def worker(args,margs,tasks,outs):
+    env = get_env(args.env)()
+    while True:
+        event = tasks.get()
+        if event is None:
+            break
+        name = os.path.basename(event).strip('.inp')
+        try:
+            res,opt_times = run_event(env,event,args,margs)
+            outs.put((name,res,opt_times))
+        except Exception:
+            err = traceback.format_exc()
+            print('Event %s failed:\n%s'%(name,err))
+            # the traceback goes back in place of the timings
+            outs.put((name,None,err))
+
+def get_histogram(times,bins=20):
+    edges = np.histogram_bin_edges(np.concatenate(list(times.values())),bins=bins)
+    hist = pd.DataFrame({name:np.histogram(t,bins=edges)[0] for name,t in times.items()}).T
+    hist.columns = ['%.2f-%.2f'%(l,r) for l,r in zip(edges[:-1],edges[1:])]
+    return hist
+
+if __name__ == '__main__':
+    args,config = parser(os.path.join(HERE,'utils','mpc.yaml'))
+    ctx = mp.get_context("spawn")
+    env,events,margs = setup(args,config)
+
+    if not os.path.exists(args.result_dir):
+        os.mkdir(args.result_dir)
+    yaml.dump(data=config,stream=open(os.path.join(args.result_dir,'parser.yaml'),'w'))
+
+    item = 'emul' if args.surrogate else 'simu'
+    res_file = os.path.join(args.result_dir,'results_%s.csv'%item)
+    if os.path.exists(res_file):
+        results = pd.read_csv(res_file,index_col=0,keep_default_na=False,na_values={c:[''] for c in COLUMNS})
+        if 'error' not in results:
+            results['error'] = ''
+    else:
+        results = pd.DataFrame(columns=COLUMNS+['error'])
+    names = [os.path.basename(event).strip('.inp') for event in events]
+    todo = [event for event,name in zip(events,names)
+            if not os.path.exists(os.path.join(args.result_dir,name + '_%s_state.npy'%item))]
+    print('Events: %s done, %s to run on %s workers'%(len(events)-len(todo),len(todo),args.workers))
+
+    tasks,outs = ctx.Queue(),ctx.Queue()
+    for event in todo:
+        tasks.put(event)
+    n_workers = max(min(args.workers,len(todo)),0)
+    for _ in range(n_workers):
+        tasks.put(None)
+    workers = [ctx.Process(target=worker,args=(args,margs,tasks,outs)) for _ in range(n_workers)]
+    for w in workers:
+        w.start()
+
+    t0 = time.time()
+    n_done = 0
+    while n_done < len(todo):
+        try:
+            name,res,opt_times = outs.get(timeout=60)
+        except queue.Empty:
+            if not any([w.is_alive() for w in workers]):
+                print('All workers exited with %s events left'%(len(todo)-n_done))
+                break
+            continue
+        n_done += 1
+        if res is None:
+            # failed events stay in the csv (last traceback line) and are rerun next time
+            results.loc[name,COLUMNS] = np.nan
+            results.loc[name,'error'] = opt_times.strip().splitlines()[-1]
+            results.to_csv(res_file)
+            print('Event %s failed (%s/%s)'%(name,n_done,len(todo)))
+            continue
+        results.loc[name,COLUMNS] = res
+        results.loc[name,'error'] = ''
+        np.save(os.path.join(args.result_dir,name + '_%s_times.npy'%item),np.array(opt_times))
+        results.to_csv(res_file)
+        print('Event %s finished (%s/%s) in %.2f s'%(name,n_done,len(todo),time.time()-t0))
+    for w in workers:
+        w.join()
+
+    times = {name:np.load(os.path.join(args.result_dir,name + '_%s_times.npy'%item)) for name in names
+             if os.path.exists(os.path.join(args.result_dir,name + '_%s_times.npy'%item))}
+    if len(times) > 0:
+        get_histogram(times).to_csv(os.path.join(args.result_dir,'timing_%s.csv'%item))
+    print('Wall time: %.2f s'%(time.time()-t0))
+    failed = results.index[results['error'] != '']
+    if len(failed) > 0:
+        print('Failed events: %s'%', '.join(failed))
+    print(results[COLUMNS].astype(float).describe())
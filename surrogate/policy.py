@@ -10,10 +10,10 @@ tf.config.list_physical_devices(device_type='GPU')
 from dataloader import DataGenerator
 from emulator import Emulator
 from agent import Actor
-from mpc import get_runoff
+from utils.runoff import RunoffCache,TimeIndex
 from envs import get_env
 from utils.utilities import get_inp_files
-from utils.memory import RandomMemory
+from utils.memory import ArrayMemory
 from functools import reduce
 import pandas as pd
 import argparse,time
@@ -57,6 +57,8 @@ def parser(config=None):
     parser.add_argument('--save_gap',type=int,default=100,help='save the agent per gap')
     parser.add_argument('--agent_dir',type=str,default='./agent/',help='path of the agent')
     parser.add_argument('--load_agent',action="store_true",help='if load agents')
+    parser.add_argument('--memory',type=int,default=0,help='capacity 2^n of the replay memory of evaluation transitions, 0 is off')
+    parser.add_argument('--mmap',action="store_true",help='if back the replay memory with memmaps in agent_dir/memory')
 
     # testing scenario args
     parser.add_argument('--test',action="store_true",help='if test')
@@ -82,7 +84,7 @@ def parser(config=None):
     print('Policy configs: {}'.format(args))
     return args,config
 
-def interact_steps(env,args,event,runoff,ctrl=None,train=False):
+def interact_steps(env,args,event,runoff,ctrl=None,train=False,trajs=False):
     # with tf.device('/cpu:0'):
     if ctrl is None:
         args.load_agent = True
@@ -99,6 +101,8 @@ def interact_steps(env,args,event,runoff,ctrl=None,train=False):
     setting = env.controller('default')
     settings = [setting]
     done,i = False,0
+    # transitions (state,setting,reward,next_state,done) between control steps
+    transitions,traj = [],None
     while not done:
         if i*args.interval % args.control_interval == 0:
             state[...,1] = state[...,1] - state[...,-1]
@@ -107,10 +111,13 @@ def interact_steps(env,args,event,runoff,ctrl=None,train=False):
                 # f = np.eye(2)[f].squeeze(-2)
                 state = np.concatenate([state[...,:-1],f,state[...,-1:]],axis=-1)
             t = env.env.methods['simulation_time']()
-            b = runoff[int(tss.asof(t)['Index'])]
-            # traj = [state]
+            b = runoff[tss.asof(t)]
             setting = ctrl.control([state,b,edge_state if args.use_edge else None],train)
             setting = setting.astype(np.float32).tolist()
+            if trajs:
+                if traj is not None:
+                    transitions.append(traj + [-sum(objects[k:]),state,False])
+                traj,k = [state,np.array(setting,np.float32)],len(objects)
             # if on_policy:
             #     action,log_probs = action
             j = 0
@@ -141,6 +148,15 @@ def interact_steps(env,args,event,runoff,ctrl=None,train=False):
     #     print('Training Score at event {0}: {1}'.format(os.path.basename(event),perf))
     # else:
     #     print('Evaluation Score at event {0}: {1}'.format(os.path.basename(event),perf))
+    if trajs:
+        if traj is not None:
+            # final state preprocessed as at a control step
+            state = state.copy()
+            state[...,1] = state[...,1] - state[...,-1]
+            if args.if_flood:
+                state = np.concatenate([state[...,:-1],(flood>0).astype(float),state[...,-1:]],axis=-1)
+            transitions.append(traj + [-sum(objects[k:]),state,True])
+        return [np.array(dat) for dat in [states,edge_states,settings,perfs,objects]] + [transitions]
     return [np.array(dat) for dat in [states,edge_states,settings,perfs,objects]]
 
 
@@ -186,21 +202,12 @@ if __name__ == '__main__':
     if 'rain_num' in config:
         rain_arg['rain_num'] = args.rain_num
     events = get_inp_files(env.config['swmm_input'],rain_arg)
-    pool = mp.Pool(args.processes)
-    res = [pool.apply_async(func=get_runoff,args=(env,event,False,args.tide,))
-     for event in events]
-    pool.close()
-    pool.join()
-    res = [r.get() for r in res]
+    cache = RunoffCache(os.path.join('./envs/data/',args.env,'runoff'),args.interval,tide=args.tide)
+    cache.compute(env,events,args.processes)
     runoffs = []
-    for ts,runoff in res:
-        # Use mp to get runoff
-        # ts,runoff = get_runoff(env,event,tide=args.tide)
-        tss = pd.DataFrame.from_dict({'Time':ts,'Index':np.arange(len(ts))}).set_index('Time')
-        tss.index = pd.to_datetime(tss.index)
-        horizon = args.prediction['eval_horizon']//args.interval
-        runoff = np.stack([np.concatenate([runoff[idx:idx+horizon],np.tile(np.zeros_like(s),(max(idx+horizon-runoff.shape[0],0),)+tuple(1 for _ in s.shape))],axis=0)
-                            for idx,s in enumerate(runoff)])
+    for event in events:
+        ts,runoff = cache.get(env,event,args.prediction['eval_horizon']//args.interval)
+        tss = TimeIndex(ts)
         runoffs.append([tss,runoff])
     print("Finish runoff")
 
@@ -231,6 +238,14 @@ if __name__ == '__main__':
         ctrl = Actor(args.action_shape,args.observ_space,args,act_only=False,margs=margs)
         ctrl.set_norm(*dG.get_norm())
         yaml.dump(data=config,stream=open(os.path.join(args.agent_dir,'parser.yaml'),'w'))
+        memory = None
+        if args.memory > 0:
+            # Replay memory of the evaluation transitions
+            memory_dir = os.path.join(args.agent_dir,'memory')
+            if not os.path.exists(memory_dir):
+                os.mkdir(memory_dir)
+            load = args.load_agent and os.path.exists(os.path.join(memory_dir,'experience_state.npy'))
+            memory = ArrayMemory(2**args.memory,memory_dir,load=load,mmap=args.mmap)
 
         seq = max(args.seq_in,args.seq_out) if args.recurrent else 0
         n_events = int(max(dG.event_id))+1
@@ -258,11 +273,14 @@ if __name__ == '__main__':
             if episode % args.eval_gap == 0:
                 ctrl.save()
                 pool = mp.Pool(args.processes)
-                res = [pool.apply_async(func=interact_steps,args=(env,args,event,runoff,))
+                res = [pool.apply_async(func=interact_steps,args=(env,args,event,runoff,None,False,memory is not None,))
                  for event,runoff in zip(events,runoffs)]
                 pool.close()
                 pool.join()
                 res = [r.get() for r in res]
+                if memory is not None:
+                    for r in res:
+                        memory.update(r.pop(-1))
                 # res = [interact_steps(env,args,event,runoff,ctrl)
                 #         for event,runoff in zip(events,runoffs)]
                 test_objs = np.array([r[-1].sum() for r in res]).sum()
@@ -278,6 +296,8 @@ if __name__ == '__main__':
                 ctrl.save(os.path.join(args.agent_dir,'%s'%episode))
         
         ctrl.save(args.agent_dir)
+        if memory is not None:
+            memory.save()
         np.save(os.path.join(args.agent_dir,'train_id.npy'),np.array(train_ids))
         np.save(os.path.join(args.agent_dir,'test_id.npy'),np.array(test_ids))
         np.save(os.path.join(args.agent_dir,'train_loss.npy'),np.array(train_losses))
@@ -0,0 +1,100 @@
+import numpy as np
+import os,time
+os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
+import tensorflow as tf
+from utils.observ import ObsSpec
+
+class RolloutEngine:
+    """
+    Compiled model-based rollout of the agent in the emulator.
+
+    Observations come from a precomputed ObsSpec, the control steps run in a
+    tf.while_loop, and the graph is traced once with a free batch dimension.
+
+    Parameters
+    ----------
+    ctrl : agent
+        agent with normalize, control and conv.
+    emul : Emulator
+        emulator with predict_tf, get_edge_action, if_flood and use_edge.
+    args : argparse.Namespace
+        mbrl arguments (horizon, setting_duration, interval, seq_in, attrs, elements, states, use_pred).
+    """
+    def __init__(self,ctrl,emul,args):
+        self.ctrl,self.emul = ctrl,emul
+        self.n_step = args.horizon//args.setting_duration
+        self.r_step = args.setting_duration//args.interval
+        self.seq_in = args.seq_in
+        self.obs_spec = ObsSpec(args,ctrl.conv)
+        self.func = None
+
+    def observe(self,x,bi,ex,ri):
+        ctrl = self.ctrl
+        x_norm,b_norm,e_norm = [ctrl.normalize(dat,item) if dat is not None else None
+                                for dat,item in zip([x,bi,ex],'xbe')]
+        r_norm = ctrl.normalize(ri,'r') if not ctrl.conv else None
+        return self.obs_spec(x_norm,b_norm,e_norm,r_norm,batch=True)
+
+    def build(self,x,a,b,y,r,ex=None):
+        emul = self.emul
+        n_step,r_step,seq_in = self.n_step,self.r_step,self.seq_in
+        use_edge = ex is not None
+        def to_steps(dat):
+            # (batch,n_step*r_step,...) -> (n_step,batch,r_step,...)
+            rest = list(dat.shape[2:])
+            dat = tf.reshape(dat[:,:n_step*r_step,...],[-1,n_step,r_step]+rest)
+            return tf.transpose(dat,[1,0]+list(range(2,len(rest)+3)))
+        def from_steps(ta):
+            # (n_step,batch,r_step,...) -> (batch,n_step*r_step,...)
+            dat = ta.stack()
+            rest = list(dat.shape[3:])
+            dat = tf.transpose(dat,[1,0]+list(range(2,len(rest)+3)))
+            return tf.reshape(dat,[-1,n_step*r_step]+rest)
+
+        def run(x,a,b,y,r,ex=None):
+            bs,rs = to_steps(b),to_steps(r)
+            tas = [tf.TensorArray(tf.float32,size=n_step) for _ in range(4 if use_edge else 3)]
+            def body(i,x,ex,*tas):
+                bi,ri = bs[i],rs[i]
+                setting = self.ctrl.control(self.observe(x,bi,ex if use_edge else None,ri),train=True,batch=True)
+                setting = tf.repeat(setting[:,tf.newaxis,:],r_step,axis=1)
+                preds = emul.predict_tf(x,bi,setting,ex if use_edge else None)
+                if emul.if_flood:
+                    x = tf.concat([preds[0][...,:-2],tf.cast(preds[0][...,-2:-1]>0.5,tf.float32),bi],axis=-1)
+                else:
+                    x = tf.concat([preds[0][...,:-1],bi],axis=-1)
+                tas = [tas[0].write(i,x),tas[1].write(i,setting),tas[2].write(i,preds[0][...,-1:])] + list(tas[3:])
+                if use_edge:
+                    ex = tf.concat([preds[1],emul.get_edge_action(setting,True)],axis=-1)
+                    tas[3] = tas[3].write(i,ex)
+                return [i+1,x,ex]+tas
+            ex0 = ex if use_edge else tf.zeros((0,))
+            out = tf.while_loop(lambda i,*_:i<n_step,body,[tf.constant(0),x,ex0]+tas)
+            xs,settings,perfs = [from_steps(ta) for ta in out[3:6]]
+            xs = tf.concat([x,xs],axis=1)
+            settings = tf.concat([a[:,:seq_in,:],settings],axis=1)
+            perfs = tf.concat([y[:,:seq_in,:,-1:],perfs],axis=1)
+            exs = tf.concat([ex,from_steps(out[6])],axis=1) if use_edge else None
+            return xs,exs,settings,perfs,r
+
+        specs = [tf.TensorSpec((None,)+tuple(dat.shape[1:]),tf.float32) for dat in [x,a,b,y,r]]
+        specs += [tf.TensorSpec((None,)+tuple(ex.shape[1:]),tf.float32)] if use_edge else []
+        self.func = tf.function(run,input_signature=specs)
+
+    def __call__(self,dats):
+        x,a,b,y,rx,ry = dats[:6]
+        ex = dats[6] if len(dats) > 6 and self.emul.use_edge else None
+        r = np.concatenate([rx,ry],axis=1)
+        inps = [x,a,b,y,r] + ([ex] if ex is not None else [])
+        if self.func is None:
+            self.build(*inps)
+        return self.func(*[tf.convert_to_tensor(dat,tf.float32) for dat in inps])
+
+    def benchmark(self,dats,iters=10):
+        _ = self(dats)
+        t0 = time.time()
+        for _ in range(iters):
+            _ = self(dats)
+        rate = iters*dats[0].shape[0]/(time.time()-t0)
+        print('Rollouts: %.1f /s (%s steps each)'%(rate,self.n_step))
+        return rate
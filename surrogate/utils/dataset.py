@@ -0,0 +1,131 @@
+import os,json
+import numpy as np
+
+# ------ Sharded dataset  ----------------------------------------------------
+# data_dir/index.json + data_dir/shard_*.npz (zlib, np.savez_compressed).
+# Each shard holds the rows of whole event runs, the index gives (event, shard, start, end)
+# of every contiguous run so that a subset of events only decompresses its own shards.
+INDEX = 'index.json'
+
+def event_runs(event_id):
+    # Contiguous runs of event_id as (event, start, end) rows
+    event_id = np.asarray(event_id)
+    if event_id.shape[0] == 0:
+        return np.zeros((0,3),np.int64)
+    brk = np.where(np.diff(event_id) != 0)[0]+1
+    start = np.concatenate([[0],brk])
+    end = np.concatenate([brk,[event_id.shape[0]]])
+    return np.stack([event_id[start].astype(np.int64),start,end],axis=1)
+
+def clear_shards(data_dir):
+    # Remove index.json and every shard so that a dir holds one format only
+    if not os.path.isdir(data_dir):
+        return
+    for f in os.listdir(data_dir):
+        if f == INDEX or (f.startswith('shard_') and f.endswith('.npz')):
+            os.remove(os.path.join(data_dir,f))
+
+def save_shards(data_dir,items,event_id,shard_rows=2**16):
+    """
+    Write the items as compressed shards of whole event runs.
+
+    Parameters
+    ----------
+    data_dir : dir
+        output dir.
+    items : dict
+        name: array with the rows of event_id (None is skipped). Floats are stored as float32
+        like DataGenerator.load reads them.
+    event_id : array
+        event of each row.
+    shard_rows : int, optional
+        rows per shard, a shard is closed after the run that reaches it. The default is 2**16.
+
+    Returns
+    -------
+    index : dict
+        content of index.json.
+    """
+    if not os.path.exists(data_dir):
+        os.makedirs(data_dir)
+    clear_shards(data_dir)
+    items = {k:v for k,v in items.items() if v is not None}
+    items['event_id'] = np.asarray(event_id)
+    runs = event_runs(event_id)
+    index = {'items':list(items),'shape':{k:list(v.shape[1:]) for k,v in items.items()},
+             'rows':int(items['event_id'].shape[0]),'shards':[],'runs':[]}
+
+    # Group runs into shards of about shard_rows
+    bounds,rows = [0],0
+    for i,(_,s,e) in enumerate(runs):
+        rows += e-s
+        if rows >= shard_rows:
+            bounds.append(i+1)
+            rows = 0
+    if bounds[-1] < runs.shape[0]:
+        bounds.append(runs.shape[0])
+
+    for k,(b0,b1) in enumerate(zip(bounds[:-1],bounds[1:])):
+        s0,s1 = runs[b0,1],runs[b1-1,2]
+        name = 'shard_%s.npz'%str(k).zfill(4)
+        dats = {}
+        for item,dat in items.items():
+            dat = dat[s0:s1]
+            if item == 'event_id':
+                dat = dat.astype(np.int32)
+            elif dat.dtype.kind == 'f':
+                dat = dat.astype(np.float32)
+            dats[item] = dat
+        np.savez_compressed(os.path.join(data_dir,name),**dats)
+        index['shards'].append(name)
+        index['runs'] += [[int(ev),k,int(s-s0),int(e-s0)] for ev,s,e in runs[b0:b1]]
+    json.dump(index,open(os.path.join(data_dir,INDEX),'w'))
+    return index
+
+def is_sharded(data_dir):
+    return os.path.isfile(os.path.join(data_dir,INDEX))
+
+def load_shards(data_dir,items=None,events=None):
+    """
+    Read the items of the selected events.
+
+    Parameters
+    ----------
+    data_dir : dir
+        dir of index.json.
+    items : list, optional
+        items to read, None is all. Missing items are returned as None.
+    events : list, optional
+        event ids to read, None is all. Only the shards holding them are opened.
+
+    Returns
+    -------
+    dats : dict
+        name: array in the saved row order, event_id is always included.
+    """
+    index = json.load(open(os.path.join(data_dir,INDEX),'r'))
+    items = index['items'] if items is None else list(items)
+    items = items + ['event_id'] if 'event_id' not in items else items
+    runs = np.array(index['runs'],dtype=np.int64).reshape(-1,4)
+    if events is not None:
+        runs = runs[np.isin(runs[:,0],np.asarray(events))]
+
+    dats = {item:[] for item in items if item in index['items']}
+    for k in np.unique(runs[:,1]):
+        sel = runs[runs[:,1] == k]
+        with np.load(os.path.join(data_dir,index['shards'][k])) as z:
+            for item in dats:
+                dat = z[item]
+                if events is None:
+                    dats[item].append(dat)
+                else:
+                    dats[item] += [dat[s:e] for _,_,s,e in sel]
+    out = {}
+    for item in items:
+        if item not in dats:
+            out[item] = None
+        elif len(dats[item]) == 0:
+            out[item] = np.zeros([0]+index['shape'][item],np.int32 if item == 'event_id' else np.float32)
+        else:
+            out[item] = np.concatenate(dats[item],axis=0)
+    return out
@@ -71,3 +71,215 @@ class RandomMemory():
         mean = reward.mean()
         std = reward.std()
         return (mean,std)
+
+
+class SumTree():
+    # Binary sum tree over leaf priorities for prioritised sampling
+    def __init__(self,limit):
+        self.capa = 2
+        while self.capa < limit:
+            self.capa *= 2
+        self.tree = np.zeros(2*self.capa,dtype=np.float64)
+
+    def total(self):
+        return self.tree[1]
+
+    def update(self,indices,priorities):
+        pos = np.asarray(indices) + self.capa
+        self.tree[pos] = priorities
+        pos = np.unique(pos//2)
+        while pos[0] >= 1:
+            self.tree[pos] = self.tree[2*pos] + self.tree[2*pos+1]
+            if pos[0] == 1:
+                break
+            pos = np.unique(pos//2)
+
+    def find(self,values):
+        pos = np.ones(len(values),dtype=np.int64)
+        values = np.array(values,dtype=np.float64)
+        while pos[0] < self.capa:
+            left = self.tree[2*pos]
+            right = values > left
+            values -= left*right
+            pos = 2*pos + right
+        return pos - self.capa
+
+
+class ArrayMemory():
+    """
+    Replay memory on preallocated NumPy ring buffers.
+
+    Parameters
+    ----------
+    limit : int
+        maximum number of transitions.
+    cwd : str
+        directory of the saved experiences.
+    load : bool
+        if load the experiences from cwd.
+    on_policy : bool
+        if store log_probs and value.
+    mmap : bool
+        if back the buffers with .npy memmaps in cwd.
+    prioritized : bool
+        if sample with priorities (sum tree) instead of uniformly.
+    alpha : float
+        priority exponent.
+    """
+    def __init__(self,limit,cwd=None,load=False,on_policy=False,mmap=False,prioritized=False,alpha=0.6):
+        self.items = ['state','action','reward','next_state','done','log_probs','value'] if on_policy else ['state','action','reward','next_state','done']
+        self.limit = limit
+        self.cwd = cwd
+        self.mmap = mmap and cwd is not None
+        self.prioritized = prioritized
+        self.alpha = alpha
+        self.clear()
+        if load:
+            self.load(cwd)
+
+    def __len__(self):
+        return self.cur_capa
+
+    def _allocate(self,traj):
+        for idx,item in enumerate(self.items):
+            dat = np.asarray(traj[idx])
+            dtype = np.float32 if dat.dtype == np.float64 else dat.dtype
+            if self.mmap:
+                buf = np.lib.format.open_memmap(os.path.join(self.cwd,'experience_%s.npy'%item),mode='w+',dtype=dtype,shape=(self.limit,)+dat.shape)
+            else:
+                buf = np.zeros((self.limit,)+dat.shape,dtype=dtype)
+            setattr(self,item,buf)
+
+    def update(self,trajs):
+        if len(trajs) == 0:
+            return
+        if getattr(self,self.items[0]) is None:
+            self._allocate(trajs[0])
+        trajs = trajs[-self.limit:]
+        n = len(trajs)
+        indices = (self.ptr + np.arange(n)) % self.limit
+        for idx,item in enumerate(self.items):
+            getattr(self,item)[indices] = np.stack([traj[idx] for traj in trajs])
+        if self.prioritized:
+            self.tree.update(indices,np.full(n,self.max_prior**self.alpha))
+        self.ptr = int((self.ptr + n) % self.limit)
+        self.cur_capa = min(self.limit,self.cur_capa + n)
+
+    def sample(self,batch_size,continuous=False,beta=0.4):
+        if continuous:
+            # contiguous window in insertion order (wraps around the ring)
+            if self.cur_capa <= batch_size:
+                indices = np.arange(self.cur_capa)
+            else:
+                indices = np.random.randint(0,self.cur_capa - batch_size + 1) + np.arange(batch_size)
+            indices = (self.ptr - self.cur_capa + indices) % self.limit
+        elif self.prioritized:
+            total = self.tree.total()
+            values = (np.arange(batch_size) + np.random.uniform(size=batch_size)) * total / batch_size
+            indices = np.minimum(self.tree.find(values),self.cur_capa-1)
+            probs = self.tree.tree[indices + self.tree.capa] / total
+            weights = (self.cur_capa * probs) ** (-beta)
+            self.weights = (weights / weights.max()).astype(np.float32)
+        else:
+            # without replacement like RandomMemory (random.sample)
+            indices = np.random.choice(self.cur_capa,size=min(batch_size,self.cur_capa),replace=False)
+        self.indices = indices
+        return [getattr(self,item)[indices] for item in self.items]
+
+    def update_priorities(self,indices,priorities):
+        priorities = np.abs(np.asarray(priorities,dtype=np.float64)).reshape(-1) + 1e-6
+        self.max_prior = max(self.max_prior,priorities.max())
+        self.tree.update(indices,priorities**self.alpha)
+
+    def _ordered(self,item):
+        dat = getattr(self,item)
+        if self.cur_capa < self.limit:
+            return dat[:self.cur_capa]
+        return np.concatenate([dat[self.ptr:],dat[:self.ptr]],axis=0)
+
+    def save(self,cwd=None):
+        cwd = self.cwd if cwd is None else cwd
+        if self.mmap and cwd == self.cwd:
+            for item in self.items:
+                getattr(self,item).flush()
+            np.save(os.path.join(cwd,'experience_meta.npy'),np.array([self.ptr,self.cur_capa]))
+            print('Flush experiences')
+            return
+        if os.path.exists(os.path.join(cwd,'experience_meta.npy')):
+            # the saved arrays are in order: a stale ring meta would reorder them on load
+            os.remove(os.path.join(cwd,'experience_meta.npy'))
+        for item in self.items:
+            np.save(os.path.join(cwd,'experience_%s.npy'%item),self._ordered(item))
+            print('Save experience %s'%item)
+
+    def clear(self):
+        for item in self.items:
+            setattr(self,item,None)
+        self.ptr,self.cur_capa = 0,0
+        if self.prioritized:
+            self.tree = SumTree(self.limit)
+            self.max_prior = 1.0
+
+    def load(self,cwd=None):
+        cwd = self.cwd if cwd is None else cwd
+        meta = os.path.join(cwd,'experience_meta.npy')
+        if self.mmap and cwd == self.cwd and os.path.exists(meta):
+            for item in self.items:
+                setattr(self,item,np.load(os.path.join(cwd,'experience_%s.npy'%item),mmap_mode='r+'))
+            self.ptr,self.cur_capa = [int(v) for v in np.load(meta)]
+            self.limit = getattr(self,self.items[0]).shape[0]
+        else:
+            data = [np.load(os.path.join(cwd,'experience_%s.npy'%item),mmap_mode='r') for item in self.items]
+            if os.path.exists(meta):
+                # flushed ring buffers: only cur_capa rows are valid, the oldest at ptr
+                ptr,cur_capa = [int(v) for v in np.load(meta)]
+                order = np.arange(ptr - cur_capa,ptr) % data[0].shape[0]
+                data = [dat[order] for dat in data]
+            n = min(self.limit,data[0].shape[0])
+            # Into RAM first: mmap buffers are allocated (w+, truncated) on the same paths
+            data = [np.array(dat[-n:]) for dat in data]
+            self.clear()
+            self._allocate([dat[0] for dat in data])
+            for item,dat in zip(self.items,data):
+                getattr(self,item)[:n] = dat
+            self.ptr,self.cur_capa = n % self.limit,n
+        if self.prioritized:
+            self.tree = SumTree(self.limit)
+            self.tree.update(np.arange(self.cur_capa),np.full(self.cur_capa,self.max_prior**self.alpha))
+        print('Load experiences: %s'%self.cur_capa)
+
+    def get_state_norm(self):
+        state = self.state[:self.cur_capa]
+        mean = state.mean(axis=0)
+        std = state.std(axis=0)
+        return np.array([mean,std])
+
+    def get_reward_norm(self):
+        reward = self.reward[:self.cur_capa]
+        mean = reward.mean()
+        std = reward.std()
+        return (mean,std)
+
+
+def benchmark(n=2**20,batch_size=256,state_size=64,iters=100):
+    import time
+    trajs = [(np.random.uniform(size=state_size).astype(np.float32),np.random.randint(4),np.random.uniform(),
+              np.random.uniform(size=state_size).astype(np.float32),False) for _ in range(n)]
+    for name,memory in [('RandomMemory',RandomMemory(n)),('ArrayMemory',ArrayMemory(n)),
+                        ('ArrayMemory (prioritized)',ArrayMemory(n,prioritized=True))]:
+        t0 = time.time()
+        for i in range(0,n,1024):
+            memory.update(trajs[i:i+1024])
+        t1 = time.time()
+        for _ in range(iters):
+            batch = memory.sample(batch_size)
+            if isinstance(memory,ArrayMemory) and memory.prioritized:
+                memory.update_priorities(memory.indices,np.random.uniform(size=batch_size))
+        t2 = time.time()
+        for _ in range(iters):
+            batch = memory.sample(batch_size,continuous=True)
+        t3 = time.time()
+        print('%s: update %.2f s, sample %.2f ms/batch, continuous %.2f ms/batch'%(name,t1-t0,(t2-t1)/iters*1e3,(t3-t2)/iters*1e3))
+
+if __name__ == '__main__':
+    benchmark()
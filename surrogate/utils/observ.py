@@ -0,0 +1,65 @@
+import numpy as np
+import tensorflow as tf
+
+def is_cum(attr):
+    return 'cum' in attr or '_vol' in attr
+
+class ObsSpec:
+    """
+    Agent observation extraction compiled from args once.
+
+    Parameters
+    ----------
+    args : argparse.Namespace
+        agent arguments with attrs, elements, states and use_pred.
+    conv : str or bool
+        if the agent uses graph convolution (full node/edge features) or selected states.
+
+    Notes
+    -----
+    Observations reduce the temporal axis by sum for cumulative attributes ('cum' or '_vol')
+    and take the last value otherwise. Selected states are gathered by flat indexes into the
+    concatenated node and edge features, with the rainfall features in front.
+    """
+    def __init__(self,args,conv=None):
+        self.conv = conv
+        self.use_pred = getattr(args,"use_pred",False)
+        self.x_cum = np.array([is_cum(attr) for attr in args.attrs['nodes']])
+        self.e_cum = np.array([is_cum(attr) for attr in args.attrs['links']])
+        if not conv:
+            n_x,n_e = len(args.attrs['nodes']),len(args.attrs['links'])
+            n_node = len(args.elements['nodes'])
+            self.idx = np.array([args.elements['nodes'].index(idx)*n_x + args.attrs['nodes'].index(attr) if attr in args.attrs['nodes']
+                                 else n_node*n_x + args.elements['links'].index(idx)*n_e + args.attrs['links'].index(attr)
+                                 for idx,attr in args.states if attr in args.attrs['nodes']+args.attrs['links']],dtype=np.int32)
+            self.cum = np.array([is_cum(attr) for _,attr in args.states])
+
+    def aggregate(self,dat,cum,axis=0):
+        last = tf.gather(dat,tf.shape(dat)[axis]-1,axis=axis)
+        return tf.where(cum,tf.reduce_sum(dat,axis=axis),last)
+
+    def __call__(self,x,b=None,e=None,r=None,batch=False):
+        """
+        Parameters
+        ----------
+        x, b, e, r : normalized node states, runoff, edge states and rainfall
+            in shape ([batch],time,...,feature).
+        batch : bool
+            if the inputs have a leading batch axis.
+
+        Returns
+        -------
+        observ : [x,b,e] or [x,e] for graph agents, tensor of selected states otherwise.
+        """
+        axis = 1 if batch else 0
+        if self.conv:
+            observ = [self.aggregate(x,self.x_cum,axis)]
+            if self.use_pred:
+                observ += [self.aggregate(b,np.arange(b.shape[-1])==0,axis)]
+            observ += [self.aggregate(e,self.e_cum,axis) if e is not None else None]
+            return observ
+        flat = [tf.reshape(dat,list(dat.shape[:axis+1])+[-1] if not batch else [-1,dat.shape[1],int(np.prod(dat.shape[2:]))])
+                for dat in [x,e] if dat is not None]
+        observ = tf.gather(tf.concat(flat,axis=-1),self.idx,axis=-1)
+        observ = tf.concat([tf.cast(r,observ.dtype),observ],axis=-1)
+        return self.aggregate(observ,self.cum,axis)
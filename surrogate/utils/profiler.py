@@ -0,0 +1,127 @@
+import os,time,json,threading
+from functools import wraps
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        return False
+
+_NULL = _NullTimer()
+
+class _Timer:
+    def __init__(self,prof,name):
+        self.prof,self.name = prof,name
+
+    def __enter__(self):
+        self.t = time.perf_counter()
+        return self
+
+    def __exit__(self,*exc):
+        self.prof.record(self.name,self.t,time.perf_counter()-self.t)
+        return False
+
+class Profiler:
+    """
+    Named stage timers and counters, off by default.
+
+    When disabled, timer returns a shared no-op context manager, so the hooks cost one
+    attribute check. Each process has its own profiler: pool workers are not aggregated.
+
+    Parameters
+    ----------
+    max_events : int
+        number of timed spans kept for the Chrome trace (stats are always aggregated).
+    """
+    def __init__(self,max_events=1000000):
+        self.enabled = False
+        self.max_events = max_events
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.t0 = time.perf_counter()
+        self.stats = {}
+        self.counters = {}
+        self.events = []
+
+    def enable(self,flag=True):
+        self.enabled = bool(flag)
+
+    def timer(self,name):
+        return _Timer(self,name) if self.enabled else _NULL
+
+    def record(self,name,start,dur):
+        with self.lock:
+            stat = self.stats.setdefault(name,[0,0.0,0.0])
+            stat[0] += 1
+            stat[1] += dur
+            stat[2] = max(stat[2],dur)
+            if len(self.events) < self.max_events:
+                self.events.append((name,start,dur,threading.get_ident()))
+
+    def count(self,name,n=1):
+        if self.enabled:
+            with self.lock:
+                self.counters[name] = self.counters.get(name,0) + n
+
+    def summary(self):
+        summ = {name:{'count':c,'total_s':t,'mean_ms':1e3*t/max(c,1),'max_ms':1e3*m}
+                for name,(c,t,m) in self.stats.items()}
+        return {'timers':summ,'counters':dict(self.counters),'wall_s':time.perf_counter()-self.t0}
+
+    def report(self):
+        summ = self.summary()
+        lines = ['Profile over %.2fs'%summ['wall_s']]
+        for name,s in sorted(summ['timers'].items(),key=lambda kv:-kv[1]['total_s']):
+            lines.append('  %-24s %8d calls %10.3fs total %10.3fms mean %10.3fms max'%(name,s['count'],s['total_s'],s['mean_ms'],s['max_ms']))
+        for name,v in summ['counters'].items():
+            lines.append('  %-24s %8d'%(name,v))
+        print('\n'.join(lines))
+        return summ
+
+    def export_tensorboard(self,log_dir,step=0):
+        import tensorflow as tf
+        summ = self.summary()
+        with tf.summary.create_file_writer(log_dir).as_default():
+            for name,s in summ['timers'].items():
+                tf.summary.scalar('profile/%s/total_s'%name,s['total_s'],step=step)
+                tf.summary.scalar('profile/%s/mean_ms'%name,s['mean_ms'],step=step)
+                tf.summary.scalar('profile/%s/count'%name,s['count'],step=step)
+            for name,v in summ['counters'].items():
+                tf.summary.scalar('profile/%s'%name,v,step=step)
+
+    def export_chrome(self,path):
+        # Complete events ('X') in microseconds, readable by chrome://tracing or Perfetto
+        pid = os.getpid()
+        events = [{'name':name,'ph':'X','ts':1e6*(start-self.t0),'dur':1e6*dur,'pid':pid,'tid':tid}
+                  for name,start,dur,tid in self.events]
+        events += [{'name':name,'ph':'C','ts':1e6*(time.perf_counter()-self.t0),'pid':pid,'args':{name:v}}
+                   for name,v in self.counters.items()]
+        with open(path,'w') as f:
+            json.dump({'traceEvents':events,'displayTimeUnit':'ms'},f)
+
+    def export(self,out_dir,step=0):
+        if not self.enabled:
+            return
+        self.report()
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        self.export_chrome(os.path.join(out_dir,'trace.json'))
+        json.dump(self.summary(),open(os.path.join(out_dir,'profile.json'),'w'),indent=2)
+        self.export_tensorboard(out_dir,step)
+
+profiler = Profiler()
+
+def timed(name):
+    # Decorator version of profiler.timer
+    def deco(func):
+        @wraps(func)
+        def wrapper(*args,**kwargs):
+            if not profiler.enabled:
+                return func(*args,**kwargs)
+            with profiler.timer(name):
+                return func(*args,**kwargs)
+        return wrapper
+    return deco
@@ -0,0 +1,144 @@
+import numpy as np
+import multiprocessing as mp
+import os,hashlib
+from numpy.lib.stride_tricks import sliding_window_view
+
+def get_runoff(env,event,rate=False,tide=False):
+    _ = env.reset(event,global_state=True)
+    runoffs = []
+    t0 = env.env.methods['simulation_time']()
+    done = False
+    while not done:
+        done = env.step()
+        if rate:
+            runoff = np.array([[env.env._getNodeLateralinflow(node)
+                        if not env.env._isFinished else 0.0]
+                       for node in env.elements['nodes']])
+        else:
+            runoff = env.state_full()[...,-1:]
+        if tide:
+            ti = env.state_full()[...,:1]
+            runoff = np.concatenate([runoff,ti],axis=-1)
+        runoffs.append(runoff)
+    ts = [t0]+env.data_log['simulation_time'][:-1]
+    runoff = np.array(runoffs)
+    return ts,runoff
+
+class HorizonWindows:
+    """
+    Horizon windows of a runoff series, read from the (memory-mapped) series per lookup.
+
+    Parameters
+    ----------
+    runoff : np.ndarray
+        runoff series in shape (T,...).
+    horizon : int
+        window length, the tail is padded with zeros.
+
+    Notes
+    -----
+    windows[i] = runoff[i:i+horizon] is a read-only view for i <= T-horizon, only the
+    last horizon-1 windows are zero-padded copies of a few rows.
+    """
+    def __init__(self,runoff,horizon):
+        self.runoff,self.horizon = runoff,horizon
+        self.shape = (runoff.shape[0],horizon) + runoff.shape[1:]
+        self.windows = np.moveaxis(sliding_window_view(runoff,horizon,axis=0),-1,1) if runoff.shape[0] >= horizon else None
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self,i):
+        if isinstance(i,tuple):
+            return self[i[0]][i[1:]]
+        i = int(i)
+        i = i + self.shape[0] if i < 0 else i
+        if not 0 <= i < self.shape[0]:
+            raise IndexError('window %s out of %s'%(i,self.shape[0]))
+        if i + self.horizon <= self.shape[0]:
+            return self.windows[i]
+        tail = self.runoff[i:]
+        pad = np.zeros((self.horizon-tail.shape[0],)+tail.shape[1:],dtype=tail.dtype)
+        return np.concatenate([tail,pad],axis=0)
+
+def get_windows(runoff,horizon):
+    # windows[i] = runoff[i:i+horizon] without copying the series
+    return HorizonWindows(runoff,horizon)
+
+class TimeIndex:
+    """
+    Row lookup of a runoff series by simulation time.
+
+    Parameters
+    ----------
+    ts : list or np.ndarray
+        start time of each runoff step (datetime or datetime64).
+    """
+    def __init__(self,ts):
+        self.ts = np.asarray(ts,dtype='datetime64[s]').astype(np.int64)
+
+    def __len__(self):
+        return self.ts.shape[0]
+
+    def asof(self,t):
+        # Same row as DataFrame.asof: the last step starting no later than t
+        t = np.datetime64(t,'s').astype(np.int64)
+        return max(int(np.searchsorted(self.ts,t,side='right'))-1,0)
+
+class RunoffCache:
+    def __init__(self,cache_dir,interval=1,rate=False,tide=False):
+        self.cache_dir = cache_dir
+        self.interval = interval
+        self.rate,self.tide = rate,tide
+        self.keys = {}
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def get_key(self,event):
+        # Keyed by the .inp content so that regenerated events are recomputed,
+        # the hash is memoised per path and mtime
+        mtime = os.path.getmtime(event)
+        if self.keys.get(event,(None,))[0] != mtime:
+            with open(event,'rb') as f:
+                md5 = hashlib.md5(f.read()).hexdigest()[:12]
+            name = os.path.basename(event).strip('.inp')
+            self.keys[event] = (mtime,'%s_%s_%s%s_%s'%(name,md5,'rate' if self.rate else 'vol','_tide' if self.tide else '',self.interval))
+        return self.keys[event][1]
+
+    def exists(self,event):
+        return os.path.isfile(os.path.join(self.cache_dir,self.get_key(event)+'.npy'))
+
+    def save(self,event,ts,runoff):
+        key = self.get_key(event)
+        ts = np.array(ts,dtype='datetime64[s]').astype(np.int64)
+        np.save(os.path.join(self.cache_dir,key+'_ts.npy'),ts)
+        np.save(os.path.join(self.cache_dir,key+'.npy'),runoff.astype(np.float32))
+
+    def load(self,event,mmap=True):
+        key = self.get_key(event)
+        ts = np.load(os.path.join(self.cache_dir,key+'_ts.npy'))
+        runoff = np.load(os.path.join(self.cache_dir,key+'.npy'),mmap_mode='r' if mmap else None)
+        return ts.astype('datetime64[s]'),runoff
+
+    def compute(self,env,events,processes=1):
+        events = [event for event in events if not self.exists(event)]
+        if len(events) == 0:
+            return
+        print('Compute runoff of %s events'%len(events))
+        if processes > 1:
+            pool = mp.Pool(processes)
+            res = [pool.apply_async(func=get_runoff,args=(env,event,self.rate,self.tide,))
+                   for event in events]
+            pool.close()
+            pool.join()
+            res = [r.get() for r in res]
+        else:
+            res = [get_runoff(env,event,self.rate,self.tide) for event in events]
+        for event,(ts,runoff) in zip(events,res):
+            self.save(event,ts,runoff)
+
+    def get(self,env,event,horizon=None):
+        if not self.exists(event):
+            self.save(event,*get_runoff(env,event,self.rate,self.tide))
+        ts,runoff = self.load(event)
+        return ts,get_windows(runoff,horizon) if horizon is not None else runoff
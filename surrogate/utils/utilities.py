@@ -1,20 +1,88 @@
 from swmm_api import read_inp_file
 from datetime import timedelta,datetime
-from os.path import exists,splitext,dirname,join
+from os.path import exists,splitext,dirname,join,basename
 from datetime import datetime,timedelta
-from swmm_api import read_inp_file
+from swmm_api import read_inp_file,SwmmInput
 from swmm_api.input_file.sections.others import TimeseriesData,Timeseries
 import pandas as pd
 import numpy as np
 from math import log10
-import random
+import multiprocessing as mp
+import re
 
 def get_inp_files(inp,arg,**kwargs):
+    if arg.get('in_memory',False):
+        # Forcing dicts injected into the base network by the scenario: no inp is written
+        if arg['func'] not in FORCINGS:
+            raise AssertionError('%s has no in-memory mode'%arg['func'])
+        return FORCINGS[arg['func']](inp,arg=arg,**kwargs)
     files = eval(arg['func'])(inp,arg=arg,**kwargs)
     return files
 
-def split_file(file,arg,**kwargs):
+# ------ Templated inp writing  ----------------------------------------------
+# The static body of the network is rendered once; each event file only adds its own
+# sections (OPTIONS, RAINGAGES ...) and the TIMESERIES rows of its rainfall/tide series.
+_TEMPLATE = {}
+
+def get_template(inp,sections=(),timeseries=()):
+    static = inp.copy()
+    for sec in sections:
+        if sec in static:
+            del static[sec]
+    if 'TIMESERIES' in static:
+        for ts in timeseries:
+            if ts in static['TIMESERIES']:
+                del static['TIMESERIES'][ts]
+    return static.to_string()
+
+def render_sections(inp,sections):
+    part = SwmmInput()
+    for sec in sections:
+        if sec in inp:
+            part[sec] = inp[sec]
+    return part.to_string()
+
+def timeseries_lines(name,index,values):
+    index = pd.DatetimeIndex(index).strftime('%m/%d/%Y %H:%M:%S')
+    return '\n'.join(['%s %s %s'%(name,t,v) for t,v in zip(index,values)])
+
+def set_template(body):
+    # Split the body after its TIMESERIES header: the event rows go into that section,
+    # so that each file has a single [TIMESERIES] header
+    m = re.search(r'^\[TIMESERIES\][ \t]*\r?$',body,re.M)
+    pos = m.end()+1 if m is not None else None
+    _TEMPLATE['body'] = body
+    _TEMPLATE['split'] = (body[:pos],body[pos:]) if pos is not None else None
+
+def write_event(job):
+    # job: (file, rendered event sections, [(name, datetimes, values)])
+    file,head,series = job
+    rows = '\n'.join([timeseries_lines(*ts) for ts in series]) + '\n' if len(series) > 0 else ''
+    with open(file,'w') as f:
+        f.write(head)
+        if _TEMPLATE['split'] is not None:
+            pre,post = _TEMPLATE['split']
+            f.write(pre + rows + post)
+        else:
+            f.write(_TEMPLATE['body'])
+            if len(rows) > 0:
+                f.write('\n[TIMESERIES]\n' + rows)
+    return file
+
+def write_event_files(jobs,body,processes=1):
+    if processes > 1 and len(jobs) > 1:
+        with mp.Pool(processes,initializer=set_template,initargs=(body,)) as pool:
+            pool.map(write_event,jobs,chunksize=max(len(jobs)//(4*processes),1))
+    else:
+        set_template(body)
+        for job in jobs:
+            write_event(job)
+
+def split_file(file,arg,processes=None,**kwargs):
     inp = read_inp_file(file)
+    processes = arg.get('processes',1) if processes is None else processes
+    body = get_template(inp,['OPTIONS','RAINGAGES'])
+    jobs = []
     for k,v in inp.TIMESERIES.items():
         if arg['suffix'] is None or k.startswith(arg['suffix']):
             dura = v.data[-1][0] - v.data[0][0]
@@ -25,12 +93,106 @@ def split_file(file,arg,**kwargs):
             inp.OPTIONS['END_DATE'],inp.OPTIONS['END_TIME'] = et.date(),et.time()
             inp.RAINGAGES[arg['gage']].Timeseries = k
             if not exists(arg['filedir']+k+'.inp'):
-                inp.write_file(arg['filedir']+k+'.inp')
+                jobs.append((arg['filedir']+k+'.inp',render_sections(inp,['OPTIONS','RAINGAGES']),[]))
+    write_event_files(jobs,body,processes)
     events = [arg['filedir']+k+'.inp' for k in inp.TIMESERIES if arg['suffix'] is None or k.startswith(arg['suffix'])]
     return events
 
 
-def generate_file(file, arg, pattern = 'Chicago_icm', filedir = None, rain_num = 1, replace = False):
+# ------ Design storms  ------------------------------------------------------
+# Each pattern maps per-event parameter arrays (events,) to the cumulative depth H (events,time)
+# on the shared grid t = 0,delta,...,dura, so thousands of events are one numpy call.
+# Every pattern distributes the IDF depth HT = a*dura/(dura+b)**n with a = A*(1+C*log10(P)).
+
+def idf_depth(A,C,n,b,P,dura):
+    a = A*(1+C*np.log10(P))
+    return a*dura/(dura+b)**n
+
+def _chicago(t,A,C,n,b,r,P,dura):
+    # Keifer & Chu (1957), same piecewise cumulative curve as Chicago_icm
+    HT = idf_depth(A,C,n,b,P,dura)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        before = HT*(r-(r-t/dura)*(1-t/(r*(dura+b)))**(-n))
+        after = HT*(r+(t/dura-r)*(1+(t-dura)/((1-r)*(dura+b)))**(-n))
+    return np.where(t <= r*dura,before,after)
+
+def _uniform(t,A,C,n,b,r,P,dura):
+    return idf_depth(A,C,n,b,P,dura)*t/dura
+
+def _triangular(t,A,C,n,b,r,P,dura):
+    # Yen & Chow (1980): linear rise to the peak at r*dura and linear recession
+    HT,tp = idf_depth(A,C,n,b,P,dura),r*dura
+    with np.errstate(divide='ignore',invalid='ignore'):
+        rise = HT*t**2/(tp*dura)
+        fall = HT*(1-(dura-t)**2/((dura-tp)*dura))
+    return np.where(t <= tp,rise,fall)
+
+def _alternating_block(t,A,C,n,b,r,P,dura):
+    # Blocks of the IDF depth increments, largest at r*dura and the next ones alternating right/left
+    D = idf_depth(A,C,n,b,P,t[...,1:])
+    inc = -np.sort(-np.diff(D,axis=-1,prepend=0),axis=-1)
+    slots = np.arange(inc.shape[-1])
+    d = slots - np.floor(r*inc.shape[-1]).clip(0,inc.shape[-1]-1)
+    order = np.argsort(np.where(d > 0,2*d-1,-2*d),axis=-1,kind='stable')
+    blocks = np.zeros_like(inc)
+    np.put_along_axis(blocks,order,inc,axis=-1)
+    return np.concatenate([np.zeros_like(blocks[...,:1]),np.cumsum(blocks,axis=-1)],axis=-1)
+
+DESIGN_STORMS = {'chicago':_chicago,
+                 'Chicago_icm':_chicago,
+                 'uniform':_uniform,
+                 'triangular':_triangular,
+                 'alternating_block':_alternating_block}
+
+def design_storms(params,delta,dura,pattern='chicago'):
+    """
+    Hyetographs of a batch of design storms.
+
+    Parameters
+    ----------
+    params : dict or array
+        A,C,n,b,r,P as scalars or arrays of shape (events,), or an array of shape (events,6).
+    delta : int
+        time resolution (min).
+    dura : int
+        rainfall duration (min).
+    pattern : str, optional
+        one of DESIGN_STORMS. The default is 'chicago'.
+
+    Returns
+    -------
+    t : array
+        start of each interval (min), shape (time,).
+    intensity : array
+        rainfall intensity (mm/h), shape (events,time).
+    """
+    if pattern not in DESIGN_STORMS:
+        raise AssertionError('Unknown design storm pattern %s'%pattern)
+    if not isinstance(params,dict):
+        params = dict(zip(['A','C','n','b','r','P'],np.atleast_2d(params).T))
+    params = {k:np.asarray(params[k],dtype=float).reshape(-1,1) for k in ['A','C','n','b','r','P']}
+    t = np.arange(dura//delta+1)*delta
+    H = np.broadcast_to(DESIGN_STORMS[pattern](t.astype(float),dura=dura,**params),
+                        (max(v.shape[0] for v in params.values()),t.shape[0]))
+    return t[:-1],np.diff(H,axis=-1)*60/delta
+
+def sample_storm_params(arg,rain_num):
+    # Sample A,C,n,b,r (tuple: uniform range, number: fixed) and the return period P for all events
+    # Drawn from np.random (np.random.seed), or from its own RandomState if arg['seed'] is given
+    rng = np.random if arg.get('seed') is None else np.random.RandomState(arg['seed'])
+    names = ['A','C','n','b','r']
+    params = {}
+    for k,v in zip(names,arg['params'].values()):
+        params[k] = rng.uniform(*v,size=rain_num) if type(v) is tuple else np.full(rain_num,float(v))
+    if type(arg['P']) is tuple:
+        params['P'] = rng.randint(arg['P'][0],arg['P'][1]+1,size=rain_num)
+    elif type(arg['P']) is list:
+        params['P'] = np.asarray(arg['P'][:rain_num])
+    else:
+        params['P'] = np.full(rain_num,arg['P'])
+    return params
+
+def generate_file(file, arg, pattern = 'Chicago_icm', filedir = None, rain_num = 1, replace = False, processes = None):
     """
     Generate multiple inp files containing rainfall events
     designed by rainfall pattern.
@@ -42,11 +204,13 @@ def generate_file(file, arg, pattern = 'Chicago_icm', filedir = None, rain_num =
     arg : dict
         rainfall arguments.
     pattern : str, optional
-        'Chicago_icm'
+        a key of DESIGN_STORMS, or arg['pattern']. The default is 'Chicago_icm'.
     filedir : dir, optional
         The output dir. The default is None.
     rain_num : int, optional
         numbers of rainfall events. The default is 1.
+    processes : int, optional
+        number of processes writing the files. The default is arg['processes'] or 1.
 
     Returns
     -------
@@ -55,72 +219,48 @@ def generate_file(file, arg, pattern = 'Chicago_icm', filedir = None, rain_num =
 
     """
     inp = read_inp_file(file)
-    files = list()
+    processes = arg.get('processes',1) if processes is None else processes
+    pattern = arg.get('pattern',pattern)
+    gage = arg.get('gage','RG')
+    body = get_template(inp,['OPTIONS','RAINGAGES','TIMESERIES'])
+    files,jobs = list(),list()
     filedir = arg.get('filedir',dirname(file)) if filedir is None else filedir
     filedir = join(filedir,arg['suffix']+'_%s.inp')
     rain_num = arg.get('rain_num',rain_num)
-    for i in range(rain_num):
-        file = filedir%i
-        files.append(file)
-        if exists(file) == True and replace == False:
-            continue        
-
-        if type(arg['P']) is tuple:
-            p = random.randint(*arg['P'])
-        elif type(arg['P']) is list:
-            p = arg['P'][i]
-        elif type(arg['P']) in [int,float]:
-            p = arg['P']
-
-        para = []
-        for v in arg['params'].values():
-            if type(v) is tuple:
-                para.append(random.uniform(*v))
-            elif type(v) in [int,float]:
-                para.append(v)
-        para += [p,arg['delta'],arg['dura']]
-
-        # define simulation time on 01/01/2000
-        start_time = datetime(2000,1,1,0,0)
-        end_time = start_time + timedelta(minutes = arg['simu_dura'])
-        inp.OPTIONS['START_DATE'] = start_time.date()
-        inp.OPTIONS['END_DATE'] = end_time.date()
-        inp.OPTIONS['START_TIME'] = start_time.time()
-        inp.OPTIONS['END_TIME'] = end_time.time()
-        inp.OPTIONS['REPORT_START_DATE'] = start_time.date()
-        inp.OPTIONS['REPORT_START_TIME'] = start_time.time()
-
-        # calculate rainfall timeseries
-        ts = eval(pattern)(para)
-        ts = [[(start_time+timedelta(hours=1)+timedelta(minutes=t)).strftime('%m/%d/%Y %H:%M:%S'),va] for t,va in ts]
-        inp['TIMESERIES'] = Timeseries.create_section()
-        inp['TIMESERIES'].add_obj(TimeseriesData(Name = str(p)+'y',data = ts))
-        inp.RAINGAGES['RG']['Timeseries'] = str(p)+'y'
-        inp.RAINGAGES['RG']['Interval'] = str(int(arg['delta']//60)).zfill(2)+':'+str(int(arg['delta']%60)).zfill(2)
-
-        inp.write_file(file)
+    files = [filedir%i for i in range(rain_num)]
+    todo = [i for i,f in enumerate(files) if replace or not exists(f)]
+    if len(todo) == 0:
+        return files
+
+    # All hyetographs in one batch
+    params = sample_storm_params(arg,rain_num)
+    params = {k:v[todo] for k,v in params.items()}
+    t,ints = design_storms(params,arg['delta'],arg['dura'],pattern)
+
+    # define simulation time on 01/01/2000
+    start_time = datetime(2000,1,1,0,0)
+    end_time = start_time + timedelta(minutes = arg['simu_dura'])
+    inp.OPTIONS['START_DATE'] = start_time.date()
+    inp.OPTIONS['END_DATE'] = end_time.date()
+    inp.OPTIONS['START_TIME'] = start_time.time()
+    inp.OPTIONS['END_TIME'] = end_time.time()
+    inp.OPTIONS['REPORT_START_DATE'] = start_time.date()
+    inp.OPTIONS['REPORT_START_TIME'] = start_time.time()
+    inp.RAINGAGES[gage]['Interval'] = str(int(arg['delta']//60)).zfill(2)+':'+str(int(arg['delta']%60)).zfill(2)
+    times = pd.Timestamp(start_time+timedelta(hours=1)) + pd.to_timedelta(t,unit='min')
+
+    for j,i in enumerate(todo):
+        name = str(int(params['P'][j]))+'y'
+        inp.RAINGAGES[gage]['Timeseries'] = name
+        jobs.append((files[i],render_sections(inp,['OPTIONS','RAINGAGES']),[(name,times,ints[j])]))
+    write_event_files(jobs,body,processes)
     return files
 
 # Generate a rainfall intensity file from a cumulative values in ICM
 def Chicago_icm(para_tuple):
     A,C,n,b,r,P,delta,dura = para_tuple
-    a = A*(1+C*log10(P))
-    HT = a*dura/(dura+b)**n
-    Hs = []
-    for i in range(dura//delta+1):
-        t = i*delta
-        if t <= r*dura:
-            H = HT*(r-(r-t/dura)*(1-t/(r*(dura+b)))**(-n))
-        else:
-            H = HT*(r+(t/dura-r)*(1+(t-dura)/((1-r)*(dura+b)))**(-n))
-        Hs.append(H)
-    tsd = np.diff(np.array(Hs))*60/delta
-    ts = []
-    for i in range(dura//delta):
-        t = i*delta
-        # key = str(1+t//60).zfill(2)+':'+str(t % 60).zfill(2)
-        ts.append([t,tsd[i]])
-    return ts
+    t,ints = design_storms([A,C,n,b,r,P],delta,dura,'chicago')
+    return [[ti,v] for ti,v in zip(t,ints[0])]
 
 def generate_split_file(base_inp_file,
                         timeseries_file=None,
@@ -128,6 +268,7 @@ def generate_split_file(base_inp_file,
                         filedir = None,
                         rain_num = None,
                         arg = None,
+                        processes = None,
                         **kwargs):
     """
     Generate multiple inp files containing rainfall events
@@ -147,6 +288,8 @@ def generate_split_file(base_inp_file,
         numbers of rainfall events. The default is 1.
     miet : int, optional
         minimum interevent time (min). The default is 120.
+    processes : int, optional
+        number of processes writing the files. The default is arg['processes'] or 1.
     Returns
     -------
     files : list
@@ -156,63 +299,26 @@ def generate_split_file(base_inp_file,
     if arg is not None:
         replace_rain = arg.get('replace_rain',False)
         MIET = arg.get('MIET',120)
-        # if dura_range is None:
-        dura_range = arg.get('duration_range',None)
-        # if precip_range is None:
-        precip_range = arg.get('precipitation_range',None)
-        # if date_range is None:
-        date_range = arg.get('date_range',None)
+        processes = arg.get('processes',1) if processes is None else processes
+    processes = 1 if processes is None else processes
     # Read inp & data files & event file
     inp = read_inp_file(base_inp_file)
-
-    if timeseries_file is None:
-        timeseries_file = arg['rainfall_timeseries']
-    tsf = pd.read_csv(timeseries_file,index_col=0)
-    tsf['datetime'] = tsf['date']+' '+tsf['time']
-    # tsf['datetime'] = tsf['datetime'].apply(lambda dt:datetime.strptime(dt, '%m/%d/%Y %H:%M:%S'))
-    tsf.index = pd.to_datetime(tsf['datetime'])
+    tsf,events = select_events(timeseries_file,event_file,rain_num,arg)
     if arg.get('tide',False):
         tidets = pd.read_csv(arg['tide'],index_col=0)
         tidets['datetime'] = tidets['date']+' '+tidets['time']
         tidets.index = pd.to_datetime(tidets['datetime'])
 
-    if event_file is None:
-        event_file = arg.get('rainfall_events',splitext(timeseries_file)[0]+'_events.csv')
-        if not exists(event_file):
-            event_file = serapate_events(timeseries_file, MIET)
-    
-    events = pd.read_csv(event_file,index_col=0) if type(event_file) == str else event_file
-
-    if dura_range is not None:
-        events = events[events['Duration'].apply(lambda x:dura_range[0]<=x<=dura_range[1])]
-    if precip_range is not None:
-        events = events[events['Precipitation'].apply(lambda x:precip_range[0]<=x<=precip_range[1])]
-    if date_range is not None:
-        date_range = [datetime.strptime(date,'%m/%d/%Y') for date in date_range]
-        events['Date'] = pd.to_datetime(events['Date'])
-        # events['Date'] = events['Date'].apply(lambda date:datetime.strptime(date,'%m/%d/%Y'))
-        events = events[events['Date'].apply(lambda x:date_range[0]<=x<=date_range[1])]
-
     filedir = arg.get('filedir') if filedir is None else filedir
     filedir = splitext(base_inp_file)[0] if filedir is None else filedir
     filedir += '_%s.inp'
 
-    if type(rain_num) == int:
-        # files = [filedir%idx for idx in range(rain_num)]
-        events = events.sample(rain_num)
-    elif type(rain_num) == list:
-        events = events[events['Start'].apply(lambda x:x.split(':')[0].replace(' ','-') in rain_num)]
-    # elif rain_num == 'all':
-    #     files = [filedir%idx for idx in range(rain_num)]
+    # Rainfall and tide series are written per event, the rest of the network once
+    rain_ts = list(dict.fromkeys(rg.Timeseries for rg in inp.RAINGAGES.values()))
+    tide_ts = list(dict.fromkeys(inp.OUTFALLS.frame['Data'])) if arg.get('tide',False) else []
+    body = get_template(inp,['OPTIONS'],rain_ts+tide_ts)
 
-    # # Skip generation if not replace
-    # new_files = [file for file in files if not exists(file) or if_replace]
-    # if len(new_files) == 0:
-    #     return files
-
-    files = list()
-    events['Start'] = pd.to_datetime(events['Start'])
-    events['End'] = pd.to_datetime(events['End'])
+    files,jobs = list(),list()
     for start_time,end_time in zip(events['Start'],events['End']):
         # Formulate the simulation periods
         # start_time = datetime.strptime(start,'%m/%d/%Y %H:%M:%S')
@@ -227,22 +333,10 @@ def generate_split_file(base_inp_file,
         # rain = tsf[start_time < tsf['datetime']]
         # rain = rain[rain['datetime'] < end_time]
         rain = tsf[start_time:end_time]
-        raindata = {col:[(dt,vol)
-         for dt,vol in zip(rain.index,rain[col])]
-          for col in rain.columns if col not in ['date','time','datetime']}
-
-        for rg in inp.RAINGAGES.values():
-            ts = rg.Timeseries
-            inp.TIMESERIES[ts] = TimeseriesData(ts,raindata[ts])
-
+        series = [(ts,rain.index,rain[ts].values) for ts in rain_ts]
         if arg.get('tide',False):
             tide = tidets[start_time:end_time]
-            tidedata = {col:[(dt,vol)
-            for dt,vol in zip(tide.index,tide[col])]
-            for col in tide.columns if col not in ['date','time','datetime']}
-            for td in set(inp.OUTFALLS.frame['Data']):
-                inp.TIMESERIES[td] = TimeseriesData(td,tidedata[td])
-
+            series += [(td,tide.index,tide[td].values) for td in tide_ts]
 
         inp.OPTIONS['START_DATE'] = start_time.date()
         inp.OPTIONS['END_DATE'] = end_time.date()
@@ -250,13 +344,170 @@ def generate_split_file(base_inp_file,
         inp.OPTIONS['END_TIME'] = end_time.time()
         inp.OPTIONS['REPORT_START_DATE'] = start_time.date()
         inp.OPTIONS['REPORT_START_TIME'] = start_time.time()
-        inp.write_file(file)
+        jobs.append((file,render_sections(inp,['OPTIONS']),series))
+    write_event_files(jobs,body,processes)
     return files
 
 
+def select_events(timeseries_file=None,event_file=None,rain_num=None,arg=None):
+    """
+    Rainfall record and the events kept by the duration, precipitation, date and rain_num filters.
+
+    Returns
+    -------
+    tsf : DataFrame
+        rainfall timeseries indexed by datetime.
+    events : DataFrame
+        events with datetime Start and End.
+    """
+    MIET = arg.get('MIET',120)
+    dura_range = arg.get('duration_range',None)
+    precip_range = arg.get('precipitation_range',None)
+    date_range = arg.get('date_range',None)
+
+    if timeseries_file is None:
+        timeseries_file = arg['rainfall_timeseries']
+    tsf = pd.read_csv(timeseries_file,index_col=0)
+    tsf['datetime'] = tsf['date']+' '+tsf['time']
+    # tsf['datetime'] = tsf['datetime'].apply(lambda dt:datetime.strptime(dt, '%m/%d/%Y %H:%M:%S'))
+    tsf.index = pd.to_datetime(tsf['datetime'])
+
+    if event_file is None:
+        event_file = arg.get('rainfall_events',splitext(timeseries_file)[0]+'_events.csv')
+        if not exists(event_file):
+            event_file = serapate_events(timeseries_file, MIET)
+    
+    events = pd.read_csv(event_file,index_col=0) if type(event_file) == str else event_file
+
+    if dura_range is not None:
+        events = events[events['Duration'].apply(lambda x:dura_range[0]<=x<=dura_range[1])]
+    if precip_range is not None:
+        events = events[events['Precipitation'].apply(lambda x:precip_range[0]<=x<=precip_range[1])]
+    if date_range is not None:
+        date_range = [datetime.strptime(date,'%m/%d/%Y') for date in date_range]
+        events['Date'] = pd.to_datetime(events['Date'])
+        # events['Date'] = events['Date'].apply(lambda date:datetime.strptime(date,'%m/%d/%Y'))
+        events = events[events['Date'].apply(lambda x:date_range[0]<=x<=date_range[1])]
+
+    if type(rain_num) == int:
+        events = events.sample(rain_num)
+    elif type(rain_num) == list:
+        events = events[events['Start'].apply(lambda x:x.split(':')[0].replace(' ','-') in rain_num)]
+    events = events.copy()
+    events['Start'] = pd.to_datetime(events['Start'])
+    events['End'] = pd.to_datetime(events['End'])
+    return tsf,events
+
+# ------ In-memory events  ---------------------------------------------------
+# Same events as the inp writers above, as forcing dicts for env_base.set_forcing:
+# {name, start, end, interval (s), rain: {gage: intensity}}. Nothing is written to disk.
+
+def interval_seconds(iv):
+    # RAINGAGES interval as 'H:MM', decimal hours or timedelta
+    if isinstance(iv,timedelta):
+        return int(iv.total_seconds())
+    if type(iv) is str and ':' in iv:
+        h,m = iv.split(':')[:2]
+        return int(h)*3600+int(m)*60
+    return int(round(float(iv)*3600))
+
+def generate_forcing(file, arg, pattern = 'Chicago_icm', filedir = None, rain_num = 1, replace = False, **kwargs):
+    """
+    Design storms of generate_file as forcing dicts.
 
+    The rainfall starts one hour after 01/01/2000 and the simulation lasts simu_dura (min).
+    The sampled parameters are kept in filedir/<suffix>_storms.npz and reused by later calls
+    (extended if more events are asked), so that the event names always refer to the same
+    storms, as the inp files of generate_file do.
+    """
+    pattern = arg.get('pattern',pattern)
+    gage = arg.get('gage','RG')
+    rain_num = arg.get('rain_num',rain_num)
+    filedir = arg.get('filedir',dirname(file)) if filedir is None else filedir
+    params_file = join(filedir,arg['suffix']+'_storms.npz')
+    params = dict(np.load(params_file)) if exists(params_file) and not replace else None
+    if params is None or params['P'].shape[0] < rain_num:
+        n = 0 if params is None else params['P'].shape[0]
+        # the tail of a full draw: with a seed, extending gives the storms of a fresh call
+        new = {k:v[n:] for k,v in sample_storm_params(arg,rain_num).items()}
+        params = new if params is None else {k:np.concatenate([params[k],new[k]]) for k in new}
+        np.savez(params_file,**params)
+    params = {k:v[:rain_num] for k,v in params.items()}
+    _,ints = design_storms(params,arg['delta'],arg['dura'],pattern)
+    lead = np.zeros((ints.shape[0],60//arg['delta']))
+    ints = np.concatenate([lead,ints],axis=1)
+    start_time = datetime(2000,1,1,0,0)
+    end_time = start_time + timedelta(minutes = arg['simu_dura'])
+    return [{'name':arg['suffix']+'_%s'%i,'start':start_time,'end':end_time,
+             'interval':arg['delta']*60,'rain':{gage:ints[i]}} for i in range(rain_num)]
+
+def generate_split_forcing(base_inp_file,
+                           timeseries_file=None,
+                           event_file=None,
+                           rain_num = None,
+                           arg = None,
+                           **kwargs):
+    """
+    Events of generate_split_file as forcing dicts.
 
-def serapate_events(timeseries_file,miet=120,event_file=None,replace=False):
+    Each gage's series is regularised to its RAINGAGES interval (missing rows are dry)
+    and converted to intensity. Tide boundaries still need the inp files.
+    """
+    if arg.get('tide',False):
+        raise AssertionError('Tide series cannot be injected in memory, use generate_split_file')
+    MIET = arg.get('MIET',120)
+    inp = read_inp_file(base_inp_file)
+    tsf,events = select_events(timeseries_file,event_file,rain_num,arg)
+    gages = {k:(rg.Timeseries,rg.Format.upper(),interval_seconds(rg.Interval)) for k,rg in inp.RAINGAGES.items()}
+    interval = min(iv for _,_,iv in gages.values())
+    name = splitext(basename(base_inp_file))[0]+'_%s'
+
+    forcings = []
+    for start_time,end_time in zip(events['Start'],events['End']):
+        end_time += timedelta(minutes=MIET)
+        n = len(pd.date_range(start_time,end_time,freq='%ss'%interval))
+        rain = {}
+        for k,(ts,fmt,iv) in gages.items():
+            # each value is held over its own interval, then repeated onto the finest one
+            grid = pd.date_range(start_time,end_time,freq='%ss'%iv)
+            vals = tsf[start_time:end_time][ts].reindex(grid,fill_value=0).to_numpy(dtype=float)
+            vals = np.repeat(vals,iv//interval)[:n]
+            if fmt == 'VOLUME':
+                vals = vals*3600/iv
+            elif fmt != 'INTENSITY':
+                raise AssertionError('%s rainfall cannot be injected in memory'%fmt)
+            rain[k] = vals
+        forcings.append({'name':name%start_time.strftime('%m_%d_%Y_%H'),'start':start_time.to_pydatetime(),
+                         'end':end_time.to_pydatetime(),'interval':interval,'rain':rain})
+    return forcings
+
+FORCINGS = {'generate_file':generate_forcing,
+            'generate_split_file':generate_split_forcing}
+
+
+
+
+def parse_rain(tsf):
+    # int64 (ns) times and numeric values of a rainfall table with date & time columns
+    times = pd.to_datetime(tsf['date']+' '+tsf['time'],format='%m/%d/%Y %H:%M:%S')
+    vals = tsf.select_dtypes('number').to_numpy(dtype=float)
+    return times.values.astype(np.int64),vals
+
+def event_bounds(times,vals,miet=120):
+    """
+    Start, end and per-column precipitation of the events in a rainfall record.
+
+    Dry rows are dropped and a new event starts after a gap longer than miet (min).
+    """
+    wet = vals.sum(axis=1) != 0
+    times,vals = times[wet],vals[wet]
+    if times.shape[0] == 0:
+        return times,times,vals
+    start = np.concatenate([[0],np.where(np.diff(times) > miet*60*10**9)[0]+1])
+    end = np.concatenate([start[1:]-1,[times.shape[0]-1]])
+    return times[start],times[end],np.add.reduceat(vals,start,axis=0)
+
+def serapate_events(timeseries_file,miet=120,event_file=None,replace=False,chunksize=None):
     """
     Separate continous rainfall timeseries file into event-wise records.
     
@@ -268,6 +519,8 @@ def serapate_events(timeseries_file,miet=120,event_file=None,replace=False):
         minimum interevent time (min). The default is 120.
     event_file : dir
         Path of the event file to be saved.
+    chunksize : int, optional
+        rows read at a time for records larger than memory. The default is None (read at once).
 
     Returns
     -------
@@ -280,28 +533,31 @@ def serapate_events(timeseries_file,miet=120,event_file=None,replace=False):
         if exists(event_file) and not replace:
             return event_file
 
-    tsf = pd.read_csv(timeseries_file,index_col=0)
-    tsf = tsf.drop(tsf[tsf.sum(axis=1,numeric_only=True)==0].index)
-    tsf['datetime'] = tsf['date']+' '+tsf['time']
-    tsf['datetime'] = tsf['datetime'].apply(lambda dt:datetime.strptime(dt, '%m/%d/%Y %H:%M:%S'))
-    
-    rain = tsf.reset_index(drop=True,level=None)
-    start = [0] + rain[rain['datetime'].diff() > timedelta(minutes = miet)].index.tolist()
-    end = [ti-1 for ti in start[1:]] + [len(rain)-1]
+    if chunksize is None:
+        start,end,precip = event_bounds(*parse_rain(pd.read_csv(timeseries_file,index_col=0)),miet)
+    else:
+        # The last event of a chunk stays open until the next chunk starts after a gap
+        bounds,carry = [],None
+        for tsf in pd.read_csv(timeseries_file,index_col=0,chunksize=chunksize):
+            st,et,pr = event_bounds(*parse_rain(tsf),miet)
+            if st.shape[0] == 0:
+                continue
+            if carry is not None:
+                if st[0] - carry[1] > miet*60*10**9:
+                    bounds.append(carry)
+                else:
+                    st[0],pr[0] = carry[0],pr[0]+carry[2]
+            bounds += list(zip(st[:-1],et[:-1],pr[:-1]))
+            carry = (st[-1],et[-1],pr[-1])
+        bounds += [carry] if carry is not None else []
+        start,end,precip = [np.array([b[i] for b in bounds]) for i in range(3)]
     
     # Get start & end pairs of each rainfall event using month/day/year by SWMM
-    pairs = [[rain.loc[ti,'datetime'],
-    rain.loc[end[idx],'datetime']] 
-    for idx,ti in enumerate(start)]
-    events = pd.DataFrame(pairs,columns = ['Start','End'])
-    events['Date'] = events['Start'].apply(lambda st:st.strftime('%m/%d/%Y'))
-    events['Duration'] = events.apply(lambda row:(row['End'] - row['Start']).total_seconds()/60,axis=1)
-    events['Precipitation'] = [tsf.loc[tsf.index[ti]:tsf.index[end[idx]]].sum(axis=0,numeric_only=True).mean() 
-    for idx,ti in enumerate(start)]
-
-    for col in ['Start','End']:
-        events[col] = events[col].apply(lambda x: x.strftime('%m/%d/%Y %H:%M:%S'))
+    start,end = pd.to_datetime(start),pd.to_datetime(end)
+    events = pd.DataFrame({'Start':start.strftime('%m/%d/%Y %H:%M:%S'),'End':end.strftime('%m/%d/%Y %H:%M:%S')})
+    events['Date'] = start.strftime('%m/%d/%Y')
+    events['Duration'] = (end - start).total_seconds()/60
+    events['Precipitation'] = precip.mean(axis=-1) if len(events) > 0 else []
 
     events.to_csv(event_file)
     return event_file
-    